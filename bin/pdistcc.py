@@ -15,5 +15,5 @@ if os.path.exists(pdistcc_pkg):
 
 
 if __name__ == '__main__':
-    from pdistcc.cli import main
+    from pdistcc.fastclient import main
     main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+# Compiles all translation units listed in compile_commands.json.
+# Every server gets a single multiplexed connection shared by all jobs,
+# so there's no TCP handshake (and no new server thread) per job:
+#
+#   python3 -m pdistcc.batch -j 64 build/compile_commands.json
+
+import argparse
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import os.path
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from .compiler import (
+    REMOTE_ATTEMPTS,
+    find_compiler_wrapper,
+)
+from .compiler.errors import (
+    UnsupportedCompiler,
+    UnsupportedCompilationMode,
+)
+from .config import (
+    client_settings,
+    merge_settings_with_cli,
+    parse_distcc_hosts,
+)
+from .history import (
+    CostModel,
+    history,
+    host_name,
+)
+from .inventory import inventory_cache
+from .net import (
+    DccSession,
+    JobFailed,
+    MultiplexNotSupported,
+    ProtocolError,
+    ReplyTimeout,
+    ServerBusy,
+    dcc_compile,
+)
+from .sched import (
+    is_localhost,
+    scheduler,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _entry_args(entry):
+    if 'arguments' in entry:
+        return list(entry['arguments'])
+    return shlex.split(entry['command'])
+
+
+def _entry_tu(entry):
+    return os.path.abspath(os.path.join(entry['directory'], entry['file']))
+
+
+class BatchCompiler(object):
+    def __init__(self, hosts, settings={}):
+        self._settings = settings
+        self._connect_timeout = settings.get('connect_timeout')
+        self._sched = scheduler(hosts, settings)
+        self._remote_hosts = [h for h in hosts if not is_localhost(h)]
+        self._history = history(hosts, settings)
+        self._inventories = inventory_cache(settings)
+        self._model = None
+        if self._history is not None:
+            self._model = CostModel(self._history)
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._output_lock = threading.Lock()
+
+    def _session(self, host):
+        addr = (host['host'], host['port'])
+        with self._sessions_lock:
+            if addr not in self._sessions:
+                try:
+                    self._sessions[addr] = DccSession(
+                        *addr, connect_timeout=self._connect_timeout)
+                except MultiplexNotSupported:
+                    logger.info('%s:%s does not support multiplexing', *addr)
+                    self._sessions[addr] = None
+            return self._sessions[addr]
+
+    def _compile_remote(self, host, wrapper, directory, out):
+        doti = os.path.join(directory, wrapper.preprocessed_file())
+        ofile = os.path.join(directory, wrapper.object_file())
+        compression = host.get('compression')
+        addr = (host['host'], host['port'])
+        session = self._session(host)
+        if session is None:
+            return dcc_compile(doti, wrapper.compiler_cmd(),
+                               host=host['host'], port=host['port'],
+                               ofile=ofile, stdout=out, stderr=out,
+                               compression=compression,
+                               connect_timeout=self._connect_timeout,
+                               io_timeout=self._settings.get('io_timeout'))
+        try:
+            return session.compile(doti, wrapper.compiler_cmd(), ofile=ofile,
+                                   stdout=out, stderr=out,
+                                   compression=compression)
+        except JobFailed:
+            raise
+        except (OSError, ProtocolError):
+            # the connection is unusable, the next job reconnects
+            with self._sessions_lock:
+                if self._sessions.get(addr) is session:
+                    del self._sessions[addr]
+            session.close()
+            raise
+
+    def order(self, entries):
+        """The entries, longest jobs first"""
+        if self._model is None:
+            return entries
+        average = self._model.average() or 0
+
+        def duration(entry):
+            expected = self._model.duration(_entry_tu(entry),
+                                            _entry_args(entry)[0],
+                                            self._remote_hosts)
+            return average if expected is None else expected
+
+        return sorted(entries, key=duration, reverse=True)
+
+    def _run_locally(self, args, directory, out):
+        lease = self._sched.lease_local(tuple(args))
+        try:
+            proc = subprocess.run(args, cwd=directory, stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+        finally:
+            if lease is not None:
+                lease.release()
+        out.write(proc.stdout)
+        return proc.returncode
+
+    def _compile(self, args, directory, out, tu):
+        try:
+            wrapper = find_compiler_wrapper(args, self._settings)
+            if wrapper.called_for_preprocessing():
+                return self._run_locally(args, directory, out)
+            wrapper.can_handle_command()
+        except (UnsupportedCompiler, UnsupportedCompilationMode):
+            return self._run_locally(args, directory, out)
+        wrapper.rewrite_local_args()
+        ret = self._run_locally(wrapper.preprocessor_cmd(), directory, out)
+        if ret != 0:
+            return ret
+        key = tuple(args)
+        order = None
+        if self._model is not None:
+            order = self._model.placement(tu, args[0], self._remote_hosts)
+        busy = []
+        if self._inventories is not None:
+            busy.extend(self._inventories.incompatible(
+                self._remote_hosts, *wrapper.remote_compiler()))
+        failures = 0
+        max_failures = self._settings.get('remote_attempts') or REMOTE_ATTEMPTS
+        while failures < max_failures:
+            lease = self._sched.lease(key, exclude=busy, order=order)
+            if lease is None:
+                break
+            with lease:
+                if is_localhost(lease.host):
+                    break
+                try:
+                    start = time.monotonic()
+                    ret = self._compile_remote(lease.host, wrapper,
+                                               directory, out)
+                    self._sched.host_ok(lease.host)
+                    if self._history is not None and ret == 0:
+                        self._record(tu, args[0], lease.host, wrapper,
+                                     directory, time.monotonic() - start)
+                    return ret
+                except ServerBusy as e:
+                    logger.info('%s:%s is busy (%s jobs queued)',
+                                lease.host['host'], lease.host['port'],
+                                e.queued)
+                    busy.append(lease.host)
+                except ReplyTimeout as e:
+                    logger.warning('%s:%s: %s', lease.host['host'],
+                                   lease.host['port'], e)
+                    break
+                except JobFailed as e:
+                    # the host can't compile this job, others still can
+                    logger.warning('%s:%s: %s', lease.host['host'],
+                                   lease.host['port'], e)
+                    busy.append(lease.host)
+                    failures += 1
+                except (OSError, ProtocolError) as e:
+                    logger.warning('%s:%s has failed: %s', lease.host['host'],
+                                   lease.host['port'], e)
+                    self._sched.host_failed(lease.host)
+                    busy.append(lease.host)
+                    failures += 1
+        return self._run_locally(args, directory, out)
+
+    def _record(self, tu, compiler, host, wrapper, directory, duration):
+        try:
+            size = os.path.getsize(os.path.join(directory,
+                                                wrapper.preprocessed_file()))
+        except OSError:
+            size = 0
+        self._history.record(tu, compiler, host_name(host), size, duration)
+
+    def compile(self, entry):
+        out = io.BytesIO()
+        try:
+            ret = self._compile(_entry_args(entry), entry['directory'], out,
+                                _entry_tu(entry))
+        except Exception as e:
+            out.write('pdistcc: {}: {}\n'.format(entry['file'], e).encode())
+            ret = 1
+        with self._output_lock:
+            sys.stderr.buffer.write(out.getvalue())
+            sys.stderr.buffer.flush()
+        return ret
+
+    def close(self):
+        for session in self._sessions.values():
+            if session is not None:
+                session.close()
+        if self._history is not None:
+            self._history.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', dest='distcc_hosts',
+                        nargs='*', help='where to compile')
+    parser.add_argument('-j', '--jobs', type=int, default=16,
+                        help='number of concurrent jobs')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='Verbose execution mode')
+    parser.add_argument('compile_commands', help='compile_commands.json')
+    args = parser.parse_args()
+    settings = merge_settings_with_cli(client_settings(), args)
+    logging.basicConfig(level=settings['loglevel'],
+                        format='%(asctime)-15s %(message)s')
+    with open(args.compile_commands, 'r') as f:
+        entries = json.load(f)
+    batch = BatchCompiler(parse_distcc_hosts(settings['distcc_hosts']),
+                          settings)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+            failed = sum(1 for ret in executor.map(batch.compile,
+                                                   batch.order(entries))
+                         if ret != 0)
+    finally:
+        batch.close()
+    if failed:
+        print('{} of {} files failed to compile'.format(failed, len(entries)),
+              file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
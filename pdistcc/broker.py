@@ -0,0 +1,175 @@
+import array
+import copy
+import logging
+import marshal
+import os
+import os.path
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import traceback
+
+from .net import (
+    ProtocolError,
+    dcc_encode,
+    recv_exactly,
+)
+# argv, cwd and environment of the job
+MAX_JOB_SIZE = 4*1024*1024
+# jobs wait for a slot in the child processes, not in the accept loop
+MAX_JOBS = 1024
+logger = logging.getLogger(__name__)
+
+
+def default_socket_path():
+    rundir = os.environ.get('XDG_RUNTIME_DIR') or \
+        os.path.expanduser('~/.cache/pdistcc')
+    return os.path.join(rundir, 'pdistcc-broker.sock')
+
+
+def _peer_uid(conn):
+    try:
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize('3i'))
+    except (AttributeError, OSError):
+        # not Linux, the socket permissions have to do
+        return os.getuid()
+    _, uid, _ = struct.unpack('3i', creds)
+    return uid
+
+
+def recv_fds(sock, size, maxfds):
+    """(data, file descriptors) received with SCM_RIGHTS"""
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(
+        size, socket.CMSG_LEN(maxfds*fds.itemsize))
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+    return data, list(fds)
+
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    """Run a single job, in a child process of the broker"""
+
+    def _receive_job(self):
+        header, fds = recv_fds(self.request, 12, 3)
+        if len(fds) != 3:
+            for fd in fds:
+                os.close(fd)
+            raise ProtocolError('expected 3 file descriptors, got {}'
+                                .format(len(fds)))
+        if len(header) < 12:
+            header += recv_exactly(self.request, 12 - len(header))
+        if header[:4] != b'JOBR':
+            raise ProtocolError('expected JOBR, got {}'.format(header[:4]))
+        size = int(header[4:], 16)
+        if size > MAX_JOB_SIZE:
+            raise ProtocolError('job description is too big: {}'.format(size))
+        # the peer is the same user, marshal is fine
+        job = marshal.loads(recv_exactly(self.request, size))
+        return job, fds
+
+    def _setup(self, job, fds):
+        os.chdir(job['cwd'])
+        os.environ.clear()
+        os.environ.update(job['env'])
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = os.fdopen(0, 'r', closefd=False)
+        sys.stdout = os.fdopen(1, 'w', closefd=False)
+        sys.stderr = os.fdopen(2, 'w', buffering=1, closefd=False)
+
+    def _settings(self, env):
+        settings = copy.deepcopy(self.server.settings)
+        if 'DISTCC_HOSTS' in env:
+            settings['distcc_hosts'] = env['DISTCC_HOSTS'].split()
+        return settings
+
+    def _run(self, job):
+        try:
+            status = self.server.run(job['argv'], self._settings(job['env']))
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except subprocess.CalledProcessError as e:
+            status = e.returncode
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        return status or 0
+
+    def handle(self):
+        if _peer_uid(self.request) != os.getuid():
+            logger.warning('rejecting a job of another user')
+            return
+        job, fds = self._receive_job()
+        self._setup(job, fds)
+        status = self._run(job)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.request.sendall(dcc_encode('STAT', status & 0xff))
+
+
+class Broker(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Keeps the modules imported and the settings parsed between jobs.
+
+    Every job runs in a forked child, so jobs don't share the current
+    directory, the environment, and stdout/stderr, and the compiler
+    wrappers work as in a standalone pdistcc process. For the same
+    reason a job opens its own connection to the server; the scheduler
+    state (slots, failed hosts) is kept in files shared by all pdistcc
+    processes anyway.
+    """
+
+    max_children = MAX_JOBS
+
+    def __init__(self, path, settings, run):
+        self.settings = settings
+        self.run = run
+        _remove_stale_socket(path)
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(path, BrokerHandler)
+        finally:
+            os.umask(old_umask)
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+    raise RuntimeError('broker is already running at {}'.format(path))
+
+
+def broker_main():
+    import argparse
+    from .cli import main
+    from .config import (
+        client_settings,
+        merge_settings_with_cli,
+        parse_loglevel,
+    )
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default=default_socket_path(),
+                        help='Unix socket to listen at')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='Verbose execution mode')
+    args = parser.parse_args()
+    settings = merge_settings_with_cli(client_settings(), args)
+    logging.basicConfig(level=parse_loglevel(settings['loglevel']),
+                        format='%(asctime)-15s %(message)s')
+    os.makedirs(os.path.dirname(args.socket), exist_ok=True)
+    with Broker(args.socket, settings, main) as broker:
+        logger.info('listening at %s', args.socket)
+        try:
+            broker.serve_forever()
+        finally:
+            os.remove(args.socket)
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+# Builds a synthetic C++ project with pdistcc against K local pdistccd
+# instances at several -j levels, and compares with a purely local build:
+#
+#   python3 -m pdistcc.build_bench --units 200 --servers 4 -j 8 -j 16
+#
+# The project has N light translation units including a chain of headers
+# (--header-depth deep, --header-size functions each), a few heavy
+# template ones (--heavy), and a main program linking all of them. It is
+# built with ninja if available, with make otherwise.
+
+import argparse
+import json
+import os
+import os.path
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ('compile', 'link')
+LAUNCHER = '''#!{python}
+import sys
+sys.path.insert(0, {pkgdir!r})
+from pdistcc.cli import main
+sys.exit(main())
+'''
+SERVER = 'from pdistcc.cli import server_main; server_main()'
+HEAVY_UNIT = '''#include <algorithm>
+#include <functional>
+#include <map>
+#include <memory>
+#include <sstream>
+#include <string>
+#include <utility>
+#include <vector>
+
+namespace {{
+
+template <int N>
+struct Value {{
+    std::map<std::string, std::vector<std::function<int(int)>>> handlers;
+    std::string describe() const {{
+        std::ostringstream out;
+        for (const auto& kv : handlers) {{
+            out << kv.first << kv.second.size();
+        }}
+        return out.str() + std::to_string(N);
+    }}
+}};
+
+template <int... Ns>
+std::string describe_all(std::integer_sequence<int, Ns...>) {{
+    std::vector<std::string> all;
+    (all.push_back(Value<Ns>{{}}.describe()), ...);
+    std::sort(all.begin(), all.end());
+    return all.front();
+}}
+
+}} // namespace
+
+std::string heavy{n}() {{
+    return describe_all(std::make_integer_sequence<int, {instances}>{{}});
+}}
+'''
+# Perf of a handled request, as logged by pdistccd -v
+HANDLED_RX = re.compile(r'handled: total: ([0-9.]+), compile: ([0-9.]+), '
+                        r'recv: ([0-9.]+), send: ([0-9.]+)')
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def generate_project(root, units=100, header_depth=4, header_size=100,
+                     unit_size=20, heavy=2, heavy_instances=150):
+    """Write the sources, return the list of them"""
+    for d in range(header_depth):
+        lines = ['#pragma once']
+        if d + 1 < header_depth:
+            lines.append('#include "level{}.h"'.format(d + 1))
+        for i in range(header_size):
+            lines.append('static inline int h{0}_{1}(int x) {{ return x*{1} + {0}; }}'
+                         .format(d, i))
+        _write(os.path.join(root, 'include', 'level{}.h'.format(d)),
+               '\n'.join(lines) + '\n')
+    sources = []
+    for n in range(units):
+        lines = ['#include "level0.h"'] if header_depth > 0 else []
+        for k in range(unit_size):
+            call = 'h0_{}(x)'.format(k % header_size) \
+                if header_depth > 0 and header_size > 0 else 'x'
+            lines.append('int unit{}_{}(int x) {{ return {} + {}; }}'
+                         .format(n, k, call, k))
+        sources.append('src/unit{}.cpp'.format(n))
+        _write(os.path.join(root, sources[-1]), '\n'.join(lines) + '\n')
+    for n in range(heavy):
+        sources.append('src/heavy{}.cpp'.format(n))
+        _write(os.path.join(root, sources[-1]),
+               HEAVY_UNIT.format(n=n, instances=heavy_instances))
+    lines = ['#include <cstdio>']
+    lines.extend('int unit{}_0(int x);'.format(n) for n in range(units))
+    lines.append('int main() {')
+    lines.append('    int sum = 0;')
+    lines.extend('    sum += unit{}_0(1);'.format(n) for n in range(units))
+    lines.append('    std::printf("%d\\n", sum);')
+    lines.append('    return 0;')
+    lines.append('}')
+    sources.append('src/main.cpp')
+    _write(os.path.join(root, sources[-1]), '\n'.join(lines) + '\n')
+    return sources
+
+
+def _object(source):
+    return 'obj/' + os.path.basename(source)[:-len('.cpp')] + '.o'
+
+
+def _write_build_files(root, sources, compiler, tool):
+    objects = [_object(s) for s in sources]
+    compile = ' '.join(compiler + ['-O2', '-Iinclude'])
+    link = 'g++ -o bench ' + ' '.join(objects)
+    if tool == 'ninja':
+        lines = [
+            'rule cc',
+            '  command = {} -c -o $out $in'.format(compile),
+            'rule link',
+            '  command = {}'.format(link),
+        ]
+        for source, obj in zip(sources, objects):
+            lines.append('build {}: cc {}'.format(obj, source))
+        lines.append('build objects: phony ' + ' '.join(objects))
+        lines.append('build bench: link ' + ' '.join(objects))
+        _write(os.path.join(root, 'build.ninja'), '\n'.join(lines) + '\n')
+        return
+    lines = [
+        '.PHONY: objects',
+        'objects: ' + ' '.join(objects),
+        'bench: ' + ' '.join(objects),
+        '\t' + link,
+    ]
+    for source, obj in zip(sources, objects):
+        lines.append('{}: {}'.format(obj, source))
+        lines.append('\t{} -c -o $@ $<'.format(compile))
+    _write(os.path.join(root, 'Makefile'), '\n'.join(lines) + '\n')
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port, proc, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("pdistccd on port {} hasn't started".format(port))
+            time.sleep(0.05)
+
+
+class Servers(object):
+    """K pdistccd instances on the loopback interface"""
+
+    def __init__(self, workdir, env, count, jobs):
+        self._procs = []
+        self._logs = []
+        self.ports = []
+        try:
+            for n in range(count):
+                port = _free_port()
+                # O_APPEND: the offset is shared with the daemon
+                log = open(os.path.join(workdir, 'pdistccd-{}.log'.format(port)), 'a+')
+                proc = subprocess.Popen([sys.executable, '-c', SERVER,
+                                         '--host', '127.0.0.1',
+                                         '--port', str(port),
+                                         '--jobs', str(jobs), '-v'],
+                                        env=env, stderr=log)
+                self._procs.append(proc)
+                self._logs.append(log)
+                _wait_for_port(port, proc)
+                self.ports.append(port)
+        except BaseException:
+            self.stop()
+            raise
+
+    def log_offsets(self):
+        return [log.seek(0, os.SEEK_END) for log in self._logs]
+
+    def breakdown(self, offsets):
+        """Requests handled since the offsets, summed per server"""
+        per_server = []
+        for log, offset in zip(self._logs, offsets):
+            log.seek(offset)
+            stats = {'jobs': 0, 'total_ms': 0.0, 'compile_ms': 0.0,
+                     'recv_ms': 0.0, 'send_ms': 0.0}
+            for m in HANDLED_RX.finditer(log.read()):
+                stats['jobs'] += 1
+                for key, value in zip(('total_ms', 'compile_ms', 'recv_ms',
+                                       'send_ms'), m.groups()):
+                    stats[key] += float(value)
+            per_server.append(stats)
+        return per_server
+
+    def stop(self):
+        for proc in self._procs:
+            proc.terminate()
+        for proc in self._procs:
+            proc.wait()
+        for log in self._logs:
+            log.close()
+
+
+def _build(root, tool, jobs, env):
+    """Clean build, seconds taken by every phase"""
+    shutil.rmtree(os.path.join(root, 'obj'), ignore_errors=True)
+    os.makedirs(os.path.join(root, 'obj'))
+    if os.path.exists(os.path.join(root, 'bench')):
+        os.remove(os.path.join(root, 'bench'))
+    times = {}
+    for phase, target in zip(PHASES, ('objects', 'bench')):
+        start = time.perf_counter()
+        subprocess.run([tool, '-j', str(jobs), target], cwd=root, env=env,
+                       stdout=subprocess.DEVNULL, check=True)
+        times[phase] = time.perf_counter() - start
+    times['makespan'] = sum(times[phase] for phase in PHASES)
+    return times
+
+
+def _environment(workdir, ports, server_slots, localhost_slots):
+    env = dict(os.environ)
+    pkgdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in [pkgdir, env.get('PYTHONPATH')] if p)
+    confdir = os.path.join(workdir, 'config')
+    # fresh settings: no object cache, private slot locks
+    _write(os.path.join(confdir, 'client.json'),
+           json.dumps({'lock_dir': os.path.join(workdir, 'lock')}))
+    env['PDISTCC_DIR'] = confdir
+    hosts = ['127.0.0.1:{}/{}'.format(port, server_slots) for port in ports]
+    if localhost_slots > 0:
+        hosts.append('localhost/{}'.format(localhost_slots))
+    env['DISTCC_HOSTS'] = ' '.join(hosts)
+    env.pop('PDISTCC_BROKER', None)
+    return env, pkgdir
+
+
+def measure(jobs=(4, 8), units=100, header_depth=4, header_size=100,
+            unit_size=20, heavy=2, servers=2, server_jobs=None,
+            localhost_slots=0, tool=None, workdir=None):
+    tool = tool or ('ninja' if shutil.which('ninja') else 'make')
+    server_jobs = server_jobs or max(1, (os.cpu_count() or 1)//servers)
+    results = {'tool': tool, 'units': units + heavy + 1, 'servers': servers,
+               'server_jobs': server_jobs, 'runs': []}
+    with tempfile.TemporaryDirectory(prefix='pdistcc-build-bench-') as tmpdir:
+        workdir = workdir or tmpdir
+        root = os.path.join(workdir, 'project')
+        sources = generate_project(root, units, header_depth, header_size,
+                                   unit_size, heavy)
+        env, pkgdir = _environment(workdir, [], 0, 0)
+        local = {}
+        _write_build_files(root, sources, ['g++'], tool)
+        for j in jobs:
+            local[j] = _build(root, tool, j, env)
+        server_procs = Servers(workdir, env, servers, server_jobs)
+        try:
+            env, _ = _environment(workdir, server_procs.ports, server_jobs,
+                                  localhost_slots)
+            launcher = os.path.join(workdir, 'pdistcc')
+            _write(launcher, LAUNCHER.format(python=sys.executable,
+                                             pkgdir=pkgdir))
+            os.chmod(launcher, 0o755)
+            _write_build_files(root, sources, [launcher, 'g++'], tool)
+            for j in jobs:
+                offsets = server_procs.log_offsets()
+                distributed = _build(root, tool, j, env)
+                results['runs'].append({
+                    'jobs': j,
+                    'local': local[j],
+                    'distributed': distributed,
+                    'speedup': local[j]['makespan']/distributed['makespan'],
+                    'servers': server_procs.breakdown(offsets),
+                })
+        finally:
+            server_procs.stop()
+    return results
+
+
+def _print_results(results):
+    print('{} translation units built with {}, {} servers x {} jobs'
+          .format(results['units'], results['tool'],
+                  results['servers'], results['server_jobs']))
+    for run in results['runs']:
+        print('-j{:<4} local: {:7.2f} s  distributed: {:7.2f} s '
+              '(compile {:.2f} s, link {:.2f} s)  speedup: {:.2f}'
+              .format(run['jobs'], run['local']['makespan'],
+                      run['distributed']['makespan'],
+                      run['distributed']['compile'],
+                      run['distributed']['link'], run['speedup']))
+        for n, stats in enumerate(run['servers']):
+            jobs = stats['jobs'] or 1
+            print('      server {}: {:4} jobs, per job: compile {:.1f} ms, '
+                  'recv {:.1f} ms, send {:.1f} ms, total {:.1f} ms'
+                  .format(n, stats['jobs'], stats['compile_ms']/jobs,
+                          stats['recv_ms']/jobs, stats['send_ms']/jobs,
+                          stats['total_ms']/jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, action='append',
+                        help='build parallelism (default: 4 and 8)')
+    parser.add_argument('--units', type=int, default=100,
+                        help='number of light translation units')
+    parser.add_argument('--header-depth', type=int, default=4)
+    parser.add_argument('--header-size', type=int, default=100,
+                        help='functions per header')
+    parser.add_argument('--unit-size', type=int, default=20,
+                        help='functions per translation unit')
+    parser.add_argument('--heavy', type=int, default=2,
+                        help='number of heavy template translation units')
+    parser.add_argument('--servers', type=int, default=2,
+                        help='number of pdistccd instances')
+    parser.add_argument('--server-jobs', type=int,
+                        help='compile slots of every server (default: CPUs/servers)')
+    parser.add_argument('--localhost', type=int, default=0, metavar='N',
+                        help='also compile up to N jobs locally')
+    parser.add_argument('--tool', choices=('ninja', 'make'),
+                        help='build tool (default: ninja if available)')
+    parser.add_argument('--keep', metavar='DIR',
+                        help='generate the project and logs in DIR')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+    results = measure(args.jobs or (4, 8), args.units, args.header_depth,
+                      args.header_size, args.unit_size, args.heavy,
+                      args.servers, args.server_jobs, args.localhost,
+                      args.tool, args.keep)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_results(results)
+
+
+if __name__ == '__main__':
+    main()
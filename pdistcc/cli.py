@@ -7,38 +7,56 @@ from .config import (
      DISTCCD_PORT,
      client_settings,
      merge_settings_with_cli,
-     parse_distcc_host,
+     parse_distcc_hosts,
      server_settings,
 )
 from .compiler import wrap_compiler
-from .server import daemon
+from . import trace
 
 
-def main():
+def main(argv=None, settings=None):
+    trace.start()
+    try:
+        with trace.span('settings'):
+            distcc_hosts, compiler_cmd, settings = _client_args(argv, settings)
+        return wrap_compiler(distcc_hosts, compiler_cmd, settings)
+    finally:
+        trace.finish()
+
+
+def _client_args(argv, settings):
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', dest='distcc_hosts',
                         nargs='*', help='where to compile')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='Verbose execution mode')
     parser.add_argument("compiler", nargs='*', help="compiler and arguments")
-    args, unknown = parser.parse_known_args()
+    args, unknown = parser.parse_known_args(argv)
     args.compiler.extend(unknown)
 
-    settings = merge_settings_with_cli(client_settings(), args)
+    if settings is None:
+        settings = client_settings()
+    settings = merge_settings_with_cli(settings, args)
     logging.basicConfig(level=settings['loglevel'],
                         format='%(asctime)-15s %(message)s')
-    distcc_hosts = [parse_distcc_host(h) for h in settings['distcc_hosts']]
-    wrap_compiler(distcc_hosts, args.compiler, settings)
+    distcc_hosts = parse_distcc_hosts(settings['distcc_hosts'])
+    return distcc_hosts, args.compiler, settings
 
 
 def server_main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', help='IP to bind to')
     parser.add_argument('--port', type=int, help='port to listen at')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of concurrent compilations (default: CPU count)')
+    parser.add_argument('--metrics-listen', metavar='HOST:PORT',
+                        help='serve Prometheus metrics over HTTP')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='Verbose execution mode')
     args = parser.parse_args()
     settings = merge_settings_with_cli(server_settings(), args)
+    # asyncio takes a while to import, don't slow down the client
+    from .server import daemon
     daemon(settings,
            host=settings['host'],
            port=settings['port'])
@@ -1,4 +1,5 @@
 
+import logging
 import os
 import re
 import subprocess
@@ -9,16 +10,43 @@ from .errors import (
 )
 from .gcc import GCCWrapper
 from .msvc import MSVCWrapper
-from ..sched import pick_server
+from .. import trace
+from ..history import (
+        CostModel,
+        history,
+        host_name,
+)
+from ..inventory import inventory_cache
+from ..net import (
+        JobFailed,
+        ProtocolError,
+        ReplyTimeout,
+        ServerBusy,
+)
+from ..sched import (
+        is_localhost,
+        scheduler,
+)
 
+# servers to try before compiling locally if they fail
+REMOTE_ATTEMPTS = 3
 
-def find_compiler_wrapper(compiler_cmd, settings={}):
-    compiler_name = os.path.basename(compiler_cmd[0])
+logger = logging.getLogger(__name__)
+
+
+def is_gcc(compiler_name):
     if compiler_name in ('gcc', 'g++', 'c++'):
-        wrapper = GCCWrapper(compiler_cmd, settings)
+        return True
     elif re.match('^.*-gcc(-[0-9.]+)*$', compiler_name):
-        wrapper = GCCWrapper(compiler_cmd, settings)
+        return True
     elif re.match('^.*-g[+][+](-[0-9.]+)*$', compiler_name):
+        return True
+    return False
+
+
+def find_compiler_wrapper(compiler_cmd, settings={}):
+    compiler_name = os.path.basename(compiler_cmd[0])
+    if is_gcc(compiler_name):
         wrapper = GCCWrapper(compiler_cmd, settings)
     elif compiler_name in ('cl', 'clang-cl', 'cl.exe', 'clang-cl.exe'):
         wrapper = MSVCWrapper(compiler_cmd, settings)
@@ -28,13 +56,118 @@ def find_compiler_wrapper(compiler_cmd, settings={}):
 
 
 def wrap_compiler(distcc_hosts, compiler_cmd, settings={}):
-    host = pick_server(distcc_hosts, tuple(compiler_cmd))
-    if host['host'] == 'localhost':
-        subprocess.check_call(compiler_cmd)
-    else:
+    """Compile remotely if possible, returns the exit status of the compiler"""
+    try:
         wrapper = find_compiler_wrapper(compiler_cmd, settings)
-        try:
-            wrapper.wrap_compiler(host['host'], host['port'])
-        except UnsupportedCompilationMode:
-            # called for linking, etc
+        if not wrapper.prepare():
+            return 0
+    except UnsupportedCompiler as e:
+        # fine as long as it's compiled locally
+        wrapper, error = None, e
+    except UnsupportedCompilationMode:
+        # called for linking, etc
+        with trace.span('local', reason='unsupported mode'):
             subprocess.check_call(compiler_cmd)
+        return 0
+    sched = scheduler(distcc_hosts, settings)
+    key = tuple(compiler_cmd)
+    # hosts not to try again: busy, failed or lacking the compiler
+    busy = []
+    inventories = inventory_cache(settings) if wrapper is not None else None
+    if inventories is not None:
+        with trace.span('inventory'):
+            busy.extend(inventories.incompatible(distcc_hosts,
+                                                 *wrapper.remote_compiler()))
+    jobs = None
+    model = None
+    order = None
+    if wrapper is not None and wrapper.source_file():
+        jobs = history(distcc_hosts, settings)
+    try:
+        if jobs is not None:
+            tu = os.path.abspath(wrapper.source_file())
+            model = CostModel(jobs)
+            with trace.span('placement'):
+                order = model.placement(
+                    tu, compiler_cmd[0],
+                    [h for h in distcc_hosts if not is_localhost(h)])
+        local = [h for h in distcc_hosts if is_localhost(h)]
+        failures = 0
+        max_failures = settings.get('remote_attempts') or REMOTE_ATTEMPTS
+        while failures < max_failures:
+            with trace.span('lease'):
+                lease = sched.lease(key, exclude=busy, order=order)
+            if lease is None:
+                break
+            with lease:
+                host = lease.host
+                trace.tag(host='{}:{}'.format(host['host'], host['port']))
+                if is_localhost(host):
+                    with trace.span('local', reason='localhost'):
+                        subprocess.check_call(compiler_cmd)
+                    return 0
+                if wrapper is None:
+                    raise error
+
+                def backup():
+                    # an idle server to send a duplicate of a slow job to
+                    return sched.try_lease(key, exclude=busy + local + [host])
+
+                def straggler(size):
+                    if model is None:
+                        return None
+                    return model.straggler(host_name(host), size)
+
+                try:
+                    ret = wrapper.compile_remote(host['host'], host['port'],
+                                                 compression=host.get('compression'),
+                                                 pump=host.get('pump', False),
+                                                 stream=host.get('stream', False),
+                                                 backup=backup,
+                                                 straggler=straggler)
+                    sched.host_ok(host)
+                    if (jobs is not None and ret == 0
+                            and wrapper.remote_duration is not None):
+                        # a hedged job might have come from the backup
+                        winner = wrapper.remote_host or host
+                        jobs.record(tu, compiler_cmd[0], host_name(winner),
+                                    wrapper.remote_size, wrapper.remote_duration)
+                    return ret
+                except ServerBusy as e:
+                    logger.info('%s:%s is busy (%s jobs queued)',
+                                host['host'], host['port'], e.queued)
+                    busy.append(host)
+                except ReplyTimeout as e:
+                    # the server is up and compiling, the job is just slow:
+                    # don't skip the server, don't wait for another one
+                    logger.warning('%s:%s: %s', host['host'], host['port'], e)
+                    break
+                except JobFailed as e:
+                    # the server is fine but can't compile this job (e.g.
+                    # it lacks the compiler): retry elsewhere, no backoff
+                    logger.warning('%s:%s: %s', host['host'], host['port'], e)
+                    busy.append(host)
+                    failures += 1
+                except (OSError, ProtocolError) as e:
+                    # refused connection, timeout, garbled reply: let other
+                    # jobs skip the host for a while, retry the job elsewhere
+                    logger.warning('%s:%s has failed: %s', host['host'],
+                                   host['port'], e)
+                    sched.host_failed(host)
+                    busy.append(host)
+                    failures += 1
+        # all servers are busy or failing, compile locally, but not on more
+        # cores than localhost has slots
+        trace.tag(host='localhost')
+        with trace.span('lease'):
+            lease = sched.lease_local(key)
+        try:
+            with trace.span('local', reason='no server available'):
+                subprocess.check_call(compiler_cmd)
+        finally:
+            if lease is not None:
+                lease.release()
+        return 0
+    finally:
+        if jobs is not None:
+            jobs.close()
@@ -7,21 +7,46 @@ import subprocess
 
 from .wrapper import CompilerWrapper
 from .errors import UnsupportedCompilationMode
-from ..inodecache import InodeCache
+from .includes import IncludeScanner
+from ..inodecache import (
+    BACKEND_FILES,
+    inode_cache,
+)
 
 LANG_C = 'c'
 LANG_CXX = 'c++'
 
 COMPILER_DIR = 'compiler_dir'
+# 'files' (default) or 'mmap', see pdistcc.inodecache
+INODE_CACHE = 'inode_cache'
 INO_CACHE_TRIPLET = 1
 INO_CACHE_MARCH_NATIVE = 2
+# 3 is used by the object cache for the compiler identity
+INO_CACHE_SYSTEM_DIRS_C = 4
+INO_CACHE_SYSTEM_DIRS_CXX = 5
+INO_CACHE_VERSION = 6
 
 logger = logging.getLogger(__name__)
 
 
 def gcc_resolve_triplet(gccpath):
     cmd = [gccpath, '-dumpmachine']
-    return subprocess.check_output(cmd).strip()
+    return subprocess.check_output(cmd, encoding='utf-8').strip()
+
+
+def gcc_version(gccpath):
+    # -dumpversion prints just the major version since GCC 7
+    cmd = [gccpath, '-dumpfullversion', '-dumpversion']
+    return subprocess.check_output(cmd, encoding='utf-8').strip()
+
+
+def inode_cached(ino_cache, gcc_abspath, kind, resolve):
+    """resolve(gcc_abspath) cached until the compiler binary changes"""
+    value = ino_cache.get_str(gcc_abspath, kind)
+    if value is None:
+        value = resolve(gcc_abspath)
+        ino_cache.put_str(gcc_abspath, kind, value)
+    return value
 
 
 def gcc_march_native(gcc_abspath):
@@ -37,6 +62,29 @@ def gcc_march_native(gcc_abspath):
     return cpuname
 
 
+def gcc_system_include_dirs(gcc_abspath, lang):
+    cmd = [gcc_abspath, '-x', lang, '-E', '-v', os.devnull]
+    out = subprocess.run(cmd,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE,
+                         encoding='utf-8',
+                         check=True).stderr
+    dirs = []
+    in_search_list = False
+    for line in out.split('\n'):
+        if line.startswith('#include <...> search starts here:'):
+            in_search_list = True
+        elif line.startswith('End of search list.'):
+            break
+        elif in_search_list:
+            dirs.append(line.strip().split(' (framework directory)')[0])
+    return dirs
+
+
+def _escape_make(path):
+    return path.replace(' ', '\\ ')
+
+
 class GCCWrapper(CompilerWrapper):
     source_file_extensions = ('cpp', 'cxx', 'cc', 'c', 'i', 'ii')
     extension2lang = {
@@ -44,12 +92,13 @@ class GCCWrapper(CompilerWrapper):
     }
 
     def __init__(self, args, settings={}):
-        super().__init__(args)
+        super().__init__(args, settings)
         self._srcfile = None
         self._objfile = None
         self._preprocessed_file = None
         self._cachedir = os.path.expanduser('~/.cache/pdistcc/icache')
         cfg = settings.get('gcc', {})
+        self._ino_backend = cfg.get(INODE_CACHE, BACKEND_FILES)
         if COMPILER_DIR in cfg:
             compiler = os.path.basename(self._compiler)
             self._compiler = os.path.join(cfg[COMPILER_DIR], compiler)
@@ -102,7 +151,20 @@ class GCCWrapper(CompilerWrapper):
         if not has_object_file:
             raise UnsupportedCompilationMode('output object not specified')
 
-    def preprocessor_cmd(self):
+    def _dependency_args(self):
+        # with -E the dependency file name and the target are derived
+        # from the -o argument, the preprocessed file or '-' instead of
+        # the object file
+        if not any(arg in self._args for arg in ('-MD', '-MMD')):
+            return []
+        args = []
+        if '-MF' not in self._args:
+            args.extend(['-MF', self.dependency_file()])
+        if '-MT' not in self._args and '-MQ' not in self._args:
+            args.extend(['-MQ', self._objfile])
+        return args
+
+    def preprocessor_cmd(self, to_stdout=False):
         cmd = [self._compiler]
         next_arg_is_object = False
 
@@ -114,7 +176,7 @@ class GCCWrapper(CompilerWrapper):
             elif next_arg_is_object:
                 self._objfile = arg
                 self._preprocessed_file = self._preprocessed_filename(arg)
-                cmd.append(self._preprocessed_file)
+                cmd.append('-' if to_stdout else self._preprocessed_file)
                 next_arg_is_object = False
                 skip_arg = True
             elif '-o' == arg:
@@ -123,6 +185,7 @@ class GCCWrapper(CompilerWrapper):
                 pass
             if not skip_arg:
                 cmd.append(arg)
+        cmd.extend(self._dependency_args())
         return cmd
 
     def set_source_file(self, srcfile):
@@ -178,6 +241,9 @@ class GCCWrapper(CompilerWrapper):
     def called_for_preprocessing(self):
         return '-E' in self._args
 
+    def can_read_stdin(self):
+        return True
+
     def is_preprocessor_flag(self, arg):
         if arg.startswith('-D'):
             return True, False
@@ -189,9 +255,9 @@ class GCCWrapper(CompilerWrapper):
             return True, False
         elif arg == '-Xpreprocessor':
             return True, True
-        elif arg in ('-MD', '-M', '-nostdinc'):
+        elif arg in ('-MD', '-MMD', '-MP', '-M', '-nostdinc'):
             return True, False
-        elif arg in ('-MT', '-MF'):
+        elif arg in ('-MT', '-MQ', '-MF'):
             return True, True
         elif arg in ('-include', '-imacro', '-iquote', '-isystem'):
             return True, True
@@ -204,9 +270,19 @@ class GCCWrapper(CompilerWrapper):
         else:
             return shutil.which(self._compiler) or self._compiler
 
+    def remote_compiler(self):
+        name, _ = super().remote_compiler()
+        ino_cache = inode_cache(self._cachedir, self._ino_backend)
+        try:
+            triplet = inode_cached(ino_cache, self._compiler_abspath(),
+                                   INO_CACHE_TRIPLET, gcc_resolve_triplet)
+        except (OSError, subprocess.CalledProcessError):
+            triplet = None
+        return name, triplet
+
     def _replace_march_native(self, flag='-march'):
         gcc_abspath = self._compiler_abspath()
-        ino_cache = InodeCache(self._cachedir)
+        ino_cache = inode_cache(self._cachedir, self._ino_backend)
         cpuname = ino_cache.get_str(gcc_abspath, INO_CACHE_MARCH_NATIVE)
         if cpuname is None:
             cpuname = gcc_march_native(gcc_abspath)
@@ -215,6 +291,115 @@ class GCCWrapper(CompilerWrapper):
             logger.debug("got cpuname '%s' from inode cache", cpuname)
         return f"{flag}={cpuname}"
 
+    def _system_include_dirs(self):
+        gcc_abspath = self._compiler_abspath()
+        lang = self._lang()
+        kind = INO_CACHE_SYSTEM_DIRS_C if lang == LANG_C else INO_CACHE_SYSTEM_DIRS_CXX
+        ino_cache = inode_cache(self._cachedir, self._ino_backend)
+        dirs = ino_cache.get_str(gcc_abspath, kind)
+        if dirs is None:
+            dirs = '\n'.join(gcc_system_include_dirs(gcc_abspath, lang))
+            ino_cache.put_str(gcc_abspath, kind, dirs)
+        return [d for d in dirs.split('\n') if d]
+
+    def _include_search_path(self):
+        quote_dirs, bracket_dirs, after_dirs, forced = [], [], [], []
+        lists = {
+            '-iquote': quote_dirs,
+            '-I': bracket_dirs,
+            '-isystem': bracket_dirs,
+            '-idirafter': after_dirs,
+            '-include': forced,
+            '-imacros': forced,
+        }
+        next_list = None
+        for arg in self._args:
+            if next_list is not None:
+                next_list.append(arg)
+                next_list = None
+            elif arg in lists:
+                next_list = lists[arg]
+            elif arg.startswith('-I'):
+                bracket_dirs.append(arg[2:])
+        return quote_dirs, bracket_dirs, after_dirs, forced
+
+    def pump_files(self):
+        if self._srcfile is None:
+            self.can_handle_command()
+        quote_dirs, bracket_dirs, after_dirs, forced = self._include_search_path()
+        system_dirs = []
+        if '-nostdinc' not in self._args:
+            system_dirs = self._system_include_dirs()
+        scanner = IncludeScanner(quote_dirs, bracket_dirs, system_dirs, after_dirs)
+        headers = scanner.scan(self._srcfile, forced)
+        return [os.path.abspath(self._srcfile)] + headers
+
+    def dependency_file(self):
+        if not any(arg in self._args for arg in ('-MD', '-MMD')):
+            return None
+        for n, arg in enumerate(self._args[:-1]):
+            if arg == '-MF':
+                return self._args[n + 1]
+        return '.'.join(self.object_file().split('.')[:-1] + ['d'])
+
+    def direct_mode_depfile(self):
+        # -MMD leaves out the system headers
+        if '-MD' not in self._args or '-MMD' in self._args:
+            return None
+        return self.dependency_file()
+
+    def write_dependency_file(self, headers):
+        depfile = self.dependency_file()
+        if depfile is None:
+            return
+        targets = []
+        for n, arg in enumerate(self._args[:-1]):
+            if arg == '-MT':
+                targets.append(self._args[n + 1])
+            elif arg == '-MQ':
+                targets.append(_escape_make(self._args[n + 1]).replace('$', '$$'))
+        if not targets:
+            targets.append(_escape_make(self.object_file()))
+        deps = [_escape_make(p) for p in [self._srcfile] + headers]
+        lines = ['{}: {}'.format(' '.join(targets), ' \\\n '.join(deps))]
+        if '-MP' in self._args:
+            lines.extend('\n{}:'.format(dep) for dep in deps[1:])
+        with open(depfile, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def pump_compiler_cmd(self, root):
+        def reroot(path):
+            if os.path.isabs(path):
+                return os.path.join(root, os.path.relpath(path, '/'))
+            return path
+
+        cmd = [self._compiler]
+        skip_next, reroot_next = False, False
+        for arg in self._args:
+            if skip_next:
+                skip_next = False
+            elif reroot_next:
+                cmd.append(reroot(arg))
+                reroot_next = False
+            elif arg in ('-MD', '-MMD', '-MP', '-M', '-MM'):
+                # the client writes the dependency file itself
+                continue
+            elif arg in ('-MF', '-MT', '-MQ'):
+                skip_next = True
+            elif arg in ('-I', '-iquote', '-isystem', '-idirafter',
+                         '-include', '-imacros'):
+                cmd.append(arg)
+                reroot_next = True
+            elif arg.startswith('-I'):
+                cmd.append('-I' + reroot(arg[2:]))
+            elif arg == self._srcfile:
+                cmd.append(reroot(arg))
+            else:
+                cmd.append(arg)
+        # keep the job root out of debug info and __FILE__
+        cmd.append('-ffile-prefix-map={}='.format(root))
+        return cmd
+
     def rewrite_local_args(self):
         new_args = []
         for arg in self._args:
@@ -0,0 +1,89 @@
+import os
+import os.path
+import re
+
+from .errors import UnsupportedCompilationMode
+
+# Conditional compilation is ignored, so the set of found headers is
+# a superset of the files actually used. That's fine as long as every
+# header the compiler might open is shipped.
+INCLUDE_RX = re.compile(
+    rb'^[ \t]*#[ \t]*(include_next|include|import)[ \t]*([<"])([^>"\n]+)[>"]',
+    re.M)
+HAS_INCLUDE_RX = re.compile(
+    rb'__has_include(_next)?[ \t]*\([ \t]*([<"])([^>"\n]+)[>"]')
+COMPUTED_INCLUDE_RX = re.compile(
+    rb'^[ \t]*#[ \t]*(include_next|include|import)\b[ \t]*[^<" \t\n]',
+    re.M)
+
+
+class IncludeScanner:
+    def __init__(self, quote_dirs, bracket_dirs, system_dirs, after_dirs=()):
+        self._quote_dirs = quote_dirs
+        self._bracket_dirs = bracket_dirs
+        self._system_dirs = [os.path.normpath(d) for d in system_dirs]
+        self._after_dirs = after_dirs
+        self._resolved = {}
+
+    def _is_system_header(self, path):
+        return any(path.startswith(d + os.sep) for d in self._system_dirs)
+
+    def _candidates(self, name, quoted, curdir):
+        if os.path.isabs(name):
+            return [name]
+        dirs = []
+        if quoted:
+            dirs.append(curdir)
+            dirs.extend(self._quote_dirs)
+        dirs.extend(self._bracket_dirs)
+        dirs.extend(self._system_dirs)
+        dirs.extend(self._after_dirs)
+        return [os.path.join(d, name) for d in dirs]
+
+    def _resolve(self, name, quoted, next_, curdir):
+        key = (name, quoted, next_, curdir)
+        if key in self._resolved:
+            return self._resolved[key]
+        found = []
+        for candidate in self._candidates(name, quoted, curdir):
+            if os.path.isfile(candidate):
+                found.append(os.path.abspath(candidate))
+                # #include_next picks one of the subsequent matches,
+                # ship all of them
+                if not next_:
+                    break
+        self._resolved[key] = found
+        return found
+
+    def _directives(self, path):
+        with open(path, 'rb') as f:
+            text = f.read()
+        if COMPUTED_INCLUDE_RX.search(text):
+            raise UnsupportedCompilationMode('computed include in %s' % path)
+        for rx in (INCLUDE_RX, HAS_INCLUDE_RX):
+            for m in rx.finditer(text):
+                next_ = m.group(1) in (b'include_next', b'_next')
+                quoted = m.group(2) == b'"'
+                yield m.group(3).decode('utf-8'), quoted, next_
+
+    def scan(self, srcfile, forced_includes=()):
+        """Find the (non-system) headers srcfile depends on"""
+        srcfile = os.path.abspath(srcfile)
+        headers = []
+        seen = set([srcfile])
+        todo = [srcfile]
+        for path in forced_includes:
+            todo.extend(self._resolve(path, True, False, os.getcwd()))
+        while todo:
+            path = todo.pop()
+            if path != srcfile:
+                if path in seen:
+                    continue
+                seen.add(path)
+                headers.append(path)
+            curdir = os.path.dirname(path)
+            for name, quoted, next_ in self._directives(path):
+                for header in self._resolve(name, quoted, next_, curdir):
+                    if header not in seen and not self._is_system_header(header):
+                        todo.append(header)
+        return headers
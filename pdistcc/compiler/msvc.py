@@ -1,4 +1,5 @@
 
+import os.path
 import sys
 from .wrapper import CompilerWrapper
 from .errors import UnsupportedCompilationMode as UCM
@@ -13,7 +14,7 @@ class MSVCWrapper(CompilerWrapper):
     # A real msvc needs tons of environment variables to work properly.
 
     def __init__(self, args, settings={}):
-        super().__init__(args)
+        super().__init__(args, settings)
         self._srcfile = None
         self._objfile = None
         self._preprocessed_file = None
@@ -37,6 +38,10 @@ class MSVCWrapper(CompilerWrapper):
         if value:
             self._use_clang = True
 
+    def remote_compiler(self):
+        compiler = self._clang_path if self._use_clang else self._compiler
+        return os.path.basename(compiler), None
+
     @property
     def distcc_compat(self):
         return self._distcc_compat
@@ -83,7 +88,7 @@ class MSVCWrapper(CompilerWrapper):
     def _is_pdb_related(self, arg):
         return arg in ('/FS') or arg.startswith('/Fd')
 
-    def preprocessor_cmd(self):
+    def preprocessor_cmd(self, to_stdout=False):
         cmd = [self._compiler]
         for arg in self._args:
             skip_arg = False
@@ -98,7 +103,10 @@ class MSVCWrapper(CompilerWrapper):
             elif arg.startswith('/Fo'):
                 skip_arg = True
                 self._objfile = arg[3:]
-                cmd.extend(['/P', '/Fi{}'.format(self.preprocessed_file())])
+                if to_stdout:
+                    cmd.append('/E')
+                else:
+                    cmd.extend(['/P', '/Fi{}'.format(self.preprocessed_file())])
             if not skip_arg:
                 cmd.append(arg)
         return cmd
@@ -1,37 +1,339 @@
-
+import io
+import logging
+import os
+import shutil
 import subprocess
-from ..net import dcc_compile
-from .errors import PreprocessorFailed
+import sys
+import time
+
+from .. import trace
+from ..manifest import (
+    direct_key,
+    manifest_cache,
+)
+from ..net import (
+    dcc_compile,
+    dcc_hedged_compile,
+    dcc_pump_compile,
+    dcc_stream_compile,
+)
+from ..objcache import (
+    cache_key,
+    compiler_identity,
+    doti_hash,
+    object_cache,
+)
+from .errors import (
+    PreprocessorFailed,
+    UnsupportedCompilationMode,
+)
 
 LANG_C = 'c'
 LANG_CXX = 'c++'
 
+logger = logging.getLogger(__name__)
+
 
 class CompilerWrapper(object):
-    def __init__(self, args):
+    def __init__(self, args, settings={}):
         self._args = args[1:]
         self._compiler = args[0]
+        self._settings = settings
+        self._preprocessed = False
+        # manifest of the compilation in the direct mode of the cache
+        self._manifests = None
+        self._direct_key = None
+        # seconds the server took to reply, size of the preprocessed
+        # source (0 if unknown) and the server which has replied to a
+        # hedged request (None if not hedged) of the last remote compilation
+        self.remote_duration = None
+        self.remote_size = 0
+        self.remote_host = None
 
     def rewrite_local_args(self):
         """Rewrite host-depent arguments like -march=native"""
         pass
 
-    def wrap_compiler(self, host, port):
-        if self.called_for_preprocessing():
-            args = [self._compiler]
-            args.extend(self._args)
-            subprocess.check_call(args)
+    def source_file(self):
+        return None
+
+    def remote_compiler(self):
+        """Name of the compiler the server runs and its target triplet
+        (None if any target goes)"""
+        return os.path.basename(self._compiler), None
+
+    def can_read_stdin(self):
+        """Whether the compiler can read the preprocessed source from stdin"""
+        return False
+
+    def pump_files(self):
+        """Source and headers to ship to the server in the pump mode"""
+        raise UnsupportedCompilationMode('pump mode is not supported')
+
+    def pump_args(self):
+        return [self._compiler] + self._args
+
+    def pump_compiler_cmd(self, root):
+        raise UnsupportedCompilationMode('pump mode is not supported')
+
+    def write_dependency_file(self, headers):
+        pass
+
+    def direct_mode_depfile(self):
+        """Dependency file the preprocessor writes with every header of
+        the source, None if the direct mode of the cache is not possible"""
+        return None
+
+    def _preprocess(self):
+        if self._preprocessed:
             return
-        self.can_handle_command()
-        self.rewrite_local_args()
-        preprocessor_cmd = self.preprocessor_cmd()
         try:
-            subprocess.check_output(preprocessor_cmd)
+            with trace.span('preprocess'):
+                subprocess.check_output(self.preprocessor_cmd())
         except subprocess.CalledProcessError:
             raise PreprocessorFailed()
+        self._preprocessed = True
+
+    def _cache_key(self):
+        compiler_id = compiler_identity(self._compiler)
+        if compiler_id is None:
+            return None
+        hsh = doti_hash()
+        with open(self.preprocessed_file(), 'rb') as f:
+            for chunk in iter(lambda: f.read(256*1024), b''):
+                hsh.update(chunk)
+        return cache_key(hsh.digest(), self.compiler_cmd(), compiler_id)
+
+    def _get_from_cache(self, objcache, key):
+        with objcache.lookup(key) as entry:
+            if entry is None:
+                return False
+            with open(self.object_file(), 'wb') as f:
+                shutil.copyfileobj(entry.object, f)
+            sys.stdout.buffer.write(entry.stdout)
+            sys.stderr.buffer.write(entry.stderr)
+            return True
+
+    def _direct_lookup(self):
+        """Get the result from the cache without running the preprocessor"""
+        depfile = self.direct_mode_depfile()
+        manifests = manifest_cache(self._settings)
+        if depfile is None or manifests is None:
+            return False
+        compiler_id = compiler_identity(self._compiler)
+        if compiler_id is None:
+            return False
+        key = direct_key(compiler_id, [self._compiler] + self._args,
+                         self.source_file())
+        if key is None:
+            return False
+        self._manifests, self._direct_key = manifests, key
+        hit = manifests.lookup(key)
+        if hit is None:
+            return False
+        objkey, depdata = hit
+        if not self._get_from_cache(object_cache(self._settings), objkey):
+            return False
+        with open(depfile, 'wb') as f:
+            f.write(depdata)
+        return True
+
+    def _record_manifest(self, objkey):
+        if self._direct_key is None:
+            return
+        with trace.span('record_manifest'):
+            try:
+                self._manifests.record(self._direct_key,
+                                       self.direct_mode_depfile(), objkey)
+            except OSError as e:
+                logger.debug('not recording the manifest: %s', e)
+
+    def _timeouts(self):
+        return {
+            'connect_timeout': self._settings.get('connect_timeout'),
+            'io_timeout': self._settings.get('io_timeout'),
+        }
+
+    def expected_duration(self, doti_size, recorded=None):
+        """Seconds a remote compilation of a doti_size bytes preprocessed
+        source should take at most, None if hedging is off. Slower ones
+        are sent to another server as well.
+
+        recorded is the duration past which the job is a straggler on the
+        server (see history.CostModel.straggler), if known.
+        """
+        delay = self._settings.get('hedge_delay')
+        if delay is None:
+            return None
+        if recorded is not None:
+            return max(delay, recorded)
+        per_mb = self._settings.get('hedge_delay_per_mb') or 0
+        return delay + per_mb*doti_size/(1024*1024)
+
+    def _remote_done(self, start, size=0, host=None):
+        self.remote_duration = time.monotonic() - start
+        self.remote_size = size
+        self.remote_host = host
+
+    def _dcc_compile(self, host, port, compression, backup=None,
+                     straggler=None, **streams):
+        doti = self.preprocessed_file()
+        try:
+            size = os.path.getsize(doti)
+        except OSError:
+            # dcc_compile reports it
+            size = 0
+        delay = None
+        if backup is not None:
+            recorded = straggler(size) if straggler is not None else None
+            delay = self.expected_duration(size, recorded)
+        start = time.monotonic()
+        winner = None
+        if delay is None:
+            ret = dcc_compile(doti,
+                              self.compiler_cmd(),
+                              host=host,
+                              port=port,
+                              ofile=self.object_file(),
+                              compression=compression,
+                              **streams,
+                              **self._timeouts())
+        else:
+            # timed from the request of the server which has won
+            ret, winner, start = dcc_hedged_compile(doti,
+                                                    self.compiler_cmd(),
+                                                    host,
+                                                    port,
+                                                    backup,
+                                                    delay,
+                                                    ofile=self.object_file(),
+                                                    compression=compression,
+                                                    **streams,
+                                                    **self._timeouts())
+        self._remote_done(start, size, winner)
+        return ret
+
+    def _compile_and_cache(self, objcache, key, host, port, compression,
+                           backup=None, straggler=None):
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        try:
+            ret = self._dcc_compile(host, port, compression, backup,
+                                    straggler, stdout=stdout, stderr=stderr)
+        finally:
+            sys.stdout.buffer.write(stdout.getvalue())
+            sys.stderr.buffer.write(stderr.getvalue())
+        if ret != 0:
+            return ret
+        with open(self.object_file(), 'rb') as doto:
+            doto_len = os.fstat(doto.fileno()).st_size
+            objcache.store(key, ret, stdout.getvalue(), stderr.getvalue(),
+                           doto, doto_len)
+        return ret
+
+    def _pump_compile(self, host, port, compression):
+        """Exit status of the compiler, None if pump mode is not possible"""
+        try:
+            with trace.span('scan_includes'):
+                files = self.pump_files()
+        except UnsupportedCompilationMode as e:
+            logger.debug('pump mode is not possible: %s', e.msg)
+            return None
+        start = time.monotonic()
+        ret = dcc_pump_compile(files,
+                               self.pump_args(),
+                               os.getcwd(),
+                               host=host,
+                               port=port,
+                               ofile=self.object_file(),
+                               compression=compression,
+                               **self._timeouts())
+        self._remote_done(start)
+        if ret == 0:
+            self.write_dependency_file(files[1:])
+        return ret
+
+    def _stream_compile(self, host, port, compression):
+        preprocessor_cmd = self.preprocessor_cmd(to_stdout=True)
+        preprocessor = subprocess.Popen(preprocessor_cmd, stdout=subprocess.PIPE)
+
+        def wait_preprocessor():
+            if preprocessor.wait() != 0:
+                raise PreprocessorFailed()
+
+        # includes preprocessing, which runs concurrently
+        start = time.monotonic()
+        try:
+            ret = dcc_stream_compile(preprocessor.stdout,
+                                     self.compiler_cmd(),
+                                     host=host,
+                                     port=port,
+                                     ofile=self.object_file(),
+                                     compression=compression,
+                                     wait_source=wait_preprocessor,
+                                     **self._timeouts())
+        finally:
+            preprocessor.stdout.close()
+            preprocessor.wait()
+        self._remote_done(start)
+        return ret
+
+    def wrap_compiler(self, host, port, compression=None, pump=False,
+                      stream=False):
+        if self.prepare():
+            return self.compile_remote(host, port, compression, pump, stream)
+        return 0
+
+    def prepare(self):
+        """Do the local part of the job, False if nothing is left to compile"""
+        if self.called_for_preprocessing():
+            args = [self._compiler]
+            args.extend(self._args)
+            with trace.span('local', reason='preprocessing'):
+                subprocess.check_call(args)
+            return False
+        with trace.span('parse_args'):
+            self.can_handle_command()
+        trace.tag(tu=self.source_file())
+        with trace.span('rewrite_local_args'):
+            self.rewrite_local_args()
+        with trace.span('direct_lookup'):
+            if self._direct_lookup():
+                return False
+        return True
+
+    def compile_remote(self, host, port, compression=None, pump=False,
+                       stream=False, backup=None, straggler=None):
+        """Compile on the given server, can be retried with another one.
 
-        dcc_compile(self.preprocessed_file(),
-                    self.compiler_cmd(),
-                    host=host,
-                    port=port,
-                    ofile=self.object_file())
+        backup() leases an idle server to send a duplicate request to if
+        the compilation takes longer than expected (see expected_duration),
+        the pump and streaming modes are never duplicated. straggler(size)
+        is the recorded duration past which a job of size bytes is late
+        on the server, None if unknown.
+        Returns the exit status of the compiler.
+        """
+        if pump:
+            ret = self._pump_compile(host, port, compression)
+            if ret is not None:
+                return ret
+        objcache = object_cache(self._settings)
+        if stream and objcache is None:
+            # the object cache needs the whole preprocessed file to
+            # compute the key before contacting the server
+            return self._stream_compile(host, port, compression)
+        self._preprocess()
+        key = None
+        if objcache is not None:
+            with trace.span('cache_lookup'):
+                key = self._cache_key()
+                if key is not None and self._get_from_cache(objcache, key):
+                    self._record_manifest(key)
+                    return 0
+        if key is None:
+            return self._dcc_compile(host, port, compression, backup,
+                                     straggler)
+        ret = self._compile_and_cache(objcache, key, host, port, compression,
+                                      backup, straggler)
+        if ret == 0:
+            self._record_manifest(key)
+        return ret
@@ -0,0 +1,149 @@
+import zlib
+
+try:
+    import lzo
+except ImportError:
+    lzo = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_LZO = 'lzo'
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+
+# identifiers sent in the COMP token. distcc does not know about COMP
+# and always uses LZO with protocol version 2, so LZO is the default.
+CODEC_IDS = {
+    CODEC_LZO: 1,
+    CODEC_ZLIB: 2,
+    CODEC_ZSTD: 3,
+}
+DEFAULT_CODEC = CODEC_LZO
+
+LZO_MAX_RATIO = 256
+
+
+class CompressionError(Exception):
+    pass
+
+
+class UnsupportedCodec(CompressionError):
+    pass
+
+
+class _LzoCompressor:
+    # LZO1X-1 has no streaming interface, distcc compresses the whole
+    # payload as a single block
+    def __init__(self):
+        self._chunks = []
+
+    def compress(self, data):
+        self._chunks.append(bytes(data))
+        return b''
+
+    def flush(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return lzo.compress(data, 1, False)
+
+
+class _LzoDecompressor:
+    def __init__(self):
+        self._chunks = []
+
+    def decompress(self, data):
+        self._chunks.append(bytes(data))
+        return b''
+
+    def flush(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        # raw LZO blocks don't record the uncompressed size
+        buflen = max(4*len(data), 64*1024)
+        while True:
+            try:
+                return lzo.decompress(data, False, buflen)
+            except lzo.error:
+                if buflen > LZO_MAX_RATIO*len(data):
+                    raise CompressionError('corrupted LZO data')
+                buflen *= 4
+
+
+class _ZstdCompressor:
+    def __init__(self):
+        self._cobj = zstandard.ZstdCompressor(level=1).compressobj()
+
+    def compress(self, data):
+        return self._cobj.compress(data)
+
+    def flush(self):
+        return self._cobj.flush()
+
+
+class _ZstdDecompressor:
+    def __init__(self):
+        self._dobj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        return self._dobj.decompress(data)
+
+    def flush(self):
+        return b''
+
+
+class Codec:
+    def __init__(self, name, compressor, decompressor):
+        self.name = name
+        self.codec_id = CODEC_IDS[name]
+        self._compressor = compressor
+        self._decompressor = decompressor
+
+    def compressobj(self):
+        return self._compressor()
+
+    def decompressobj(self):
+        return self._decompressor()
+
+
+def _codecs():
+    codecs = {
+        CODEC_ZLIB: Codec(CODEC_ZLIB,
+                          lambda: zlib.compressobj(1),
+                          zlib.decompressobj),
+    }
+    if lzo is not None:
+        codecs[CODEC_LZO] = Codec(CODEC_LZO, _LzoCompressor, _LzoDecompressor)
+    if zstandard is not None:
+        codecs[CODEC_ZSTD] = Codec(CODEC_ZSTD, _ZstdCompressor, _ZstdDecompressor)
+    return codecs
+
+
+CODECS = _codecs()
+
+
+def available_codecs():
+    return list(CODECS.keys())
+
+
+def get_codec(name):
+    if name not in CODECS:
+        raise UnsupportedCodec('compression {} is not available'.format(name))
+    return CODECS[name]
+
+
+def pump_codec(name=None):
+    # file payloads are always compressed in the pump mode
+    if name not in CODECS:
+        name = DEFAULT_CODEC if DEFAULT_CODEC in CODECS else CODEC_ZLIB
+    return get_codec(name)
+
+
+def get_codec_by_id(codec_id):
+    for name, cid in CODEC_IDS.items():
+        if cid == codec_id:
+            return get_codec(name)
+    raise UnsupportedCodec('unknown compression id {}'.format(codec_id))
+
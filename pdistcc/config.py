@@ -1,12 +1,20 @@
 
 import copy
-import json
 import logging
+import marshal
 import os
 import re
 
 
 DISTCCD_PORT = 3632
+# job slots of hosts specified without /weight, same as distcc
+DEFAULT_HOST_SLOTS = 4
+DEFAULT_LOCALHOST_SLOTS = 2
+# parsed client.json and DISTCC_HOSTS, python starts faster without json
+SETTINGS_CACHE = '~/.cache/pdistcc/client-settings'
+SETTINGS_CACHE_VERSION = 5
+
+_parsed_hosts = {}
 
 
 def _find_config(name):
@@ -24,6 +32,19 @@ def _server_settings():
     return {
         'listen': '127.0.0.1:{}'.format(DISTCCD_PORT),
         'loglevel': 'WARN',
+        # number of concurrently running compilers, defaults to CPU count
+        'jobs': None,
+        # requests waiting for a compile slot before new ones are
+        # rejected, defaults to the number of compile slots
+        'max_queue': None,
+        # reject requests when the 1 minute load average or the CPU
+        # pressure (% of time tasks waited for CPU, Linux only) is higher
+        'max_load': None,
+        'max_cpu_pressure': None,
+        # jobs in flight on a single multiplexed connection
+        'max_connection_jobs': None,
+        # host:port to serve Prometheus metrics at (/metrics), off if None
+        'metrics_listen': None,
     }
 
 
@@ -31,6 +52,21 @@ def _client_settings():
     return {
         'distcc_hosts': ['127.0.0.1:{}/10'.format(DISTCCD_PORT)],
         'loglevel': 'WARN',
+        # seconds to wait for a server to accept the connection and to
+        # reply once the request is sent
+        'connect_timeout': 4,
+        'io_timeout': 300,
+        # servers to try (skipping the failed ones) before compiling locally
+        'remote_attempts': 3,
+        # send a duplicate request to an idle server if the reply takes
+        # longer than the recorded jobs of a similar size (see history),
+        # at least hedge_delay seconds; hedge_delay plus hedge_delay_per_mb
+        # per MB of the preprocessed source if unknown; off if None
+        'hedge_delay': None,
+        'hedge_delay_per_mb': 2,
+        # durations of past jobs, used to send heavy ones to the fastest
+        # servers first, off if None
+        'history': '~/.cache/pdistcc/history.sqlite',
     }
 
 
@@ -41,6 +77,8 @@ def _merge_settings(settings, default):
 
 
 def _settings(name, default):
+    # json is not needed when the client settings are cached
+    import json
     conffile = _find_config(name)
     settings = copy.deepcopy(default)
     if conffile is not None:
@@ -73,10 +111,54 @@ def server_settings():
     return settings
 
 
-def client_settings():
+def _settings_cache_key(conffile):
+    key = [SETTINGS_CACHE_VERSION, marshal.version, conffile,
+           os.environ.get('DISTCC_HOSTS')]
+    if conffile is not None:
+        st = os.stat(conffile)
+        key.extend([st.st_mtime_ns, st.st_size])
+    return tuple(key)
+
+
+def _load_settings_cache(path, key):
+    try:
+        with open(path, 'rb') as f:
+            cached_key, settings, hosts = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if cached_key != key:
+        return None
+    return settings, hosts
+
+
+def _store_settings_cache(path, key, settings, hosts):
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            marshal.dump((key, settings, hosts), f)
+        os.replace(tmp_path, path)
+    except (OSError, ValueError):
+        pass
+
+
+def client_settings(cache=SETTINGS_CACHE):
+    cache = os.path.expanduser(cache)
+    key = _settings_cache_key(_find_config('client.json'))
+    cached = _load_settings_cache(cache, key)
+    if cached is not None:
+        settings, hosts = cached
+        _parsed_hosts[tuple(settings['distcc_hosts'])] = hosts
+        return settings
     settings = _settings('client.json', _client_settings())
     if 'DISTCC_HOSTS' in os.environ:
         settings['distcc_hosts'] = os.environ['DISTCC_HOSTS'].split()
+    try:
+        hosts = parse_distcc_hosts(settings['distcc_hosts'])
+    except ValueError:
+        # reported when the hosts are used
+        return settings
+    _store_settings_cache(cache, key, settings, hosts)
     return settings
 
 
@@ -95,14 +177,37 @@ def merge_settings_with_cli(settings, args):
     return merged_settings
 
 
+HOST_COMPRESSION_OPTIONS = ('lzo', 'zlib', 'zstd')
+
+
 def parse_distcc_host(h):
-    rx = re.compile('^([^:/]+):([0-9]+)/([0-9]+)')
+    rx = re.compile('^([^:/,]+)(?::([0-9]+))?(?:/([0-9]+))?((?:,[a-z0-9]+)*)')
     m = rx.match(h)
     if m is None:
         raise ValueError('invalid host spec: %s' % h)
-    host, port, weight = m.groups()
-    return {
+    host, port, weight, options = m.groups()
+    if weight is None:
+        weight = DEFAULT_LOCALHOST_SLOTS if host == 'localhost' \
+            else DEFAULT_HOST_SLOTS
+    spec = {
         'host': host,
-        'port': int(port),
+        'port': int(port) if port is not None else DISTCCD_PORT,
         'weight': int(weight),
     }
+    for opt in options.split(',')[1:]:
+        if opt in HOST_COMPRESSION_OPTIONS:
+            spec['compression'] = opt
+        elif opt == 'pump':
+            # pdistccd only; distcc-pump's ,cpp is ignored, its protocol
+            # is not supported
+            spec['pump'] = True
+        elif opt == 'stream':
+            spec['stream'] = True
+    return spec
+
+
+def parse_distcc_hosts(specs):
+    key = tuple(specs)
+    if key not in _parsed_hosts:
+        _parsed_hosts[key] = [parse_distcc_host(h) for h in specs]
+    return _parsed_hosts[key]
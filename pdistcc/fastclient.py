@@ -0,0 +1,64 @@
+# pdistcc entry point. Python is started for every compiler invocation,
+# so this module imports as little as possible: when the broker is
+# running the job is handed to it without importing the rest of pdistcc.
+
+import array
+import marshal
+import os
+import socket
+import sys
+
+BROKER_SOCKET_ENV = 'PDISTCC_BROKER'
+
+
+def _recv_exactly(s, count):
+    data = b''
+    while len(data) < count:
+        chunk = s.recv(count - len(data))
+        if not chunk:
+            raise ConnectionError('broker has closed the connection')
+        data += chunk
+    return data
+
+
+def send_fds(s, data, fds):
+    """Send data with the file descriptors attached (SCM_RIGHTS)"""
+    s.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                        array.array('i', fds))])
+
+
+def run_job(argv, path, fds=(0, 1, 2)):
+    """Run pdistcc with argv in the broker at path.
+
+    stdin, stdout, and stderr are passed to the broker, so the compiler
+    output goes straight to the caller's terminal (or pipe).
+    Returns the exit status, None if the broker is not running.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except OSError:
+            return None
+        job = marshal.dumps({
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        })
+        # same format as pdistcc.net.dcc_encode
+        header = 'JOBR{:08x}'.format(len(job)).encode('ascii')
+        send_fds(s, header, fds)
+        s.sendall(job)
+        reply = _recv_exactly(s, 12)
+        if reply[:4] != b'STAT':
+            raise ConnectionError('unexpected reply from broker: {!r}'.format(reply))
+        return int(reply[4:], 16)
+
+
+def main():
+    path = os.environ.get(BROKER_SOCKET_ENV)
+    if path and hasattr(socket, 'AF_UNIX'):
+        status = run_job(sys.argv[1:], path)
+        if status is not None:
+            sys.exit(status)
+    from .cli import main
+    sys.exit(main())
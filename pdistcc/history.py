@@ -0,0 +1,221 @@
+# Durations of remote compilations observed by the client, kept in an
+# SQLite database shared by all clients of the user. Used to send heavy
+# translation units to the servers which compile them fastest and to
+# start them first (see CostModel).
+
+import os
+import os.path
+import threading
+
+from .sched import is_localhost
+
+DEFAULT_HISTORY = '~/.cache/pdistcc/history.sqlite'
+# weight of the latest observation in the running averages
+DURATION_ALPHA = 0.3
+HOST_ALPHA = 0.05
+# jobs expected to take this many times longer than an average one are
+# heavy: placed on the fastest servers first
+HEAVY_FACTOR = 2
+# the history is advisory, don't wait for other clients holding the lock
+DB_TIMEOUT = 0.05
+# a job is a straggler once it has taken longer than this percentile of
+# the recorded jobs of a similar size (half to twice as large) on the
+# server, known once there are STRAGGLER_MIN_JOBS of them
+STRAGGLER_PERCENTILE = 95
+STRAGGLER_MIN_JOBS = 10
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS durations (
+    tu TEXT NOT NULL,
+    compiler TEXT NOT NULL,
+    host TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (tu, compiler, host)
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT PRIMARY KEY,
+    -- seconds per byte of the preprocessed source
+    rate REAL,
+    -- seconds per job
+    duration REAL NOT NULL
+);
+'''
+
+
+def host_name(host):
+    return '{}:{}'.format(host['host'], host.get('port'))
+
+
+def _average(old, new, alpha):
+    return new if old is None else old + alpha*(new - old)
+
+
+class History(object):
+    def __init__(self, path):
+        import sqlite3
+        self._error = sqlite3.Error
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # several threads of pdistcc.batch share the connection
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=DB_TIMEOUT,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=OFF')
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def record(self, tu, compiler, host, size, duration):
+        """Account a remote compilation, size of the preprocessed source
+        is 0 if unknown"""
+        try:
+            with self._lock:
+                self._record(tu, compiler, host, size, duration)
+        except self._error:
+            # locked by other clients for too long
+            pass
+
+    def _record(self, tu, compiler, host, size, duration):
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT duration FROM durations '
+                             'WHERE tu = ? AND compiler = ? AND host = ?',
+                             (tu, compiler, host)).fetchone()
+            db.execute('INSERT OR REPLACE INTO durations VALUES (?, ?, ?, ?, ?)',
+                       (tu, compiler, host, size,
+                        _average(row and row[0], duration, DURATION_ALPHA)))
+            row = db.execute('SELECT rate, duration FROM hosts WHERE host = ?',
+                             (host,)).fetchone()
+            rate, avg = row if row is not None else (None, None)
+            if size > 0:
+                rate = _average(rate, duration/size, HOST_ALPHA)
+            db.execute('INSERT OR REPLACE INTO hosts VALUES (?, ?, ?)',
+                       (host, rate, _average(avg, duration, HOST_ALPHA)))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def durations(self, tu, compiler):
+        """{host: (size, duration)} of the translation unit"""
+        try:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT host, size, duration FROM durations '
+                    'WHERE tu = ? AND compiler = ?', (tu, compiler)).fetchall()
+        except self._error:
+            return {}
+        return {host: (size, duration) for host, size, duration in rows}
+
+    def sized_durations(self, host, min_size, max_size):
+        """Durations of the jobs of min_size to max_size bytes on the
+        host, shortest first"""
+        try:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT duration FROM durations '
+                    'WHERE host = ? AND size BETWEEN ? AND ? '
+                    'ORDER BY duration', (host, min_size, max_size)).fetchall()
+        except self._error:
+            return []
+        return [duration for duration, in rows]
+
+    def hosts(self):
+        """{host: (seconds per byte or None, seconds per job)}"""
+        try:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT host, rate, duration FROM hosts').fetchall()
+        except self._error:
+            return {}
+        return {host: (rate, duration) for host, rate, duration in rows}
+
+
+def history(hosts, settings):
+    """History of the jobs to place on the hosts, None if disabled or if
+    there's no choice: less than two servers"""
+    path = settings.get('history', DEFAULT_HISTORY)
+    if path is None or sum(1 for h in hosts if not is_localhost(h)) < 2:
+        return None
+    try:
+        return History(path)
+    except Exception:
+        # unusable database, compile without the history
+        return None
+
+
+class CostModel(object):
+    """Expected compile durations of a translation unit on the hosts"""
+
+    def __init__(self, history):
+        self._history = history
+        self._hosts = None
+
+    def _host_stats(self):
+        if self._hosts is None:
+            self._hosts = self._history.hosts()
+        return self._hosts
+
+    def expected(self, tu, compiler, hosts):
+        """{host name: seconds} for the hosts it can be estimated for"""
+        known = self._history.durations(tu, compiler)
+        if not known:
+            return {}
+        stats = self._host_stats()
+        expected = {}
+        for host in map(host_name, hosts):
+            if host in known:
+                expected[host] = known[host][1]
+                continue
+            rate = stats.get(host, (None, None))[0]
+            if rate is None:
+                continue
+            # scale the duration on a host with a known speed
+            estimates = [duration*rate/stats[other][0]
+                         for other, (size, duration) in known.items()
+                         if stats.get(other, (None, None))[0]]
+            if estimates:
+                expected[host] = min(estimates)
+        return expected
+
+    def average(self):
+        """Seconds an average job takes, None if unknown"""
+        durations = [d for _, d in self._host_stats().values()]
+        return sum(durations)/len(durations) if durations else None
+
+    def duration(self, tu, compiler, hosts):
+        """Seconds the translation unit takes on the fastest of the hosts,
+        the average job duration if unknown"""
+        expected = self.expected(tu, compiler, hosts)
+        if expected:
+            return min(expected.values())
+        return self.average()
+
+    def straggler(self, host, size):
+        """Seconds after which a job of size bytes on the host is slower
+        than STRAGGLER_PERCENTILE of the recorded ones, None if unknown"""
+        if size <= 0:
+            return None
+        durations = self._history.sized_durations(host, size//2, size*2)
+        if len(durations) < STRAGGLER_MIN_JOBS:
+            return None
+        n = -(-len(durations)*STRAGGLER_PERCENTILE//100)
+        return durations[n - 1]
+
+    def placement(self, tu, compiler, hosts):
+        """Hosts ordered by the expected duration, fastest first, if the
+        translation unit is a heavy one, otherwise None"""
+        expected = self.expected(tu, compiler, hosts)
+        average = self.average()
+        if not expected or average is None:
+            return None
+        if min(expected.values()) < HEAVY_FACTOR*average:
+            return None
+        # hosts with no estimate go last
+        worst = max(expected.values())
+        return sorted(hosts, key=lambda h: expected.get(host_name(h), 2*worst))
@@ -1,15 +1,33 @@
 
-import fasteners
 import hashlib
+import logging
 import os
 import os.path
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, only the files backend is available
+    fcntl = None
 
 CACHE_VERSION = 1
+BACKEND_FILES = 'files'
+BACKEND_MMAP = 'mmap'
+# geometry of the memory mapped table, part of its file name
+MMAP_SLOTS = 256
+MMAP_SLOT_SIZE = 4096
+# slots an entry can be placed at (linear probing)
+MMAP_PROBES = 8
+# re-reads of a slot being written before giving up
+MMAP_READ_RETRIES = 100
 
+logger = logging.getLogger(__name__)
 
-def hash_inode(path, kind):
+
+def _inode_digest(st, kind):
     hsh = hashlib.new('md5')
-    st = os.stat(path)
     key = (
         CACHE_VERSION.to_bytes(2, 'little'),
         kind.to_bytes(2, 'little'),
@@ -19,13 +37,31 @@ def hash_inode(path, kind):
         (st.st_mtime_ns//1000).to_bytes(8, 'little')
     )
     hsh.update(b''.join(k for k in key))
-    return hsh.hexdigest()
+    return hsh
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning('can not remove %s: %s', path, e)
+
+
+def hash_inode(path, kind):
+    return _inode_digest(os.stat(path), kind).hexdigest()
 
 
 class InodeCache:
-    def __init__(self, cachedir, rwlock=None):
+    """A file per entry, named after the hash of the inode.
+
+    No locks: put writes a temporary file and renames it over the entry,
+    so readers see either the old or the new value, never a partial one.
+    """
+
+    def __init__(self, cachedir):
         self._basedir = cachedir
-        self._rwlock = rwlock or fasteners.InterProcessReaderWriterLock
         os.makedirs(cachedir, exist_ok=True)
 
     def _path_by_hash(self, digest):
@@ -34,30 +70,40 @@ class InodeCache:
     def put(self, path, kind, value):
         digest = hash_inode(path, kind)
         entry_path = self._path_by_hash(digest)
-        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
-        lock = self._rwlock(f"{entry_path}.lock")
-        with lock.write_lock():
-            with open(entry_path, 'wb') as f:
+        tmp = '{}.{}.{}'.format(entry_path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'wb') as f:
                 f.write(value)
+        except OSError as e:
+            logger.warning('can not write %s: %s', tmp, e)
+            _remove(tmp)
+            return
+        try:
+            os.replace(tmp, entry_path)
+        except FileNotFoundError:
+            # the temporary file has been cleaned up under our feet
+            return
+        except OSError as e:
+            # Windows can't replace a file open by a reader, the next put
+            # will do
+            logger.debug('can not replace %s: %s', entry_path, e)
+            _remove(tmp)
+            return
+        # left by pdistcc versions which locked the entries
+        _remove(entry_path + '.lock')
 
     def get(self, path, kind):
         digest = hash_inode(path, kind)
-        entry_path = self._path_by_hash(digest)
-        lock = self._rwlock(f"{entry_path}.lock")
         try:
-            with lock.read_lock():
-                with open(entry_path, 'rb') as f:
-                    return f.read()
+            with open(self._path_by_hash(digest), 'rb') as f:
+                return f.read()
         except FileNotFoundError:
             return None
 
     def purge(self, path, kind):
         digest = hash_inode(path, kind)
-        entry_path = self._path_by_hash(digest)
-        lock = self._rwlock(f"{entry_path}.lock")
         try:
-            with lock.write_lock():
-                os.remove(entry_path)
+            os.remove(self._path_by_hash(digest))
         except FileNotFoundError:
             pass
 
@@ -69,3 +115,143 @@ class InodeCache:
 
     def put_str(self, path, kind, value):
         self.put(path, kind, value.encode('utf-8'))
+
+
+# header of a slot: sequence number (odd while the slot is being
+# written), key digest, length of the value
+_SLOT_HEADER = struct.Struct('<I16sI')
+_MAX_VALUE = MMAP_SLOT_SIZE - _SLOT_HEADER.size
+_EMPTY_KEY = bytes(16)
+# values seen by this process by (st_dev, st_ino, st_size, st_mtime_ns, kind)
+_memo = {}
+
+
+class MmapInodeCache:
+    """InodeCache in a single memory mapped file.
+
+    The file is a hash table of MMAP_SLOTS fixed size slots. Writers lock
+    the slot (fcntl byte range lock) and bump its sequence number before
+    and after updating it; readers take no locks, they retry if the
+    sequence number is odd or has changed while they were copying the
+    slot (a seqlock). Values which don't fit into a slot aren't cached.
+    """
+
+    def __init__(self, cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+        name = 'inodes-{}-{}x{}'.format(CACHE_VERSION, MMAP_SLOTS,
+                                        MMAP_SLOT_SIZE)
+        self._path = os.path.join(cachedir, name)
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        if self._map is not None:
+            return
+        import mmap
+        size = MMAP_SLOTS*MMAP_SLOT_SIZE
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                # zero filled: all slots are empty
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._map = self._fd = None
+
+    def _lookup(self, path, kind):
+        st = os.stat(path)
+        memo_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, kind)
+        digest = _inode_digest(st, kind).digest()
+        return memo_key, digest
+
+    def _slots(self, digest):
+        first = int.from_bytes(digest[:4], 'little') % MMAP_SLOTS
+        return [((first + n) % MMAP_SLOTS)*MMAP_SLOT_SIZE
+                for n in range(MMAP_PROBES)]
+
+    def _read_slot(self, offset):
+        """(key, value) of the slot, None if it's being written"""
+        m = self._map
+        for _ in range(MMAP_READ_RETRIES):
+            seq, key, length = _SLOT_HEADER.unpack_from(m, offset)
+            if seq & 1:
+                continue
+            start = offset + _SLOT_HEADER.size
+            value = m[start:start + min(length, _MAX_VALUE)]
+            if _SLOT_HEADER.unpack_from(m, offset)[0] == seq:
+                return key, value
+        return None
+
+    def _write_slot(self, offset, key, value):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, MMAP_SLOT_SIZE, offset)
+        try:
+            m = self._map
+            seq = struct.unpack_from('<I', m, offset)[0]
+            # odd even if a writer has crashed in the middle
+            struct.pack_into('<I', m, offset, (seq | 1) & 0xffffffff)
+            start = offset + _SLOT_HEADER.size
+            m[start:start + len(value)] = value
+            struct.pack_into('<16sI', m, offset + 4, key, len(value))
+            struct.pack_into('<I', m, offset, ((seq | 1) + 1) & 0xffffffff)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, MMAP_SLOT_SIZE, offset)
+
+    def get(self, path, kind):
+        memo_key, digest = self._lookup(path, kind)
+        if memo_key in _memo:
+            return _memo[memo_key]
+        self._open()
+        for offset in self._slots(digest):
+            slot = self._read_slot(offset)
+            if slot is not None and slot[0] == digest:
+                _memo[memo_key] = slot[1]
+                return slot[1]
+        return None
+
+    def put(self, path, kind, value):
+        memo_key, digest = self._lookup(path, kind)
+        _memo[memo_key] = value
+        if len(value) > _MAX_VALUE:
+            return
+        self._open()
+        slots = self._slots(digest)
+        target = slots[0]
+        for offset in slots:
+            slot = self._read_slot(offset)
+            if slot is not None and slot[0] in (digest, _EMPTY_KEY):
+                target = offset
+                break
+        # the first slot is evicted if all of them are taken
+        self._write_slot(target, digest, value)
+
+    def purge(self, path, kind):
+        memo_key, digest = self._lookup(path, kind)
+        _memo.pop(memo_key, None)
+        self._open()
+        for offset in self._slots(digest):
+            slot = self._read_slot(offset)
+            if slot is not None and slot[0] == digest:
+                self._write_slot(offset, _EMPTY_KEY, b'')
+
+    def get_str(self, path, kind):
+        val = self.get(path, kind)
+        if val is not None:
+            val = val.decode('utf-8')
+        return val
+
+    def put_str(self, path, kind, value):
+        self.put(path, kind, value.encode('utf-8'))
+
+
+def inode_cache(cachedir, backend=BACKEND_FILES):
+    if backend == BACKEND_MMAP and fcntl is not None:
+        return MmapInodeCache(cachedir)
+    return InodeCache(cachedir)
@@ -7,7 +7,14 @@ import shutil
 import subprocess
 import time
 
-from .inodecache import InodeCache
+from . import inodecache
+from .inodecache import (
+    BACKEND_FILES,
+    BACKEND_MMAP,
+    InodeCache,
+    hash_inode,
+    inode_cache,
+)
 
 
 class Stat:
@@ -28,7 +35,7 @@ class Stat:
     def merge(self, other):
         new_count = self.count + other.count
         self._avg  = (self.count*self.avg + other.count*other.avg)/new_count
-        self._count = new_count
+        self._n = new_count
         self._min = min(self.min, other.min)
         self._max = max(self.max, other.max)
 
@@ -49,70 +56,138 @@ class Stat:
         return self._n
 
 
-def bench(repetitions):
-    cdir = os.path.expanduser('~/.cache/pdistcc/icache')
-    ic = InodeCache(cdir)
-    gcc = '/usr/bin/gcc'
-    value = b'test'
-    ic.put(gcc, 1, value)
+class LockedInodeCache(InodeCache):
+    """InodeCache as it was before: every access takes an inter-process
+    reader/writer lock of the entry (leaving a .lock file behind)"""
+
+    def __init__(self, cachedir):
+        super().__init__(cachedir)
+        import fasteners
+        self._rwlock = fasteners.InterProcessReaderWriterLock
+
+    def put(self, path, kind, value):
+        entry_path = self._path_by_hash(hash_inode(path, kind))
+        with self._rwlock(f"{entry_path}.lock").write_lock():
+            with open(entry_path, 'wb') as f:
+                f.write(value)
+
+    def get(self, path, kind):
+        entry_path = self._path_by_hash(hash_inode(path, kind))
+        try:
+            with self._rwlock(f"{entry_path}.lock").read_lock():
+                with open(entry_path, 'rb') as f:
+                    return f.read()
+        except FileNotFoundError:
+            return None
+
+    def purge(self, path, kind):
+        entry_path = self._path_by_hash(hash_inode(path, kind))
+        try:
+            with self._rwlock(f"{entry_path}.lock").write_lock():
+                os.remove(entry_path)
+        except FileNotFoundError:
+            pass
+
+
+BACKEND_LOCKED = 'locked'
+BACKENDS = (BACKEND_LOCKED, BACKEND_FILES, BACKEND_MMAP)
+CACHE_DIR = '~/.cache/pdistcc/icache'
+GCC = '/usr/bin/gcc'
+VALUE = b'test'
+
+
+def _cache(backend):
+    if backend == BACKEND_LOCKED:
+        # keep the .lock files out of the real cache
+        return LockedInodeCache(os.path.expanduser(CACHE_DIR + '-locked'))
+    return inode_cache(os.path.expanduser(CACHE_DIR), backend)
+
+
+def bench(repetitions, backend=BACKEND_FILES, write=False):
+    ic = _cache(backend)
     st = Stat()
     start, end = None, None
     for _ in range(repetitions):
+        # a client process does a single lookup, don't measure the memo
+        inodecache._memo.clear()
         start = time.perf_counter_ns()
-        ret = ic.get(gcc, 1)
+        if write:
+            ic.put(GCC, 1, VALUE)
+        else:
+            ret = ic.get(GCC, 1)
         end = time.perf_counter_ns()
-        assert ret == value
+        if not write:
+            assert ret == VALUE
         elapsed = (end - start)//1000
         st.update(elapsed)
     return st
 
 
 def bench_nocache(repetitions):
-    gcc = '/usr/bin/gcc'
     st = Stat()
     start, end = None, None
     for _ in range(repetitions):
         start = time.perf_counter_ns()
-        out = subprocess.check_output([gcc, '-dumpmachine']).strip()
+        out = subprocess.check_output([GCC, '-dumpmachine']).strip()
         end = time.perf_counter_ns()
         elapsed = (end - start)//1000
         st.update(elapsed)
     return st
 
 
-def bench_multiprocess(concurrency, repetitions):
-    def reap(ares):
-        st = ares[0].get()
-        for handle in ares[1:]:
-            st.merge(handle.get())
-        return st
+def _reap(ares):
+    st = ares[0].get()
+    for handle in ares[1:]:
+        st.merge(handle.get())
+    return st
 
-    with multiprocessing.Pool(processes=concurrency) as pool:
-        ares = [pool.apply_async(bench, (repetitions,))
-                for _ in range(concurrency)]
-        st_cache = reap(ares)
-        ares = [pool.apply_async(bench_nocache, (repetitions,))
-                for _ in range(concurrency)]
-        st_nocache = reap(ares)
 
-    def report(st):
-        print("average\tmax\tmin")
-        print("{0:0.1f}\t{1:0.1f}\t{2:0.1f}".format(st.avg, st.max, st.min))
+def _run(pool, jobs):
+    """Run (function, args) jobs at once, returns their stats (merged by
+    the function) and the wall time in seconds"""
+    start = time.perf_counter()
+    ares = {}
+    for fn, args in jobs:
+        ares.setdefault(args, []).append(pool.apply_async(fn, args))
+    stats = {args: _reap(handles) for args, handles in ares.items()}
+    return stats, time.perf_counter() - start
 
-    print('--- cached ---')
-    report(st_cache)
-    print('--- NO CACHE ---')
-    report(st_nocache)
+
+def bench_multiprocess(concurrency, repetitions):
+    def report(name, st, wall):
+        print('{}\t{:0.1f}\t{:0.1f}\t{:0.1f}\t{:0.0f}'.format(
+            name, st.avg, st.max, st.min, st.count/wall))
+
+    print('us\t\taverage\tmax\tmin\tops/s')
+    with multiprocessing.Pool(processes=concurrency) as pool:
+        for backend in BACKENDS:
+            print('--- {} ---'.format(backend))
+            for write, name in ((False, 'read'), (True, 'write')):
+                args = (repetitions, backend, write)
+                stats, wall = _run(pool, [(bench, args)]*concurrency)
+                report(name + '\t', stats[args], wall)
+            # readers contending with writers for the same entry
+            readers = (repetitions, backend, False)
+            writers = (repetitions, backend, True)
+            half = concurrency//2
+            stats, wall = _run(pool, [(bench, readers)]*(concurrency - half)
+                               + [(bench, writers)]*half)
+            report('mixed read', stats[readers], wall)
+            report('mixed write', stats[writers], wall)
+        print('--- NO CACHE ---')
+        args = (repetitions,)
+        stats, wall = _run(pool, [(bench_nocache, args)]*concurrency)
+        report('dumpmachine', stats[args], wall)
 
 
 def main():
-    cdir = os.path.expanduser('~/.cache/pdistcc/icache')
-    ic = InodeCache(cdir)
-    gcc = '/usr/bin/gcc'
-    ic.purge(gcc, 1)
-    assert ic.get(gcc, 1) is None
-    ic.put(gcc, 1, b'test')
-    assert ic.get(gcc, 1) == b'test'
+    for backend in BACKENDS:
+        ic = _cache(backend)
+        ic.purge(GCC, 1)
+        inodecache._memo.clear()
+        assert ic.get(GCC, 1) is None
+        ic.put(GCC, 1, VALUE)
+        assert ic.get(GCC, 1) == VALUE
     bench_multiprocess(20, 500)
 
 
@@ -0,0 +1,268 @@
+# Compilers a server can run. pdistccd builds the inventory on startup
+# and sends it in reply to the INVQ token, the client caches the
+# inventories of the hosts and sends a job only to the servers which
+# have its compiler (for the same target).
+#
+# The inventory is a line per compiler: name, version, target triplet
+# and path separated by tabs. Version and triplet are empty if unknown.
+
+import logging
+import marshal
+import os
+import os.path
+import threading
+import time
+
+from .net import (
+    ProtocolError,
+    ServerBusy,
+    dcc_inventory,
+)
+from .sched import (
+    file_lock,
+    is_localhost,
+)
+
+DEFAULT_INVENTORY_DIR = '~/.cache/pdistcc/inventory'
+# seconds the client trusts a cached inventory of a host
+DEFAULT_INVENTORY_TTL = 600
+SERVER_ICACHE_DIR = '~/.cache/pdistcc/icache'
+# the second field of a triplet with none of these is the vendor
+# (x86_64-pc-linux-gnu, x86_64-w64-mingw32)
+TRIPLET_OS = ('linux', 'none', 'elf', 'eabi', 'mingw', 'cygwin', 'windows',
+              'darwin', 'freebsd', 'netbsd', 'openbsd', 'android', 'gnu')
+
+logger = logging.getLogger(__name__)
+
+# file locks are per process, keep track of the hosts the threads of this
+# process are asking (see sched._leased)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _gcc_paths(dirs):
+    """{name: path} of the GCC compilers in dirs, earlier dirs win"""
+    from .compiler import is_gcc
+    paths = {}
+    for d in dirs:
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(d, name)
+            if name in paths or not is_gcc(name):
+                continue
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                paths[name] = path
+    return paths
+
+
+def _gcc_entry(name, path, ino_cache):
+    import subprocess
+    from .compiler.gcc import (
+        INO_CACHE_TRIPLET,
+        INO_CACHE_VERSION,
+        gcc_resolve_triplet,
+        gcc_version,
+        inode_cached,
+    )
+    try:
+        version = inode_cached(ino_cache, path, INO_CACHE_VERSION, gcc_version)
+        triplet = inode_cached(ino_cache, path, INO_CACHE_TRIPLET,
+                               gcc_resolve_triplet)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning('skipping compiler %s: %s', path, e)
+        return None
+    return {'name': name, 'version': version, 'triplet': triplet,
+            'path': path}
+
+
+def server_inventory(settings, path_dirs=None):
+    """Compilers pdistccd runs for the requests.
+
+    GCC is looked up in `compiler_dir` of the `gcc` settings (the server
+    runs compilers from there whatever path the client has sent), or in
+    PATH. MSVC jobs are compiled with `clang_path` of the `msvc` settings.
+    """
+    # the client needs just the cache, keep its start up fast
+    import shutil
+    from .compiler.gcc import (
+        COMPILER_DIR,
+        INODE_CACHE,
+    )
+    from .inodecache import (
+        BACKEND_FILES,
+        inode_cache,
+    )
+    gcc_cfg = settings.get('gcc', {})
+    if COMPILER_DIR in gcc_cfg:
+        dirs = [gcc_cfg[COMPILER_DIR]]
+    elif path_dirs is not None:
+        dirs = path_dirs
+    else:
+        dirs = os.environ.get('PATH', os.defpath).split(os.pathsep)
+    ino_cache = inode_cache(os.path.expanduser(SERVER_ICACHE_DIR),
+                            gcc_cfg.get(INODE_CACHE, BACKEND_FILES))
+    compilers = []
+    for name, path in sorted(_gcc_paths(dirs).items()):
+        entry = _gcc_entry(name, path, ino_cache)
+        if entry is not None:
+            compilers.append(entry)
+    clang_path = settings.get('msvc', {}).get('clang_path', 'clang-cl')
+    clang_abspath = shutil.which(clang_path)
+    if clang_abspath is not None:
+        compilers.append({'name': os.path.basename(clang_path), 'version': '',
+                          'triplet': '', 'path': clang_abspath})
+    return compilers
+
+
+def encode_inventory(compilers):
+    return ''.join('{name}\t{version}\t{triplet}\t{path}\n'.format(**c)
+                   for c in compilers).encode('utf-8')
+
+
+def decode_inventory(data):
+    compilers = []
+    for line in data.decode('utf-8').splitlines():
+        fields = line.split('\t')
+        if len(fields) != 4:
+            raise ProtocolError('malformed inventory line: {}'.format(line))
+        name, version, triplet, path = fields
+        compilers.append({'name': name, 'version': version,
+                          'triplet': triplet, 'path': path})
+    return compilers
+
+
+def normalize_triplet(triplet):
+    """Target triplet without the vendor, x86_64-pc-linux-gnu,
+    x86_64-redhat-linux and x86_64-linux-gnu are the same target"""
+    fields = triplet.split('-')
+    if len(fields) >= 3 and not fields[1].startswith(TRIPLET_OS):
+        del fields[1]
+    if fields[1:] == ['linux']:
+        fields.append('gnu')
+    return '-'.join(fields)
+
+
+def can_compile(compilers, name, triplet):
+    """Whether any of the compilers is the named one for the same target"""
+    if triplet is not None:
+        triplet = normalize_triplet(triplet)
+    for c in compilers:
+        if c['name'] != name:
+            continue
+        if (triplet is None or not c['triplet']
+                or normalize_triplet(c['triplet']) == triplet):
+            return True
+    return False
+
+
+class InventoryCache:
+    """Inventories of the hosts cached in files shared by all clients.
+
+    An inventory is queried again once it's older than ttl seconds. If a
+    host can't tell (distccd, older pdistccd, the host is down) it's
+    assumed to have every compiler until the next query.
+    """
+
+    def __init__(self, cachedir=DEFAULT_INVENTORY_DIR,
+                 ttl=DEFAULT_INVENTORY_TTL, query=dcc_inventory,
+                 clock=time.time, timeouts={}):
+        self._cachedir = os.path.expanduser(cachedir)
+        self._ttl = ttl
+        self._query = query
+        self._clock = clock
+        self._timeouts = timeouts
+        os.makedirs(self._cachedir, exist_ok=True)
+
+    def _path(self, host):
+        name = '{}_{}'.format(host['host'], host.get('port', 0))
+        return os.path.join(self._cachedir, name)
+
+    def _load(self, host):
+        try:
+            with open(self._path(host), 'rb') as f:
+                return marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def _store(self, host, compilers):
+        path = self._path(host)
+        tmp = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            marshal.dump((self._clock(), compilers), f)
+        os.replace(tmp, path)
+
+    def _fresh(self, cached):
+        return cached is not None and self._clock() - cached[0] < self._ttl
+
+    def get(self, host):
+        """Compilers of the host, None if unknown"""
+        cached = self._load(host)
+        if self._fresh(cached):
+            return cached[1]
+        # a single client asks the host, the others go on with what they
+        # have rather than wait for the reply
+        stale = cached[1] if cached is not None else None
+        path = self._path(host)
+        with _refreshing_lock:
+            if path in _refreshing:
+                return stale
+            _refreshing.add(path)
+        try:
+            lock = file_lock(path + '.lock')
+            if not lock.acquire(blocking=False):
+                return stale
+            try:
+                cached = self._load(host)
+                if self._fresh(cached):
+                    # just refreshed by another client
+                    return cached[1]
+                return self._refresh(host)
+            finally:
+                lock.release()
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(path)
+
+    def _refresh(self, host):
+        try:
+            compilers = decode_inventory(
+                self._query(host['host'], host['port'], **self._timeouts))
+        except ServerBusy:
+            # ask again next time
+            return None
+        except (OSError, ProtocolError) as e:
+            logger.info('%s:%s has no inventory: %s', host['host'],
+                        host['port'], e)
+            compilers = None
+        try:
+            self._store(host, compilers)
+        except OSError:
+            pass
+        return compilers
+
+    def incompatible(self, hosts, name, triplet):
+        """Hosts which lack the compiler"""
+        excluded = []
+        for host in hosts:
+            if is_localhost(host) or host['weight'] == 0:
+                continue
+            compilers = self.get(host)
+            if compilers is not None and not can_compile(compilers, name,
+                                                          triplet):
+                excluded.append(host)
+        return excluded
+
+
+def inventory_cache(settings):
+    ttl = settings.get('inventory_ttl', DEFAULT_INVENTORY_TTL)
+    if ttl is None:
+        return None
+    timeouts = {
+        'connect_timeout': settings.get('connect_timeout'),
+        'io_timeout': settings.get('io_timeout'),
+    }
+    return InventoryCache(settings.get('inventory_dir', DEFAULT_INVENTORY_DIR),
+                          ttl, timeouts=timeouts)
@@ -0,0 +1,98 @@
+import os
+import time
+
+PSI_CPU = '/proc/pressure/cpu'
+SAMPLE_INTERVAL = 1.0
+
+
+def cpu_pressure(path=PSI_CPU):
+    """Share of time (in %) some tasks were stalled on CPU in the last 10 seconds"""
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    for field in fields[1:]:
+                        name, _, value = field.partition('=')
+                        if name == 'avg10':
+                            return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def load_average():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+class LoadMonitor:
+    def __init__(self, slots, settings={}, clock=time.monotonic,
+                 pressure=cpu_pressure, loadavg=load_average):
+        self._slots = slots
+        self._max_queue = settings.get('max_queue') or slots.count
+        self._max_load = settings.get('max_load')
+        self._max_cpu_pressure = settings.get('max_cpu_pressure')
+        self._clock = clock
+        self._pressure_func = pressure
+        self._loadavg_func = loadavg
+        self._connections = 0
+        self._sampled_at = None
+        self._pressure = None
+        self._loadavg = None
+
+    def connection_opened(self):
+        self._connections += 1
+
+    def connection_closed(self):
+        self._connections -= 1
+
+    @property
+    def connections(self):
+        return self._connections
+
+    @property
+    def running(self):
+        return self._slots.running
+
+    @property
+    def queued(self):
+        # connections which won't get a compile slot right away
+        return max(self._connections - self._slots.count, 0)
+
+    def _sample(self):
+        now = self._clock()
+        if self._sampled_at is None or now - self._sampled_at >= SAMPLE_INTERVAL:
+            self._sampled_at = now
+            self._pressure = self._pressure_func()
+            self._loadavg = self._loadavg_func()
+
+    @property
+    def cpu_pressure(self):
+        self._sample()
+        return self._pressure
+
+    @property
+    def load_average(self):
+        self._sample()
+        return self._loadavg
+
+    def busy(self):
+        """Reason to reject a new request, None if the server has capacity"""
+        if self.queued >= self._max_queue:
+            return 'queue is full'
+        if self._max_load is not None:
+            loadavg = self.load_average
+            if loadavg is not None and loadavg > self._max_load:
+                return 'load average {:.2f}'.format(loadavg)
+        if self._max_cpu_pressure is not None:
+            pressure = self.cpu_pressure
+            if pressure is not None and pressure > self._max_cpu_pressure:
+                return 'CPU pressure {:.2f}%'.format(pressure)
+        return None
+
+    def __str__(self):
+        return 'running: {}, queued: {}, load: {}, CPU pressure: {}'.format(
+            self.running, self.queued, self.load_average, self.cpu_pressure)
@@ -0,0 +1,191 @@
+# Direct mode of the object cache (as in ccache): a compilation is looked
+# up by its source file and the headers it has included the last time,
+# the preprocessor does not run on a hit.
+#
+# A manifest is keyed by the compiler, its command line, the working
+# directory and the content of the source file. It holds the headers
+# from the dependency file the preprocessor has written (-MD) with their
+# digests, the object cache key of the result and the dependency file
+# itself. The same source can include different headers (a header has
+# changed a macro), so a manifest keeps a few results, latest first.
+# Manifests are evicted like the object files, in their own directory
+# with its own size limit.
+
+import hashlib
+import marshal
+import os
+import os.path
+import tempfile
+import time
+
+from .objcache import CacheDir
+
+MANIFEST_VERSION = 1
+DEFAULT_MANIFEST_DIR = '~/.cache/pdistcc/manifests'
+DEFAULT_MAX_SIZE = 256*1024*1024
+MAX_RESULTS = 4
+# a header modified as recently as this (nanoseconds) can change again
+# without changing its mtime, it is hashed on every lookup
+TOO_NEW = 2*10**9
+# environment read by the preprocessor
+PREPROCESSOR_ENV = ('CPATH', 'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH',
+                    'OBJC_INCLUDE_PATH')
+# the result depends on more than the content of the files
+TIME_MACROS = (b'__DATE__', b'__TIME__', b'__TIMESTAMP__')
+
+
+def _has_time_macros(data):
+    return any(macro in data for macro in TIME_MACROS)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return os.fstat(f.fileno()), f.read()
+
+
+def direct_key(compiler_id, compiler_cmd, srcfile):
+    """Manifest key of the compilation, None if it can't be cached"""
+    try:
+        _, source = _read(srcfile)
+    except OSError:
+        return None
+    if _has_time_macros(source):
+        return None
+    hsh = hashlib.new('sha256')
+    hsh.update(MANIFEST_VERSION.to_bytes(2, 'little'))
+    fields = [compiler_id, os.getcwd()] + compiler_cmd
+    fields.extend('{}={}'.format(name, os.environ.get(name, ''))
+                  for name in PREPROCESSOR_ENV)
+    for field in fields:
+        fieldbytes = field.encode('utf-8', 'surrogateescape')
+        hsh.update(len(fieldbytes).to_bytes(4, 'little'))
+        hsh.update(fieldbytes)
+    hsh.update(hashlib.sha256(source).digest())
+    return hsh.hexdigest()
+
+
+def _make_words(line):
+    words, word = [], []
+    n = 0
+    while n < len(line):
+        c = line[n]
+        if c == '\\' and line[n + 1:n + 2] in (' ', '#'):
+            word.append(line[n + 1])
+            n += 2
+            continue
+        if c == '$' and line[n + 1:n + 2] == '$':
+            word.append('$')
+            n += 2
+            continue
+        if c.isspace():
+            if word:
+                words.append(''.join(word))
+                word = []
+        else:
+            word.append(c)
+        n += 1
+    if word:
+        words.append(''.join(word))
+    return words
+
+
+def parse_dependencies(text):
+    """Prerequisites of the first rule of a dependency file, None if
+    there's no rule"""
+    rule = text.replace('\\\n', ' ').split('\n', 1)[0]
+    words = _make_words(rule)
+    for n, word in enumerate(words):
+        if word.endswith(':'):
+            return words[n + 1:]
+    return None
+
+
+class ManifestCache(CacheDir):
+    def __init__(self, cachedir=DEFAULT_MANIFEST_DIR, clock=time.time_ns,
+                 max_size=DEFAULT_MAX_SIZE):
+        super().__init__(os.path.expanduser(cachedir), max_size)
+        self._clock = clock
+
+    def _load(self, key):
+        try:
+            with open(self._path_by_key(key), 'rb') as f:
+                return marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return []
+
+    def _store(self, key, results):
+        path = self._path_by_key(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                marshal.dump(results, f)
+                size = f.tell()
+            self._replace(tmp_path, path, size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _unchanged(self, headers):
+        for path, size, mtime, ctime, digest in headers:
+            try:
+                st = os.stat(path)
+                if st.st_size != size:
+                    return False
+                if (mtime is not None and st.st_mtime_ns == mtime
+                        and st.st_ctime_ns == ctime):
+                    continue
+                _, data = _read(path)
+            except OSError:
+                return False
+            if hashlib.sha256(data).digest() != digest:
+                return False
+        return True
+
+    def lookup(self, key):
+        """(object cache key, dependency file) of the latest result
+        whose headers are unchanged, None if there's none"""
+        for headers, objkey, depdata in self._load(key):
+            if self._unchanged(headers):
+                try:
+                    # the least recently used manifests are evicted
+                    os.utime(self._path_by_key(key))
+                except FileNotFoundError:
+                    pass
+                return objkey, depdata
+        return None
+
+    def record(self, key, depfile, objkey):
+        """Add the result of the compilation the preprocessor has written
+        depfile for, False if it can't be cached"""
+        with open(depfile, 'rb') as f:
+            depdata = f.read()
+        deps = parse_dependencies(depdata.decode('utf-8', 'surrogateescape'))
+        if deps is None:
+            return False
+        recent = self._clock() - TOO_NEW
+        headers = []
+        for path in deps:
+            st, data = _read(path)
+            if _has_time_macros(data):
+                return False
+            mtime = st.st_mtime_ns
+            if max(mtime, st.st_ctime_ns) > recent:
+                mtime = None
+            headers.append((path, st.st_size, mtime, st.st_ctime_ns,
+                            hashlib.sha256(data).digest()))
+        results = [r for r in self._load(key) if r[1] != objkey]
+        results.insert(0, (headers, objkey, depdata))
+        self._store(key, results[:MAX_RESULTS])
+        return True
+
+
+def manifest_cache(settings):
+    cfg = settings.get('object_cache')
+    if not cfg or not cfg.get('direct_mode', True):
+        return None
+    return ManifestCache(cfg.get('manifest_dir', DEFAULT_MANIFEST_DIR),
+                         max_size=cfg.get('manifest_max_size',
+                                          DEFAULT_MAX_SIZE))
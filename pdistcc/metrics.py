@@ -0,0 +1,246 @@
+# pdistccd metrics in the Prometheus text format:
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+
+import asyncio
+import bisect
+import logging
+import threading
+
+# seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                10.0, 30.0, 60.0, 120.0)
+# bytes
+SIZE_BUCKETS = tuple(4**n*1024 for n in range(10))
+PHASES = ('total', 'queue', 'compile', 'recv', 'send')
+HTTP_TIMEOUT = 10
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self._labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self._labelnames)
+
+    def _labels(self, key):
+        return list(zip(self._labelnames, key))
+
+    def samples(self):
+        """(name, labels, value) tuples"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                          _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+        if not labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Gauge(_Metric):
+    """Value read at the scrape time, omitted if the function returns None"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn):
+        super().__init__(name, help)
+        self._fn = fn
+
+    def samples(self):
+        value = self._fn()
+        if value is not None:
+            yield self.name, [], value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # per label values: count of every bucket (not cumulative), sum
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # the bucket with the least upper bound >= value
+        n = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0]*(len(self._buckets) + 1), 0))
+            counts[n] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+        for key, (counts, total) in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float('inf'),), counts):
+                cumulative += count
+                yield (self.name + '_bucket', labels + [('le', _format_value(bound))],
+                       cumulative)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+class ServerMetrics(object):
+    """Request timings and counters of pdistccd, and its current load"""
+
+    def __init__(self, slots=None, load=None):
+        self.request_seconds = Histogram(
+            'pdistccd_request_seconds',
+            'Time spent on a request by phase (queue: waiting for a compile slot)',
+            ('phase',), TIME_BUCKETS)
+        self.request_bytes = Histogram(
+            'pdistccd_request_bytes',
+            'Size of received sources (in) and sent objects (out)',
+            ('direction',), SIZE_BUCKETS)
+        self.received_bytes = Counter('pdistccd_received_bytes_total',
+                                      'Bytes of sources received')
+        self.sent_bytes = Counter('pdistccd_sent_bytes_total',
+                                  'Bytes of objects sent')
+        self.compiler_exits = Counter('pdistccd_compiler_exits_total',
+                                      'Replies by compiler exit code', ('code',))
+        self.cache_hits = Counter('pdistccd_cache_hits_total',
+                                  'Replies from the object cache')
+        self.failed = Counter('pdistccd_failed_requests_total',
+                              'Requests failed with an error')
+        self.rejected = Counter('pdistccd_rejected_requests_total',
+                                'Requests rejected with BUSY')
+        self._metrics = [
+            self.request_seconds,
+            self.request_bytes,
+            self.received_bytes,
+            self.sent_bytes,
+            self.compiler_exits,
+            self.cache_hits,
+            self.failed,
+            self.rejected,
+        ]
+        if slots is not None:
+            self._metrics.extend([
+                Gauge('pdistccd_compile_slots', 'Number of compile slots',
+                      lambda: slots.count),
+                Gauge('pdistccd_active_jobs', 'Compilers running now',
+                      lambda: slots.running),
+                Gauge('pdistccd_queued_jobs', 'Jobs waiting for a compile slot',
+                      lambda: slots.waiting),
+            ])
+        if load is not None:
+            self._metrics.extend([
+                Gauge('pdistccd_connections', 'Open client connections',
+                      lambda: load.connections),
+                Gauge('pdistccd_load_average', '1 minute load average',
+                      lambda: load.load_average),
+                Gauge('pdistccd_cpu_pressure',
+                      '% of time tasks waited for a CPU in the last 10 seconds',
+                      lambda: load.cpu_pressure),
+            ])
+
+    def observe(self, perf):
+        """Account a handled request"""
+        for phase in PHASES:
+            self.request_seconds.observe(getattr(perf, phase + '_time')/1000,
+                                         phase=phase)
+        self.request_bytes.observe(perf.recv_size, direction='in')
+        self.request_bytes.observe(perf.send_size, direction='out')
+        self.received_bytes.inc(perf.recv_size)
+        self.sent_bytes.inc(perf.send_size)
+        if perf.returncode is not None:
+            self.compiler_exits.inc(code=perf.returncode)
+        if perf.cache_hit:
+            self.cache_hits.inc()
+
+    def request_failed(self):
+        self.failed.inc()
+
+    def request_rejected(self):
+        self.rejected.inc()
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+async def _handle_http(metrics, reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                         HTTP_TIMEOUT)
+        method, path, _ = request.split(b'\r\n', 1)[0].split(b' ', 2)
+        if method == b'GET' and path.split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', metrics.render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'
+                     .format(status, CONTENT_TYPE, len(body)).encode('ascii'))
+        writer.write(body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            asyncio.TimeoutError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(metrics, host, port):
+    """Serve GET /metrics over HTTP, returns asyncio.Server"""
+    server = await asyncio.start_server(
+        lambda r, w: _handle_http(metrics, r, w), host, port)
+    logger.info('serving metrics at http://%s:%s/metrics', host, port)
+    return server
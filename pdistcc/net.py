@@ -1,19 +1,66 @@
 
+import io
+import logging
 import os
+import select
 import socket
 import sys
+import threading
+import time
 
-from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+from contextlib import (
+    ExitStack,
+    contextmanager,
+)
+
+from . import trace
+from .compression import (
+    DEFAULT_CODEC,
+    UnsupportedCodec,
+    get_codec,
+    pump_codec,
+)
 
 
 DCC_TOKEN_HEADER_LEN = 12
 DCC_VERSION = 1
+DCC_VERSION_COMPRESSED = 2
+# pump mode of pdistcc: not distcc's version 3, distcc-pump frames the
+# files differently, so a distccd rejects the request instead of
+# misparsing it
+DCC_VERSION_PUMP = 0x50
+# many jobs over a single connection (MPLX extension)
+MPLX_VERSION = 1
+# compilers of the server (INVQ/INVR extension)
+INVENTORY_VERSION = 1
+# set in the DOTC value by the clients which accept the object file as
+# a sequence of compressed chunks too (servers ignore the DOTC value)
+CHUNKED_REPLY = 1
+# smaller files are sent along with the token headers in a single syscall
+SENDFILE_MIN_SIZE = 64*1024
+# larger files are spliced from the socket to the destination file
+RECV_SPLICE_MIN_SIZE = 64*1024
+SPLICE_PIPE_SIZE = 1024*1024
+# max number of buffers of a single sendmsg() call
+IOV_MAX = 1024
+
+logger = logging.getLogger(__name__)
 
 
 class ProtocolError(Exception):
     pass
 
 
+class ReplyTimeout(TimeoutError):
+    """The server has accepted the job but not replied in io_timeout"""
+
+
 class InvalidToken(ProtocolError):
     def __init__(self, fmt, *args, **kwargs):
         super().__init__()
@@ -23,6 +70,23 @@ class InvalidToken(ProtocolError):
         return 'InvalidToken: ' + self.message
 
 
+class ServerBusy(ProtocolError):
+    def __init__(self, queued):
+        super().__init__()
+        self.queued = queued
+
+    def __str__(self):
+        return 'ServerBusy: {} jobs queued'.format(self.queued)
+
+
+class MultiplexNotSupported(ProtocolError):
+    pass
+
+
+class JobFailed(ProtocolError):
+    pass
+
+
 def dcc_encode(name, val):
     return '{0}{1:08x}'.format(name, val).encode('utf-8')
 
@@ -37,16 +101,27 @@ def dcc_decode(token):
     return name, size
 
 
-def recv_exactly(s, count):
-    data = b''
-    remaining = count
-    while remaining > 0:
-        chunk = s.recv(remaining)
-        if len(chunk) == 0:
+def _recv_into_exactly(sock, mv):
+    pos = 0
+    size = len(mv)
+    while pos < size:
+        with mv[pos:] as view:
+            n = sock.recv_into(view)
+        if n == 0:
             raise ProtocolError('peer disconnected')
-        data += chunk
-        remaining -= len(chunk)
-    return data
+        pos += n
+
+
+def recv_exactly(s, count):
+    data = s.recv(count)
+    if len(data) == count:
+        # tokens and small fields arrive at once
+        return data
+    buf = bytearray(count)
+    buf[:len(data)] = data
+    with memoryview(buf) as mv, mv[len(data):] as view:
+        _recv_into_exactly(s, view)
+    return bytes(buf)
 
 
 def read_field(s, with_data=True):
@@ -67,32 +142,221 @@ def read_token(sock, expected=None):
     return name, size
 
 
-def chunked_read_write(sock, fobj, size, chunk_size=256*1024):
+def chunked_read_write(sock, fobj, size, chunk_size=256*1024, hsh=None):
     remaining = size
-    recv_into = sock.recv_into
-    fobj_write = fobj.write
-    buflen = chunk_size
-    with memoryview(bytearray(buflen)) as mv:
+    if remaining == 0:
+        return
+    with memoryview(bytearray(min(chunk_size, size))) as mv:
         while remaining > 0:
-            if chunk_size > remaining:
-                chunk_size = remaining
-            n = recv_into(mv, chunk_size)
+            if len(mv) > remaining:
+                with mv[:remaining] as smv:
+                    _recv_into_exactly(sock, smv)
+                    fobj.write(smv)
+                    if hsh is not None:
+                        hsh.update(smv)
+                break
+            # fill the whole buffer before writing it out
+            _recv_into_exactly(sock, mv)
+            fobj.write(mv)
+            if hsh is not None:
+                hsh.update(mv)
+            remaining -= len(mv)
+
+
+def _splice_to_file(sock, fd, offset, size):
+    r, w = os.pipe()
+    try:
+        pipe_size = 64*1024
+        try:
+            pipe_size = fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass
+        remaining = size
+        while remaining > 0:
+            n = os.splice(sock.fileno(), w, min(remaining, pipe_size),
+                          flags=os.SPLICE_F_MOVE)
             if n == 0:
                 raise ProtocolError('peer disconnected')
-            elif n < buflen:
-                with mv[:n] as smv:
-                    fobj.write(smv)
-            else:
-                fobj_write(mv)
             remaining -= n
+            while n > 0:
+                m = os.splice(r, fd, n, offset_dst=offset,
+                              flags=os.SPLICE_F_MOVE)
+                n -= m
+                offset += m
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def receive_file(sock, fobj, size, hsh=None):
+    """Receive size bytes into fobj at its current position.
+
+    The file is preallocated, and on Linux large files are spliced from
+    the socket without copying the data through Python buffers. Data
+    to be hashed, in-memory files, and fake sockets go through
+    chunked_read_write().
+    """
+    fd = _fileno(fobj)
+    if size < RECV_SPLICE_MIN_SIZE or fd is None:
+        chunked_read_write(sock, fobj, size, hsh=hsh)
+        return
+    fobj.flush()
+    offset = fobj.tell()
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, offset, size)
+        except OSError:
+            # not supported by the file system
+            pass
+    # splice() needs a blocking socket, one with a timeout is not
+    if hsh is None and hasattr(os, 'splice') and \
+            _fileno(sock) is not None and sock.gettimeout() is None:
+        _splice_to_file(sock, fd, offset, size)
+        fobj.seek(offset + size)
+    else:
+        chunked_read_write(sock, fobj, size, hsh=hsh)
+
+
+def chunked_send(sock, fobj, size, chunk_size=256*1024):
+    remaining = size
+    while remaining > 0:
+        chunk = fobj.read(min(chunk_size, remaining))
+        if len(chunk) == 0:
+            raise ProtocolError('unexpected end of file')
+        sock.sendall(chunk)
+        remaining -= len(chunk)
 
 
-def chunked_send(sock, fobj, size, chunk_size=4096):
+def send_buffers(sock, buffers):
+    """Send the buffers one after another with as few syscalls as possible"""
+    buffers = [memoryview(b) for b in buffers if len(b) > 0]
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is None:
+        # Windows or a fake socket
+        sock.sendall(b''.join(buffers))
+        return
+    n = 0
+    while n < len(buffers):
+        sent = sendmsg(buffers[n:n + IOV_MAX])
+        while sent > 0:
+            if sent < len(buffers[n]):
+                buffers[n] = buffers[n][sent:]
+                break
+            sent -= len(buffers[n])
+            n += 1
+
+
+def _fileno(fobj):
+    try:
+        return fobj.fileno()
+    except (AttributeError, OSError):
+        # io.UnsupportedOperation: in-memory file
+        return None
+
+
+def send_file(sock, fobj, size, headers=()):
+    """Send the headers followed by size bytes of fobj.
+
+    Large files go with sendfile() straight from the page cache, small
+    ones are sent together with the headers in a single syscall.
+    """
+    if size < SENDFILE_MIN_SIZE:
+        data = fobj.read(size)
+        if len(data) != size:
+            raise ProtocolError('unexpected end of file')
+        send_buffers(sock, list(headers) + [data])
+        return
+    send_buffers(sock, headers)
+    if not hasattr(sock, 'sendfile') or _fileno(fobj) is None:
+        chunked_send(sock, fobj, size)
+        return
+    if sock.sendfile(fobj, fobj.tell(), size) != size:
+        raise ProtocolError('unexpected end of file')
+
+
+def compress_file(codec, fobj, size, chunk_size=256*1024):
+    cobj = codec.compressobj()
+    out = []
     remaining = size
     while remaining > 0:
-        chunk = fobj.read(chunk_size)
-        sock.sendall(chunk)
+        chunk = fobj.read(min(chunk_size, remaining))
+        if len(chunk) == 0:
+            raise ProtocolError('unexpected end of file')
+        out.append(cobj.compress(chunk))
         remaining -= len(chunk)
+    out.append(cobj.flush())
+    return b''.join(out)
+
+
+def send_compressed_chunks(sock, fobj, size, codec, headers=(),
+                           chunk_size=256*1024):
+    """Send the headers and size bytes of fobj as CHNK fields ended by an
+    empty one. Every chunk is compressed on its own and sent right away.
+    Returns the number of compressed bytes sent."""
+    buffers = list(headers)
+    sent = 0
+    remaining = size
+    while remaining > 0:
+        chunk = fobj.read(min(chunk_size, remaining))
+        if len(chunk) == 0:
+            raise ProtocolError('unexpected end of file')
+        data = compress_chunk(codec, chunk)
+        buffers.extend([dcc_encode('CHNK', len(data)), data])
+        send_buffers(sock, buffers)
+        buffers = []
+        sent += len(data)
+        remaining -= len(chunk)
+    send_buffers(sock, buffers + [dcc_encode('CHNK', 0)])
+    return sent
+
+
+def receive_chunks(sock, fobj, codec=None):
+    """Receive CHNK fields up to an empty one, returns the number of
+    bytes received"""
+    total = 0
+    while True:
+        _, size = read_token(sock, b'CHNK')
+        if size == 0:
+            return total
+        if codec is not None:
+            fobj.write(decompress_chunk(codec, recv_exactly(sock, size)))
+        else:
+            chunked_read_write(sock, fobj, size)
+        total += size
+
+
+def chunked_read_decompress(sock, fobj, size, codec, chunk_size=256*1024):
+    dobj = codec.decompressobj()
+    remaining = size
+    while remaining > 0:
+        chunk = sock.recv(min(chunk_size, remaining))
+        if len(chunk) == 0:
+            raise ProtocolError('peer disconnected')
+        fobj.write(dobj.decompress(chunk))
+        remaining -= len(chunk)
+    fobj.write(dobj.flush())
+
+
+def compress_chunk(codec, data):
+    cobj = codec.compressobj()
+    return cobj.compress(data) + cobj.flush()
+
+
+def decompress_chunk(codec, data):
+    dobj = codec.decompressobj()
+    return dobj.decompress(data) + dobj.flush()
+
+
+def client_codec(compression):
+    """Codec of the compression host option, None if it's not available
+    (the job is sent uncompressed then)"""
+    if not compression:
+        return None
+    try:
+        return get_codec(compression)
+    except UnsupportedCodec as e:
+        logger.warning('%s, sending the job uncompressed', e)
+        return None
 
 
 def to_string(b):
@@ -130,30 +394,162 @@ class DccClient(object):
                  ofile,
                  stdout=sys.stdout.buffer,
                  stderr=sys.stderr.buffer,
-                 fileops=FileOpsFactory()):
+                 fileops=FileOpsFactory(),
+                 codec=None,
+                 multiplexed=False,
+                 io_timeout=None):
         self._conn = conn
+        self._multiplexed = multiplexed
+        self._io_timeout = io_timeout
         self._doti = doti
         self._ofile = ofile
         self._stdout = stdout
         self._stderr = stderr
         self._fileops = fileops
-        self._protocol_version = DCC_VERSION
-
-    def request(self, args):
-        buf = dcc_encode('DIST', DCC_VERSION)
-        buf += dcc_encode('ARGC', len(args))
+        self._codec = codec
+        if codec is None:
+            self._protocol_version = DCC_VERSION
+        else:
+            self._protocol_version = DCC_VERSION_COMPRESSED
+
+    def fileno(self):
+        # select() on clients
+        return self._conn.fileno()
+
+    def _chunked(self):
+        # distcc expects a single LZO block, the other codecs are
+        # understood by pdistccd only, which accepts chunks
+        return self._codec is not None and self._codec.name != DEFAULT_CODEC
+
+    def _request_header(self, args):
+        buf = [dcc_encode('DIST', self._protocol_version)]
+        if self._codec is not None and self._codec.name != DEFAULT_CODEC:
+            buf.append(dcc_encode('COMP', self._codec.codec_id))
+        buf.append(dcc_encode('ARGC', len(args)))
         for n, arg in enumerate(args):
             argbytes = arg.encode('utf-8')
-            buf += dcc_encode('ARGV', len(argbytes))
-            buf += argbytes
+            buf.append(dcc_encode('ARGV', len(argbytes)))
+            buf.append(argbytes)
+        return b''.join(buf)
+
+    def request(self, args, prefix=b''):
+        buf = prefix + self._request_header(args)
         with self._fileops.open(self._doti, 'rb') as doti:
             doti_len = self._fileops.size(doti)
+            if self._chunked():
+                buf += dcc_encode('DOTC', CHUNKED_REPLY)
+                if doti_len >= SENDFILE_MIN_SIZE:
+                    self._conn.sendall(buf)
+                    self.check_busy()
+                    buf = b''
+                send_compressed_chunks(self._conn, doti, doti_len,
+                                       self._codec, [buf])
+                return
+            data = None
+            if self._codec is not None:
+                data = compress_file(self._codec, doti, doti_len)
+                doti_len = len(data)
             buf += dcc_encode('DOTI', doti_len)
-            self._conn.sendall(buf)
-            chunked_send(self._conn, doti, doti_len)
+            if doti_len >= SENDFILE_MIN_SIZE:
+                # a busy server replies right after accepting the
+                # connection, don't upload a large source in vain
+                self._conn.sendall(buf)
+                self.check_busy()
+                buf = b''
+            if data is not None:
+                send_buffers(self._conn, [buf, data])
+            else:
+                send_file(self._conn, doti, doti_len, [buf])
+
+    def request_stream(self, args, stream, chunk_size=256*1024):
+        """Send DOTI of unknown size as a sequence of chunks"""
+        buf = self._request_header(args)
+        flags = CHUNKED_REPLY if self._codec is not None else 0
+        buf += dcc_encode('DOTC', flags)
+        self._conn.sendall(buf)
+        self.check_busy()
+        read = getattr(stream, 'read1', stream.read)
+        while True:
+            chunk = read(chunk_size)
+            if len(chunk) == 0:
+                break
+            if self._codec is not None:
+                # every chunk is compressed independently (LZO has
+                # no streaming interface)
+                chunk = compress_chunk(self._codec, chunk)
+            send_buffers(self._conn, [dcc_encode('CHNK', len(chunk)), chunk])
+
+    def end_stream(self):
+        self._conn.sendall(dcc_encode('CHNK', 0))
+
+    def request_pump(self, args, cwd, files):
+        self._protocol_version = DCC_VERSION_PUMP
+        buf = self._request_header(args)
+        cwdbytes = cwd.encode('utf-8')
+        buf += dcc_encode('CDIR', len(cwdbytes))
+        buf += cwdbytes
+        buf += dcc_encode('NFIL', len(files))
+        self._conn.sendall(buf)
+        self.check_busy()
+        for path in files:
+            pathbytes = path.encode('utf-8')
+            with self._fileops.open(path, 'rb') as f:
+                data = compress_file(self._codec, f, self._fileops.size(f))
+            buf = dcc_encode('NAME', len(pathbytes)) + pathbytes
+            buf += dcc_encode('FILE', len(data))
+            send_buffers(self._conn, [buf, data])
+
+    def check_busy(self, timeout=0):
+        """Raise ServerBusy if the server has rejected the request"""
+        if self._multiplexed:
+            # the server can't reject a job of a multiplexed connection
+            return
+        try:
+            readable, _, _ = select.select([self._conn], [], [], timeout)
+        except (TypeError, ValueError):
+            # not a real socket
+            return
+        if not readable:
+            return
+        # a quick server might have already replied DONE, leave it be
+        try:
+            head = self._conn.recv(4, socket.MSG_PEEK | socket.MSG_WAITALL)
+            # a socket with a timeout may still peek a part of the token,
+            # no other reply starts like BUSY, read_token waits for the rest
+            if not head or not b'BUSY'.startswith(head):
+                return
+            _, queued = read_token(self._conn, b'BUSY')
+        except (OSError, ProtocolError):
+            return
+        raise ServerBusy(queued)
+
+    def _wait_reply(self):
+        if self._io_timeout is None:
+            return
+        try:
+            readable, _, _ = select.select([self._conn], [], [],
+                                           self._io_timeout)
+        except (TypeError, ValueError):
+            # not a real socket
+            return
+        if not readable:
+            raise ReplyTimeout('no reply in {} seconds'.format(self._io_timeout))
 
     def handle_response(self):
-        _, version = read_token(self._conn, b'DONE')
+        with trace.span('wait'):
+            self._wait_reply()
+            name, version = read_token(self._conn)
+        with trace.span('download'):
+            return self._read_response(name, version)
+
+    def _read_response(self, name, version):
+        if name == b'BUSY':
+            raise ServerBusy(version)
+        if name == b'JOBE':
+            # pdistccd can't compile the job (unknown compiler, codec...)
+            raise JobFailed('the server has rejected the job')
+        if name != b'DONE':
+            raise InvalidToken('expected "DONE", got "{}"', to_string(name))
         if version != self._protocol_version:
             raise ProtocolError('unsupported protocol version {}, supported: {}'
                                 .format(version, self._protocol_version))
@@ -166,18 +562,322 @@ class DccClient(object):
         chunked_read_write(self._conn, self._stdout, sout_len)
 
         if status != 0:
+            if self._multiplexed:
+                # pdistccd sends an empty DOTO, skip to the next reply
+                _, doto_len = read_token(self._conn, b'DOTO')
+                recv_exactly(self._conn, doto_len)
             return status
 
-        _, doto_len = read_token(self._conn, b'DOTO')
+        name, doto_len = read_token(self._conn)
+        if name not in (b'DOTO', b'DOTC'):
+            raise InvalidToken('expected "DOTO", got "{}"', to_string(name))
         with self._fileops.open(self._ofile, 'wb') as doto:
-            chunked_read_write(self._conn, doto, doto_len)
+            if name == b'DOTC':
+                receive_chunks(self._conn, doto, self._codec)
+            elif self._codec is not None and doto_len > 0:
+                chunked_read_decompress(self._conn, doto, doto_len, self._codec)
+            else:
+                receive_file(self._conn, doto, doto_len)
             self._fileops.flush(doto)
         return status
 
 
-def dcc_compile(doti, args, host='127.0.0.1', port=3632, ofile='a.out'):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((host, port))
-        dcc = DccClient(s, doti, ofile)
-        dcc.request(args)
-        dcc.handle_response()
+def _connect(host, port, timeout=None):
+    with trace.span('connect'):
+        s = socket.create_connection((host, port), timeout)
+    # blocking I/O (required by splice), the reply is waited for with
+    # the io_timeout of DccClient
+    s.settimeout(None)
+    return s
+
+
+@contextmanager
+def _busy_reply(dcc):
+    try:
+        yield
+    except (BrokenPipeError, ConnectionResetError):
+        # a busy server closes the connection without reading the request
+        dcc.check_busy()
+        raise
+
+
+def dcc_compile(doti, args, host='127.0.0.1', port=3632, ofile='a.out',
+                stdout=sys.stdout.buffer, stderr=sys.stderr.buffer,
+                compression=None, connect_timeout=None, io_timeout=None):
+    codec = client_codec(compression)
+    with _connect(host, port, connect_timeout) as s:
+        dcc = DccClient(s, doti, ofile, stdout=stdout, stderr=stderr,
+                        codec=codec, io_timeout=io_timeout)
+        with trace.span('upload'), _busy_reply(dcc):
+            dcc.request(args)
+        return dcc.handle_response()
+
+
+def dcc_hedged_compile(doti, args, host, port, backup, delay, ofile='a.out',
+                       stdout=sys.stdout.buffer, stderr=sys.stderr.buffer,
+                       compression=None, connect_timeout=None, io_timeout=None):
+    """dcc_compile() which sends a duplicate request to another server
+    if there is no reply in `delay` seconds.
+
+    backup() returns the slot lease (see sched.SlotLease) of the server
+    to send the duplicate to, or None if there is no idle one. The first
+    reply wins, the connection of the other request is closed. The
+    output of a request is kept aside until it wins, so a request
+    failing half way through its reply leaves nothing behind.
+
+    Returns the exit status of the compiler, the server which has won
+    ({'host': ..., 'port': ...}) and the time.monotonic() its request
+    was sent at.
+    """
+    codec = client_codec(compression)
+    sent = time.monotonic()
+    with _connect(host, port, connect_timeout) as s:
+        primary = _HedgedClient(s, doti, ofile, codec, io_timeout,
+                                {'host': host, 'port': port}, sent)
+        with trace.span('upload'), _busy_reply(primary.dcc):
+            primary.dcc.request(args)
+        with trace.span('wait', hedge_delay=delay):
+            readable, _, _ = select.select([primary], [], [], delay)
+        lease = None if readable else backup()
+        if lease is None:
+            return primary.finish(ofile, stdout, stderr)
+        with lease, ExitStack() as stack:
+            clients = [primary]
+            try:
+                clients.append(_hedge_request(stack, doti, args, lease.host,
+                                              ofile + '.hedge',
+                                              connect_timeout, io_timeout))
+            except (OSError, ProtocolError):
+                # the primary request is still there
+                pass
+            while True:
+                with trace.span('wait', hedged=True):
+                    readable, _, _ = select.select(clients, [], [], io_timeout)
+                if not readable:
+                    raise ReplyTimeout('no reply in {} seconds'.format(io_timeout))
+                client = readable[0]
+                try:
+                    return client.finish(ofile, stdout, stderr)
+                except (OSError, ProtocolError):
+                    # busy or failed, wait for the other one
+                    clients.remove(client)
+                    if not clients:
+                        raise
+
+
+class _HedgedClient(object):
+    """DccClient of a hedged request, its output is published once it
+    has won"""
+
+    def __init__(self, sock, doti, ofile, codec, io_timeout, host, sent):
+        self.host = host
+        self.sent = sent
+        self._ofile = ofile
+        self._stdout = io.BytesIO()
+        self._stderr = io.BytesIO()
+        self.dcc = DccClient(sock, doti, ofile, stdout=self._stdout,
+                             stderr=self._stderr, codec=codec,
+                             io_timeout=io_timeout)
+
+    def fileno(self):
+        return self.dcc.fileno()
+
+    def finish(self, ofile, stdout, stderr):
+        """Read the reply, the object file is moved to ofile. Returns
+        the result of dcc_hedged_compile()."""
+        ret = self.dcc.handle_response()
+        if ret == 0 and self._ofile != ofile:
+            os.replace(self._ofile, ofile)
+        stdout.write(self._stdout.getvalue())
+        stderr.write(self._stderr.getvalue())
+        return ret, self.host, self.sent
+
+    def discard(self):
+        if os.path.exists(self._ofile):
+            os.remove(self._ofile)
+
+
+def _hedge_request(stack, doti, args, host, ofile, connect_timeout,
+                   io_timeout):
+    compression = host.get('compression')
+    codec = client_codec(compression)
+    with trace.span('hedge', hedge_host='{}:{}'.format(host['host'], host['port'])):
+        sent = time.monotonic()
+        s = stack.enter_context(_connect(host['host'], host['port'],
+                                         connect_timeout))
+        client = _HedgedClient(s, doti, ofile, codec, io_timeout, host, sent)
+        # the object file of the duplicate, unless it has won
+        stack.callback(client.discard)
+        with _busy_reply(client.dcc):
+            client.dcc.request(args)
+    return client
+
+
+def dcc_stream_compile(stream, args, host='127.0.0.1', port=3632,
+                       ofile='a.out', stdout=sys.stdout.buffer,
+                       stderr=sys.stderr.buffer, compression=None,
+                       wait_source=None, connect_timeout=None, io_timeout=None):
+    # wait_source is called once the stream is exhausted and should
+    # raise if the stream is incomplete. The connection is closed then
+    # without the terminating chunk, so the server won't compile a
+    # truncated source.
+    codec = client_codec(compression)
+    with _connect(host, port, connect_timeout) as s:
+        dcc = DccClient(s, None, ofile, stdout=stdout, stderr=stderr,
+                        codec=codec, io_timeout=io_timeout)
+        with trace.span('upload', stream=True), _busy_reply(dcc):
+            dcc.request_stream(args, stream)
+        if wait_source is not None:
+            wait_source()
+        dcc.end_stream()
+        return dcc.handle_response()
+
+
+def dcc_pump_compile(files, args, cwd, host='127.0.0.1', port=3632,
+                     ofile='a.out', stdout=sys.stdout.buffer,
+                     stderr=sys.stderr.buffer, compression=None,
+                     connect_timeout=None, io_timeout=None):
+    codec = pump_codec(compression)
+    with _connect(host, port, connect_timeout) as s:
+        dcc = DccClient(s, None, ofile, stdout=stdout, stderr=stderr,
+                        codec=codec, io_timeout=io_timeout)
+        with trace.span('upload', pump=True), _busy_reply(dcc):
+            dcc.request_pump(args, cwd, files)
+        return dcc.handle_response()
+
+
+def dcc_inventory(host='127.0.0.1', port=3632, connect_timeout=None,
+                  io_timeout=None):
+    """Compilers of the server, see pdistcc.inventory"""
+    with _connect(host, port, connect_timeout) as s:
+        s.settimeout(io_timeout)
+        s.sendall(dcc_encode('INVQ', INVENTORY_VERSION))
+        name, size = read_token(s)
+        if name == b'BUSY':
+            raise ServerBusy(size)
+        if name != b'INVR':
+            raise InvalidToken('expected INVR, got "{}"', to_string(name))
+        return recv_exactly(s, size)
+
+
+class _SessionJob(object):
+    def __init__(self, dcc):
+        self.dcc = dcc
+        self.done = threading.Event()
+        self.status = None
+        self.error = None
+
+
+class DccSession(object):
+    """Many compilations over a single connection.
+
+    compile() can be called from several threads at once: the requests
+    are pipelined and the replies, which may come out of order, are
+    matched to the jobs by id.
+    """
+
+    def __init__(self, host='127.0.0.1', port=3632, fileops=FileOpsFactory(),
+                 conn=None, connect_timeout=None):
+        self._conn = conn or _connect(host, port, connect_timeout)
+        self._fileops = fileops
+        self._write_lock = threading.Lock()
+        self._jobs_lock = threading.Lock()
+        self._jobs = {}
+        self._next_id = 0
+        self._error = None
+        try:
+            self._conn.sendall(dcc_encode('MPLX', MPLX_VERSION))
+            name, max_jobs = read_token(self._conn)
+        except (OSError, ProtocolError):
+            # distccd and older pdistccd drop the connection
+            self._conn.close()
+            raise MultiplexNotSupported()
+        if name == b'BUSY':
+            self._conn.close()
+            raise ServerBusy(max_jobs)
+        if name != b'MPLX' or max_jobs == 0:
+            self._conn.close()
+            raise MultiplexNotSupported()
+        self._slots = threading.BoundedSemaphore(max_jobs)
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+
+    def _read_reply(self):
+        name, job_id = read_token(self._conn)
+        if name not in (b'JOBO', b'JOBE'):
+            raise InvalidToken('expected JOBO, got "{}"', to_string(name))
+        with self._jobs_lock:
+            job = self._jobs.pop(job_id, None)
+        if job is None:
+            raise ProtocolError('reply to unknown job {}'.format(job_id))
+        try:
+            if name == b'JOBE':
+                job.error = JobFailed('job {} has failed on the server'
+                                      .format(job_id))
+            else:
+                job.status = job.dcc.handle_response()
+        except Exception as e:
+            # the reply might be partially read, the connection is unusable
+            job.error = e
+            raise
+        finally:
+            job.done.set()
+
+    def _read_replies(self):
+        try:
+            while True:
+                self._read_reply()
+        except Exception as e:
+            self._fail_all(e)
+
+    def _fail_all(self, error):
+        with self._jobs_lock:
+            self._error = error
+            jobs, self._jobs = self._jobs, {}
+        for job in jobs.values():
+            job.error = error
+            job.done.set()
+
+    def compile(self, doti, args, ofile='a.out', stdout=sys.stdout.buffer,
+                stderr=sys.stderr.buffer, compression=None):
+        codec = client_codec(compression)
+        dcc = DccClient(self._conn, doti, ofile, stdout=stdout, stderr=stderr,
+                        fileops=self._fileops, codec=codec, multiplexed=True)
+        job = _SessionJob(dcc)
+        with self._slots:
+            with self._write_lock:
+                with self._jobs_lock:
+                    if self._error is not None:
+                        raise self._error
+                    job_id = self._next_id
+                    self._next_id = (self._next_id + 1) & 0xffffffff
+                    self._jobs[job_id] = job
+                try:
+                    dcc.request(args, prefix=dcc_encode('JOBI', job_id))
+                except BaseException:
+                    # the request is incomplete, the connection is unusable
+                    with self._jobs_lock:
+                        self._jobs.pop(job_id, None)
+                    try:
+                        self._conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    raise
+            job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.status
+
+    def close(self):
+        try:
+            self._conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self._reader.join()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+# Micro-benchmarks of the wire protocol: the token codec, field reads,
+# bulk transfers, and whole DccClient <-> Distccd exchanges (with a stub
+# compiler) over socketpairs and loopback TCP.
+#
+#   python3 -m pdistcc.net_bench --json > before.json
+#   python3 -m pdistcc.net_bench --baseline before.json
+#
+# Exits with status 1 if some rate is lower than in the baseline by more
+# than the tolerance.
+
+import argparse
+import io
+import json
+import os
+import os.path
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from .net import (
+    DccClient,
+    ProtocolError,
+    chunked_read_write,
+    chunked_send,
+    dcc_decode,
+    dcc_encode,
+    read_field,
+    read_token,
+    receive_file,
+    recv_exactly,
+    send_file,
+)
+from .server import Distccd
+
+KB = 1024
+MB = 1024*KB
+DEFAULT_SIZES = (KB, 64*KB, MB, 16*MB, 64*MB)
+DEFAULT_ARGC = (8, 64, 512)
+TRANSPORTS = ('socketpair', 'tcp')
+# codec operations per timed call
+CODEC_BATCH = 1000
+MAX_CALLS = 100000
+
+
+def _size_label(size):
+    for unit, scale in (('M', MB), ('K', KB)):
+        if size >= scale and size % scale == 0:
+            return '{}{}'.format(size // scale, unit)
+    return str(size)
+
+
+def _parse_size(text):
+    scale = {'K': KB, 'M': MB}.get(text[-1:].upper(), 1)
+    return int(text[:-1] if scale != 1 else text)*scale
+
+
+def _rate(run, min_time):
+    """Calls of run(count) per second, count is raised until the run
+    takes at least min_time"""
+    count = 1
+    while True:
+        start = time.perf_counter()
+        run(count)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or count >= MAX_CALLS:
+            return count/elapsed
+        scale = int(1.2*min_time/max(elapsed, 1e-6))
+        count = min(MAX_CALLS, count*max(2, min(10, scale)))
+
+
+class _BufferSocket(object):
+    """Reads from memory, to time the parsing alone"""
+
+    def __init__(self, data):
+        self._buf = io.BytesIO(data)
+
+    def rewind(self):
+        self._buf.seek(0)
+
+    def recv(self, size, flags=0):
+        return self._buf.read(size)
+
+    def recv_into(self, buf, size=0):
+        if size == 0:
+            return self._buf.readinto(buf)
+        with memoryview(buf) as mv, mv[:size] as view:
+            return self._buf.readinto(view)
+
+
+def bench_codec(min_time):
+    tokens = [dcc_encode('ARGV', n) for n in range(CODEC_BATCH)]
+    stat = _BufferSocket(dcc_encode('STAT', 0)*CODEC_BATCH)
+    argv = _BufferSocket((dcc_encode('ARGV', 8) + b'-DFOO=42')*CODEC_BATCH)
+
+    def encode(count):
+        for _ in range(count):
+            for n in range(CODEC_BATCH):
+                dcc_encode('ARGV', n)
+
+    def decode(count):
+        for _ in range(count):
+            for token in tokens:
+                dcc_decode(token)
+
+    def tokens_(count):
+        for _ in range(count):
+            stat.rewind()
+            for _ in range(CODEC_BATCH):
+                read_token(stat, b'STAT')
+
+    def fields(count):
+        for _ in range(count):
+            argv.rewind()
+            for _ in range(CODEC_BATCH):
+                read_field(argv)
+
+    results = {}
+    for name, run in (('dcc_encode', encode), ('dcc_decode', decode),
+                      ('read_token', tokens_), ('read_field', fields)):
+        results[name] = {'ops_per_s': CODEC_BATCH*_rate(run, min_time)}
+    return results
+
+
+def _listening_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    return sock
+
+
+def _connected_pair(transport):
+    if transport == 'socketpair':
+        return socket.socketpair()
+    with _listening_socket() as lsock:
+        client = socket.create_connection(lsock.getsockname())
+        server, _ = lsock.accept()
+    return client, server
+
+
+def _drain(sock, size):
+    remaining = size
+    with memoryview(bytearray(min(size, MB))) as mv:
+        while remaining > 0:
+            n = sock.recv_into(mv, min(remaining, len(mv)))
+            if n == 0:
+                raise ProtocolError('peer disconnected')
+            remaining -= n
+
+
+def _transfer_ops(tmpdir, size):
+    """Name -> (local op, peer op) pairs, local ops run count times"""
+    payload = os.urandom(size)
+    src = os.path.join(tmpdir, 'send.bin')
+    with open(src, 'wb') as f:
+        f.write(payload)
+    dst = open(os.path.join(tmpdir, 'recv.bin'), 'wb')
+    fsrc = open(src, 'rb')
+
+    def sender(sock, count):
+        for _ in range(count):
+            sock.sendall(payload)
+
+    def drainer(sock, count):
+        _drain(sock, count*size)
+
+    def sending(fn):
+        def op(sock):
+            fsrc.seek(0)
+            fn(sock, fsrc, size)
+        return op
+
+    def receiving(fn):
+        def op(sock):
+            dst.seek(0)
+            fn(sock, dst, size)
+        return op
+
+    ops = {
+        'chunked_send': (sending(chunked_send), drainer),
+        'send_file': (sending(send_file), drainer),
+        'recv_exactly': (lambda sock: recv_exactly(sock, size), sender),
+        'chunked_read_write': (receiving(chunked_read_write), sender),
+        'receive_file': (receiving(receive_file), sender),
+    }
+    return ops, (fsrc, dst)
+
+
+def bench_transfer(transport, sizes, min_time, tmpdir):
+    results = {}
+    for size in sizes:
+        ops, files = _transfer_ops(tmpdir, size)
+        try:
+            for name, (local, peer) in ops.items():
+                def run(count):
+                    a, b = _connected_pair(transport)
+                    with a, b:
+                        thread = threading.Thread(target=peer, args=(b, count))
+                        thread.start()
+                        for _ in range(count):
+                            local(a)
+                        thread.join()
+                rate = _rate(run, min_time)
+                results.setdefault(name, {})[_size_label(size)] = {
+                    'mb_per_s': rate*size/MB,
+                }
+        finally:
+            for f in files:
+                f.close()
+    return results
+
+
+class _StubProcess(object):
+    def __init__(self, args, obj):
+        self._ofile = args[args.index('-o') + 1]
+        self._obj = obj
+        self.returncode = 0
+
+    def communicate(self, input=None):
+        with open(self._ofile, 'wb') as f:
+            f.write(self._obj)
+        return b'', b''
+
+
+class _StubServer(object):
+    """Distccd with a compiler which writes a canned object file"""
+
+    def __init__(self, transport, tmpdir, obj):
+        self._transport = transport
+        self._settings = {'scratch_dir': tmpdir}
+        self._obj = obj
+        self._lsock = None
+        if transport == 'tcp':
+            self._lsock = _listening_socket()
+
+    def _popen(self, args, **kwargs):
+        return _StubProcess(args, self._obj)
+
+    def _handle(self, conn):
+        with conn:
+            Distccd(self._settings, conn, ('bench', 0), None,
+                    popen=self._popen, objcache=None)
+
+    def connect(self):
+        """Client socket and the thread handling the connection"""
+        if self._lsock is None:
+            client, conn = socket.socketpair()
+        else:
+            client = socket.create_connection(self._lsock.getsockname())
+            conn, _ = self._lsock.accept()
+        thread = threading.Thread(target=self._handle, args=(conn,))
+        thread.start()
+        return client, thread
+
+    def close(self):
+        if self._lsock is not None:
+            self._lsock.close()
+
+
+def _exchange_rate(transport, tmpdir, doti_size, obj_size, argc, min_time):
+    doti = os.path.join(tmpdir, 'foo.i')
+    with open(doti, 'wb') as f:
+        f.write(b'x'*doti_size)
+    ofile = os.path.join(tmpdir, 'foo.o')
+    args = ['gcc', '-c', '-o', 'foo.o', 'foo.c']
+    args += ['-DMACRO_{}=1'.format(n) for n in range(argc)]
+    server = _StubServer(transport, os.path.join(tmpdir, 'scratch'),
+                         os.urandom(obj_size))
+
+    def run(count):
+        for _ in range(count):
+            conn, thread = server.connect()
+            with conn:
+                dcc = DccClient(conn, doti, ofile, io.BytesIO(), io.BytesIO())
+                dcc.request(args)
+                if dcc.handle_response() != 0:
+                    raise ProtocolError('stub compiler has failed')
+            thread.join()
+
+    try:
+        return _rate(run, min_time)
+    finally:
+        server.close()
+
+
+def bench_exchange(transport, sizes, argcs, min_time, tmpdir):
+    os.makedirs(os.path.join(tmpdir, 'scratch'), exist_ok=True)
+    payload = {}
+    for size in sizes:
+        # the object file as large as the preprocessed source
+        rate = _exchange_rate(transport, tmpdir, size, size, 8, min_time)
+        payload[_size_label(size)] = {
+            'requests_per_s': rate,
+            'mb_per_s': 2*rate*size/MB,
+        }
+    argv = {}
+    for argc in argcs:
+        rate = _exchange_rate(transport, tmpdir, KB, KB, argc, min_time)
+        argv[str(argc)] = {'requests_per_s': rate}
+    return {'payload': payload, 'argc': argv}
+
+
+def measure(sizes=DEFAULT_SIZES, argcs=DEFAULT_ARGC, transports=TRANSPORTS,
+            min_time=0.3):
+    results = {'codec': bench_codec(min_time), 'transfer': {}, 'exchange': {}}
+    with tempfile.TemporaryDirectory(prefix='pdistcc-bench-') as tmpdir:
+        for transport in transports:
+            results['transfer'][transport] = bench_transfer(
+                transport, sizes, min_time, tmpdir)
+            results['exchange'][transport] = bench_exchange(
+                transport, sizes, argcs, min_time, tmpdir)
+    return results
+
+
+def _rates(results, path=()):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _rates(value, path + (key,))
+        else:
+            yield path + (key,), value
+
+
+def regressions(results, baseline, tolerance):
+    """Rates lower than the baseline ones by more than the tolerance"""
+    base = dict(_rates(baseline))
+    failed = []
+    for path, rate in _rates(results):
+        if path in base and rate < (1 - tolerance)*base[path]:
+            failed.append(('/'.join(path), rate, base[path]))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', dest='sizes', type=_parse_size,
+                        action='append', metavar='SIZE',
+                        help='payload size, e.g. 64K (default: 1K to 64M)')
+    parser.add_argument('--argc', dest='argcs', type=int, action='append',
+                        help='number of compiler arguments')
+    parser.add_argument('--transport', choices=TRANSPORTS, action='append',
+                        help='transport to measure (default: all)')
+    parser.add_argument('--min-time', type=float, default=0.3, metavar='S',
+                        help='time to run every benchmark for')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('--baseline', metavar='JSON',
+                        help='results (--json) to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown relative to the baseline')
+    args = parser.parse_args()
+    results = measure(args.sizes or DEFAULT_SIZES,
+                      args.argcs or DEFAULT_ARGC,
+                      args.transport or TRANSPORTS,
+                      args.min_time)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for path, rate in _rates(results):
+            print('{:60} {:14.1f}'.format(' '.join(path), rate))
+    if args.baseline is None:
+        return
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    failed = regressions(results, baseline, args.tolerance)
+    for path, rate, base in failed:
+        print('{}: {:.1f}, baseline {:.1f}'.format(path, rate, base),
+              file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
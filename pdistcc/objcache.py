@@ -0,0 +1,231 @@
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+from .inodecache import hash_inode
+from .net import (
+    DCC_TOKEN_HEADER_LEN,
+    dcc_decode,
+    dcc_encode,
+)
+
+OBJCACHE_VERSION = 1
+INO_KIND_COMPILER = 3
+DEFAULT_CACHE_DIR = '~/.cache/pdistcc/objects'
+DEFAULT_MAX_SIZE = 5*1024*1024*1024
+# after an eviction the cache is shrunk to this fraction of max_size,
+# so the directory is not rescanned on every subsequent store
+EVICT_LOW_WATERMARK = 0.9
+
+# the inter-process lock does not exclude threads of the same process,
+# pdistccd compiles in many threads
+_account_lock = threading.Lock()
+
+
+def compiler_identity(compiler):
+    path = compiler if os.path.isabs(compiler) else shutil.which(compiler)
+    if path is None or not os.path.isfile(path):
+        return None
+    path = os.path.realpath(path)
+    return '{}:{}'.format(path, hash_inode(path, INO_KIND_COMPILER))
+
+
+def cache_key(doti_digest, compiler_cmd, compiler_id):
+    hsh = hashlib.new('sha256')
+    hsh.update(OBJCACHE_VERSION.to_bytes(2, 'little'))
+    hsh.update(compiler_id.encode('utf-8'))
+    hsh.update(b'\0')
+    for arg in compiler_cmd:
+        argbytes = arg.encode('utf-8')
+        hsh.update(len(argbytes).to_bytes(4, 'little'))
+        hsh.update(argbytes)
+    hsh.update(doti_digest)
+    return hsh.hexdigest()
+
+
+def doti_hash():
+    return hashlib.new('sha256')
+
+
+class DigestWriter:
+    """File-like object hashing the data written through it"""
+
+    def __init__(self, fobj, hsh):
+        self._fobj = fobj
+        self._hsh = hsh
+
+    def write(self, data):
+        self._hsh.update(data)
+        return self._fobj.write(data)
+
+    def digest(self):
+        return self._hsh.digest()
+
+
+def _read_field(f):
+    name, size = dcc_decode(f.read(DCC_TOKEN_HEADER_LEN))
+    return name, size
+
+
+class CacheEntry:
+    def __init__(self, returncode, stdout, stderr, obj, object_size):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.object = obj
+        self.object_size = object_size
+
+
+class CacheDir:
+    """Files under the subdirectories of cachedir, the least recently
+    used (by mtime) are removed once their total size exceeds max_size.
+
+    The total is kept in the size file of cachedir, the directory is
+    rescanned only if that file is missing. Files which names start with
+    .tmp are not counted.
+    """
+
+    def __init__(self, cachedir, max_size):
+        self._basedir = cachedir
+        self._max_size = max_size
+        self._size_file = os.path.join(cachedir, 'size')
+        # imported on demand to keep the client start up fast
+        import fasteners
+        self._lock = fasteners.InterProcessLock(os.path.join(cachedir, 'lock'))
+        os.makedirs(cachedir, exist_ok=True)
+
+    def _path_by_key(self, key):
+        return os.path.join(self._basedir, key[:2], key)
+
+    def _replace(self, tmp_path, path, size):
+        """Move tmp_path of size bytes to path and account for it"""
+        # an entry in place but not accounted for yet would be
+        # counted twice by a concurrent rescan of the cache
+        with _account_lock, self._lock:
+            try:
+                size -= os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self._account(size)
+
+    def _read_size(self):
+        try:
+            with open(self._size_file, 'r') as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_size(self, size):
+        tmp_path = self._size_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(size))
+        os.replace(tmp_path, self._size_file)
+
+    def _account(self, delta):
+        # called with the locks held
+        size = self._read_size()
+        if size is None:
+            size = self._evict(self._max_size)
+        else:
+            size += delta
+        if size > self._max_size:
+            size = self._evict(int(self._max_size*EVICT_LOW_WATERMARK))
+        self._write_size(size)
+
+    def _entries(self):
+        for subdir in os.scandir(self._basedir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.startswith('.tmp'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield st.st_mtime_ns, st.st_size, entry.path
+
+    def _evict(self, target_size):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+class ObjectCache(CacheDir):
+    """Content addressed cache of compilation results.
+
+    Every entry is a single file holding the STAT, SERR, SOUT and DOTO
+    fields in the wire format. Entries are evicted in the LRU order
+    (a cache hit bumps the entry mtime) once the total size of the cache
+    exceeds max_size.
+    """
+
+    def __init__(self, cachedir, max_size=DEFAULT_MAX_SIZE):
+        super().__init__(cachedir, max_size)
+
+    @contextmanager
+    def lookup(self, key):
+        path = self._path_by_key(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            yield None
+            return
+        try:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # evicted concurrently, the open file is still valid
+                pass
+            _, ret = _read_field(f)
+            _, serr_len = _read_field(f)
+            stderr = f.read(serr_len)
+            _, sout_len = _read_field(f)
+            stdout = f.read(sout_len)
+            _, doto_len = _read_field(f)
+            yield CacheEntry(ret, stdout, stderr, f, doto_len)
+        finally:
+            f.close()
+
+    def store(self, key, ret, stdout, stderr, doto, doto_len):
+        path = self._path_by_key(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                f.write(dcc_encode('STAT', ret))
+                f.write(dcc_encode('SERR', len(stderr)))
+                f.write(stderr)
+                f.write(dcc_encode('SOUT', len(stdout)))
+                f.write(stdout)
+                f.write(dcc_encode('DOTO', doto_len))
+                shutil.copyfileobj(doto, f)
+                size = f.tell()
+            self._replace(tmp_path, path, size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def object_cache(settings):
+    cfg = settings.get('object_cache')
+    if not cfg:
+        return None
+    cachedir = os.path.expanduser(cfg.get('dir', DEFAULT_CACHE_DIR))
+    return ObjectCache(cachedir, cfg.get('max_size', DEFAULT_MAX_SIZE))
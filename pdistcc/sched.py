@@ -1,10 +1,260 @@
+import os
+import os.path
+import threading
+import time
+import zlib
 
-from uhashring import HashRing
+try:
+    import fcntl
+except ImportError:
+    # Windows, use fasteners
+    fcntl = None
 
+DEFAULT_LOCK_DIR = '~/.cache/pdistcc/lock'
+LEASE_RETRY_MIN = 0.01
+LEASE_RETRY_MAX = 0.5
+# seconds a failed host is skipped for, doubled on every failure in a row
+BACKOFF_MIN = 5
+BACKOFF_MAX = 300
 
-def pick_server(servers, key):
-    if len(servers) == 1:
-        return servers[0]
-    # HashRing does not accept list of distcs
-    _servers = dict((n, s) for n, s in enumerate(servers))
-    return _servers[HashRing(_servers).get_node(key)]
+# fcntl locks are per process, so threads of the same process would
+# happily share a slot. Keep track of the slots leased by this process.
+_leased = set()
+_leased_lock = threading.Lock()
+
+
+def is_localhost(host):
+    return host['host'] == 'localhost'
+
+
+def _affinity(host, key):
+    # rendezvous hashing: the same command prefers the same server (and
+    # hits its object cache) as long as the server has a free slot
+    name = '{}:{}'.format(host['host'], host.get('port')).encode('utf-8')
+    return zlib.crc32(repr(key).encode('utf-8'), zlib.crc32(name))
+
+
+class _FileLock:
+    """Exclusive lock of a file, released when the process exits.
+
+    Same as fasteners.InterProcessLock, which takes long to import.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.lockf(fd, flags)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        # closing the file drops the lock
+        os.close(self._fd)
+        self._fd = None
+
+
+def _backoff_delay(failures):
+    return min(BACKOFF_MIN*2**(failures - 1), BACKOFF_MAX)
+
+
+def file_lock(path):
+    """Lock of the file shared by all processes, see _FileLock"""
+    if fcntl is None:
+        import fasteners
+        return fasteners.InterProcessLock(path)
+    return _FileLock(path)
+
+
+class SlotLease:
+    """A job slot on a host, held until released"""
+
+    def __init__(self, host, slot, path, lock):
+        self.host = host
+        self.slot = slot
+        self._path = path
+        self._lock = lock
+
+    def release(self):
+        if self._lock is None:
+            return
+        self._lock.release()
+        self._lock = None
+        with _leased_lock:
+            _leased.discard(self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class Scheduler:
+    """Lease job slots on the hosts.
+
+    Every host has `weight` slots, each slot is a lock file shared by
+    all pdistcc processes of the user. Like distcc the first slots of
+    all hosts are tried before the second ones, so the jobs are spread
+    over the hosts in proportion to their weights.
+
+    Hosts which have failed are skipped by all processes for a while
+    (see host_failed), the state is kept in files next to the slots.
+
+    Heavy jobs pass the hosts in the order to try them (see
+    pdistcc.history.CostModel): all slots of the fastest host are tried
+    before the next one, and the job polls for a slot more often than
+    light ones do.
+    """
+
+    def __init__(self, hosts, lockdir=DEFAULT_LOCK_DIR, sleep=time.sleep,
+                 clock=time.time):
+        self._hosts = hosts
+        self._lockdir = os.path.expanduser(lockdir)
+        self._sleep = sleep
+        self._clock = clock
+        # hosts this process has found backed off
+        self._backed_off = set()
+        os.makedirs(self._lockdir, exist_ok=True)
+
+    def _host_path(self, prefix, host):
+        name = '{}_{}_{}'.format(prefix, host['host'], host.get('port', 0))
+        return os.path.join(self._lockdir, name)
+
+    def _slot_path(self, host, slot):
+        return '{}_{}'.format(self._host_path('slot', host), slot)
+
+    def _read_backoff(self, host):
+        """(failures in a row, time until the host is skipped) or None"""
+        try:
+            with open(self._host_path('backoff', host), 'r') as f:
+                failures, until = f.read().split()
+            return int(failures), float(until)
+        except (OSError, ValueError):
+            return None
+
+    def _write_backoff(self, host, failures, until):
+        path = self._host_path('backoff', host)
+        tmp = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            f.write('{} {:.3f}'.format(failures, until))
+        os.replace(tmp, path)
+
+    def host_failed(self, host):
+        """Skip the host for a while, longer if it keeps failing"""
+        # concurrent failures might be counted once, that's fine
+        state = self._read_backoff(host)
+        failures = state[0] + 1 if state is not None else 1
+        self._write_backoff(host, failures,
+                            self._clock() + _backoff_delay(failures))
+        self._backed_off.add(self._host_path('backoff', host))
+
+    def host_ok(self, host):
+        path = self._host_path('backoff', host)
+        if path not in self._backed_off:
+            return
+        self._backed_off.discard(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _available_hosts(self, exclude):
+        now = self._clock()
+        hosts = []
+        for host in self._hosts:
+            if host in exclude or host['weight'] == 0:
+                continue
+            state = self._read_backoff(host)
+            if state is not None:
+                self._backed_off.add(self._host_path('backoff', host))
+                if now < state[1]:
+                    continue
+            hosts.append(host)
+        return hosts
+
+    def _probe(self, host):
+        # The backoff period of the host is over and this process is
+        # going to try it. Other processes keep skipping the host until
+        # this attempt is over, so a dead host gets a single job.
+        state = self._read_backoff(host)
+        if state is not None:
+            failures, _ = state
+            self._write_backoff(host, failures,
+                                self._clock() + _backoff_delay(failures))
+
+    def _try_slot(self, host, slot):
+        path = self._slot_path(host, slot)
+        with _leased_lock:
+            if path in _leased:
+                return None
+            lock = file_lock(path)
+            if not lock.acquire(blocking=False):
+                return None
+            _leased.add(path)
+        return SlotLease(host, slot, path, lock)
+
+    def _try_ordered(self, hosts, order):
+        for host in [h for h in order if h in hosts]:
+            for slot in range(host['weight']):
+                lease = self._try_slot(host, slot)
+                if lease is not None:
+                    return lease
+        return None
+
+    def _try_hosts(self, key, hosts, order=None):
+        if order is not None:
+            lease = self._try_ordered(hosts, order)
+            if lease is not None:
+                if self._host_path('backoff', lease.host) in self._backed_off:
+                    self._probe(lease.host)
+                return lease
+            hosts = [h for h in hosts if h not in order]
+        hosts = sorted(hosts, key=lambda h: _affinity(h, key))
+        max_weight = max((h['weight'] for h in hosts), default=0)
+        for slot in range(max_weight):
+            for host in hosts:
+                if slot >= host['weight']:
+                    continue
+                lease = self._try_slot(host, slot)
+                if lease is not None:
+                    if self._host_path('backoff', host) in self._backed_off:
+                        self._probe(host)
+                    return lease
+        return None
+
+    def try_lease(self, key, exclude=(), order=None):
+        return self._try_hosts(key, self._available_hosts(exclude), order)
+
+    def lease(self, key, exclude=(), order=None):
+        """Wait for a free slot, None if there are no hosts to pick from
+        (all of them are excluded or backed off)"""
+        delay = LEASE_RETRY_MIN
+        while True:
+            hosts = self._available_hosts(exclude)
+            if not hosts:
+                return None
+            lease = self._try_hosts(key, hosts, order)
+            if lease is not None:
+                return lease
+            self._sleep(delay)
+            if order is None:
+                # heavy jobs keep polling often to get the next free slot
+                delay = min(2*delay, LEASE_RETRY_MAX)
+
+    def lease_local(self, key):
+        """Wait for a slot of localhost to compile on, None if localhost
+        is not one of the hosts"""
+        remote = [h for h in self._hosts if not is_localhost(h)]
+        return self.lease(key, exclude=remote)
+
+
+def scheduler(hosts, settings):
+    return Scheduler(hosts, settings.get('lock_dir', DEFAULT_LOCK_DIR))
@@ -1,38 +1,120 @@
 
+import asyncio
+import concurrent.futures
 import copy
+import io
 import logging
-import multiprocessing
 import os
+import shutil
+import socket
 import tempfile
+import threading
 import time
 import socketserver
 import subprocess
 
+from .compression import (
+    DEFAULT_CODEC,
+    UnsupportedCodec,
+    available_codecs,
+    get_codec,
+    get_codec_by_id,
+)
 from .net import (
+    CHUNKED_REPLY,
+    DCC_TOKEN_HEADER_LEN,
+    DCC_VERSION,
+    DCC_VERSION_COMPRESSED,
+    DCC_VERSION_PUMP,
     FileOpsFactory,
+    INVENTORY_VERSION,
     InvalidToken,
+    MPLX_VERSION,
+    ProtocolError,
+    chunked_read_decompress,
     chunked_read_write,
-    chunked_send,
+    compress_file,
     dcc_encode,
     read_field,
+    read_token,
+    receive_chunks,
+    receive_file,
+    send_buffers,
+    send_compressed_chunks,
+    send_file,
     to_string,
 )
 
 from .compiler import find_compiler_wrapper
+from .compiler.errors import (
+    UnsupportedCompiler,
+    UnsupportedCompilationMode,
+)
+from .inventory import (
+    encode_inventory,
+    server_inventory,
+)
+from .load import LoadMonitor
+from .metrics import (
+    ServerMetrics,
+    serve_metrics,
+)
+from .objcache import (
+    DigestWriter,
+    cache_key,
+    compiler_identity,
+    doti_hash,
+    object_cache,
+)
 
-DCC_PROTOCOL = 1
+DCC_PROTOCOLS = (DCC_VERSION, DCC_VERSION_COMPRESSED, DCC_VERSION_PUMP)
+LISTEN_BACKLOG = 128
+SCRATCH_PREFIX = 'pdistccd-'
+# scratch files left by a killed daemon are removed on startup. Another
+# daemon might share the scratch directory, so only old files are removed.
+STALE_SCRATCH_AGE = 3600
+# how long a rejected client may keep sending its request
+BUSY_DRAIN_TIMEOUT = 10
+# jobs in flight on a single multiplexed connection
+MAX_CONNECTION_JOBS = 16
 logger = logging.getLogger(__name__)
 
 
+class RejectedJob(ProtocolError):
+    """The job can't be compiled, the rest of its request is still to be
+    read"""
+
+
+class _NullWriter:
+    def write(self, data):
+        return len(data)
+
+
 class Distccd(socketserver.BaseRequestHandler):
     def __init__(self, settings, *args, **kwargs):
         # XXX: super().__init__ calls handle(), which uses _settings
         self._settings = settings
         self._fileops = kwargs.get('fileops', FileOpsFactory())
         self._tempfile = kwargs.get('tempfile', tempfile.NamedTemporaryFile)
+        self._mkdtemp = kwargs.get('mkdtemp', tempfile.mkdtemp)
         self._Popen = kwargs.get('popen', subprocess.Popen)
+        self._objcache = kwargs.get('objcache', object_cache(settings))
+        self._scratch_dir = settings.get('scratch_dir')
+        self._from_stdin = settings.get('compile_from_stdin', False)
+        self._metrics = kwargs.get('metrics')
+        # encoded compiler inventory, the INVQ query is refused if None
+        self._inventory = kwargs.get('inventory')
         self._perf = Perf()
-        for arg in ('fileops', 'tempfile', 'popen'):
+        self._protocol_version = DCC_VERSION
+        self._codec = None
+        # the client accepts the object file in compressed chunks
+        self._chunked_reply = False
+        # set for every job of a multiplexed connection
+        self._job_id = None
+        self._reply_prefix = b''
+        self._write_lock = threading.Lock()
+        for arg in ('fileops', 'tempfile', 'mkdtemp', 'popen', 'objcache',
+                    'metrics', 'inventory'):
             if arg in kwargs:
                 del kwargs[arg]
         super().__init__(*args, **kwargs)
@@ -48,117 +130,433 @@ class Distccd(socketserver.BaseRequestHandler):
         return compiler_cmd
 
     def _read_request(self):
-        hello, tlen, _ = read_field(self.request, False)
+        hello, version, _ = read_field(self.request, False)
         if hello != b'DIST':
             raise InvalidToken("client hasn't sent a valid greeting")
+        if version not in DCC_PROTOCOLS:
+            raise ProtocolError('unsupported protocol version {}'.format(version))
+        self._protocol_version = version
         argc_name, argc, _ = read_field(self.request, False)
+        codec_error = None
+        if version >= DCC_VERSION_COMPRESSED:
+            try:
+                if argc_name == b'COMP':
+                    codec_id = argc
+                    argc_name, argc, _ = read_field(self.request, False)
+                    self._codec = get_codec_by_id(codec_id)
+                else:
+                    # distcc: LZO, requires python-lzo
+                    self._codec = get_codec(DEFAULT_CODEC)
+                logger.debug('%s: using %s compression', self.client_address, self._codec.name)
+            except UnsupportedCodec as e:
+                codec_error = e
         if argc_name != b'ARGC':
             raise InvalidToken("expected ARGC, got {}", to_string(argc_name))
         compiler_cmd = self._read_compiler_cmd(argc)
+        if codec_error is not None:
+            raise RejectedJob(str(codec_error))
         return compiler_cmd
 
-    def _read_doti(self):
+    def _receive_doti(self, name, doti_bytes, fobj):
+        hsh = doti_hash() if self._objcache is not None else None
+        out = fobj if hsh is None else DigestWriter(fobj, hsh)
+        if name == b'DOTC':
+            self._chunked_reply = bool(doti_bytes & CHUNKED_REPLY)
+            doti_bytes = receive_chunks(self.request, out, self._codec)
+        elif self._codec is not None:
+            chunked_read_decompress(self.request, out, doti_bytes, self._codec)
+        else:
+            receive_file(self.request, fobj, doti_bytes, hsh)
+        digest = hsh.digest() if hsh is not None else None
+        return doti_bytes, digest
+
+    def _read_doti(self, in_memory=False):
         start_time = time.perf_counter()
         name, doti_bytes, _ = read_field(self.request, False)
-        if name != b'DOTI':
+        if name not in (b'DOTI', b'DOTC'):
             raise InvalidToken("expected DOTI, got {}", to_string(name))
         logger.debug('%s: reading doti file', self.client_address)
-        with self._tempfile(suffix='.ii', delete=False) as doti:
-            path = doti.name
-            chunked_read_write(self.request, doti.file, doti_bytes)
-            doti.flush()
+        path, data = None, None
+        if in_memory:
+            buf = io.BytesIO()
+            doti_bytes, digest = self._receive_doti(name, doti_bytes, buf)
+            data = buf.getvalue()
+        else:
+            with self._tempfile(prefix=SCRATCH_PREFIX, suffix='.ii',
+                                dir=self._scratch_dir, delete=False) as doti:
+                path = doti.name
+                doti_bytes, digest = self._receive_doti(name, doti_bytes, doti.file)
+                doti.flush()
         self._perf.recv_time = (time.perf_counter() - start_time)*1000
         self._perf.recv_size = doti_bytes
         logger.debug('%s: successfully read %s bytes', self.client_address, doti_bytes)
-        return path
+        return path, data, digest
 
-    def _compile(self, wrapper, cleanup_files):
+    def _read_pump_files(self, root):
+        start_time = time.perf_counter()
+        name, _, cdir = read_field(self.request)
+        if name != b'CDIR':
+            raise InvalidToken("expected CDIR, got {}", to_string(name))
+        name, nfiles, _ = read_field(self.request, False)
+        if name != b'NFIL':
+            raise InvalidToken("expected NFIL, got {}", to_string(name))
+        recv_size = 0
+        for n in range(nfiles):
+            name, _, path = read_field(self.request)
+            if name != b'NAME':
+                raise InvalidToken("expected NAME, got {}", to_string(name))
+            path = _rooted_path(root, to_string(path))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            name, file_bytes, _ = read_field(self.request, False)
+            if name != b'FILE':
+                raise InvalidToken("expected FILE, got {}", to_string(name))
+            with open(path, 'wb') as f:
+                chunked_read_decompress(self.request, f, file_bytes, self._codec)
+            recv_size += file_bytes
+        cwd = _rooted_path(root, to_string(cdir))
+        os.makedirs(cwd, exist_ok=True)
+        self._perf.recv_time = (time.perf_counter() - start_time)*1000
+        self._perf.recv_size = recv_size
+        logger.debug('%s: received %s files', self.client_address, nfiles)
+        return cwd
+
+    def _skip_files(self):
+        """Read and drop the files of a rejected request"""
+        null = _NullWriter()
+        if self._protocol_version != DCC_VERSION_PUMP:
+            name, doti_bytes, _ = read_field(self.request, False)
+            if name == b'DOTC':
+                receive_chunks(self.request, null)
+            elif name == b'DOTI':
+                chunked_read_write(self.request, null, doti_bytes)
+            else:
+                raise InvalidToken("expected DOTI, got {}", to_string(name))
+            return
+        name, _, _ = read_field(self.request)
+        if name != b'CDIR':
+            raise InvalidToken("expected CDIR, got {}", to_string(name))
+        name, nfiles, _ = read_field(self.request, False)
+        if name != b'NFIL':
+            raise InvalidToken("expected NFIL, got {}", to_string(name))
+        for n in range(nfiles):
+            name, _, _ = read_field(self.request)
+            if name != b'NAME':
+                raise InvalidToken("expected NAME, got {}", to_string(name))
+            name, file_bytes, _ = read_field(self.request, False)
+            if name != b'FILE':
+                raise InvalidToken("expected FILE, got {}", to_string(name))
+            chunked_read_write(self.request, null, file_bytes)
+
+    def _set_object_file(self, wrapper, cleanup_files):
         objext = '.' + wrapper.object_file().split('.')[-1]
         objname = os.path.basename(wrapper.object_file())
 
-        # XXX: perhaps this is racy
-        with self._tempfile(prefix=objname, suffix=objext) as f:
+        # keep the file so the name can't be reused by someone else,
+        # the compiler overwrites it
+        with self._tempfile(prefix=SCRATCH_PREFIX + objname, suffix=objext,
+                            dir=self._scratch_dir, delete=False) as f:
             objfile = f.name
         wrapper.set_object_file(objfile)
         cleanup_files.append(objfile)
+        return objfile
 
+    def _cache_key(self, wrapper, doti_digest):
+        if self._objcache is None:
+            return None
         compiler_cmd = wrapper.compiler_cmd()
+        compiler_id = compiler_identity(compiler_cmd[0])
+        if compiler_id is None:
+            return None
+        # temporary file names differ between requests
+        temp_paths = (
+            (wrapper.preprocessed_file(), '@DOTI@'),
+            (wrapper.object_file(), '@DOTO@'),
+        )
+        for path, placeholder in temp_paths:
+            if path is None or path == '-':
+                continue
+            compiler_cmd = [a.replace(path, placeholder) for a in compiler_cmd]
+        return cache_key(doti_digest, compiler_cmd, compiler_id)
+
+    def _reply_from_cache(self, key):
+        with self._objcache.lookup(key) as entry:
+            if entry is None:
+                return False
+            logger.debug('%s: cache hit %s', self.client_address, key)
+            self._perf.cache_hit = True
+            self._send_reply(entry.returncode, entry.stdout, entry.stderr,
+                             entry.object, entry.object_size)
+            return True
+
+    def _store_in_cache(self, key, ret, stdout, stderr, objfile):
+        with self._fileops.open(objfile, 'rb') as doto:
+            doto_len = self._fileops.size(doto)
+            self._objcache.store(key, ret, stdout, stderr, doto, doto_len)
+
+    def _compile(self, compiler_cmd, cwd=None, doti_data=None):
         logger.debug('%s: running compiler: %s', self.client_address, str(compiler_cmd))
         start_time = time.perf_counter()
         compiler = self._Popen(compiler_cmd,
+                               cwd=cwd,
+                               stdin=subprocess.PIPE if doti_data is not None else None,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
-        stdout, stderr = compiler.communicate()
-        self._perf.compile_time = (time.perf_counter() - start_time)*1000
+        stdout, stderr = compiler.communicate(input=doti_data)
+        compile_time = (time.perf_counter() - start_time)*1000
+        if isinstance(compiler, SlotProcess):
+            # waiting for a free compile slot is not compiling
+            self._perf.queue_time = compiler.queue_time
+            compile_time -= compiler.queue_time
+        self._perf.compile_time = compile_time
         ret = compiler.returncode
         logger.debug('%s: compiler returned: %s', self.client_address, ret)
-        return ret, stdout, stderr, objfile
+        return ret, stdout, stderr
 
-    def _reply(self, ret, stdout, stderr, objfile):
+    def _send_reply(self, ret, stdout, stderr, doto, doto_len):
         logging.debug('%s: sending reply', self.client_address)
         start_time = time.perf_counter()
-        buf = dcc_encode('DONE', DCC_PROTOCOL)
-        buf += dcc_encode('STAT', ret)
-        buf += dcc_encode('SERR', len(stderr))
-        self.request.sendall(buf)
-        self.request.sendall(stderr)
-        self.request.sendall(dcc_encode('SOUT', len(stdout)))
-        self.request.sendall(stdout)
+        chunked = (self._chunked_reply and self._codec is not None
+                   and doto_len > 0)
+        # compress before taking the write lock
+        data = None
+        if self._codec is not None and doto_len > 0 and not chunked:
+            data = compress_file(self._codec, doto, doto_len)
+            doto_len = len(data)
+        buf = [
+            self._reply_prefix
+            + dcc_encode('DONE', self._protocol_version)
+            + dcc_encode('STAT', ret)
+            + dcc_encode('SERR', len(stderr)),
+            stderr,
+            dcc_encode('SOUT', len(stdout)),
+            stdout,
+            dcc_encode('DOTC', 0) if chunked else dcc_encode('DOTO', doto_len),
+        ]
+        # replies of a multiplexed connection must not interleave
+        with self._write_lock:
+            if chunked:
+                doto_len = send_compressed_chunks(self.request, doto, doto_len,
+                                                  self._codec, buf)
+            elif data is not None:
+                send_buffers(self.request, buf + [data])
+            elif doto_len > 0:
+                send_file(self.request, doto, doto_len, buf)
+            else:
+                send_buffers(self.request, buf)
+        self._perf.send_time = (time.perf_counter() - start_time)*1000
+        self._perf.send_size = doto_len
+        self._perf.returncode = ret
+        logger.debug('%s: successfully sent %s bytes', self.client_address, doto_len)
 
+    def _reply(self, ret, stdout, stderr, objfile):
+        if ret != 0:
+            # the object file (if any) is stale or incomplete
+            self._send_reply(ret, stdout, stderr, None, 0)
+            return
         try:
             with self._fileops.open(objfile, 'rb') as doto:
                 doto_len = self._fileops.size(doto)
-                self.request.sendall(dcc_encode('DOTO', doto_len))
                 logger.debug('%s: sending object file %s', self.client_address, objfile)
-                chunked_send(self.request, doto, doto_len)
-                self._perf.send_time = (time.perf_counter() - start_time)*1000
-                self._perf.send_size = doto_len
-                logger.debug('%s: successfully sent %s bytes', self.client_address, doto_len)
+                self._send_reply(ret, stdout, stderr, doto, doto_len)
         except FileNotFoundError:
-            if ret != 0:
-                self.request.sendall(dcc_encode('DOTO', 0))
-            else:
-                raise RuntimeError("compiler failed to produce '%s' file" % objfile)
+            raise RuntimeError("compiler failed to produce '%s' file" % objfile)
+
+    def _receive_job(self, cleanup_files, cleanup_dirs):
+        compiler_cmd = self._read_request()
+        wrapper = find_compiler_wrapper(compiler_cmd, self._settings)
+        wrapper.can_handle_command()
+        if self._protocol_version == DCC_VERSION_PUMP:
+            root = self._mkdtemp(prefix=SCRATCH_PREFIX, suffix='.pump',
+                                 dir=self._scratch_dir)
+            cleanup_dirs.append(root)
+            cwd = self._read_pump_files(root)
+            objfile = self._set_object_file(wrapper, cleanup_files)
+            return wrapper.pump_compiler_cmd(root), cwd, None, objfile, None
+        in_memory = self._from_stdin and wrapper.can_read_stdin()
+        doti_file, doti_data, doti_digest = self._read_doti(in_memory)
+        if in_memory:
+            doti_file = '-'
+        else:
+            cleanup_files.append(doti_file)
+        wrapper.set_preprocessed_file(doti_file)
+        objfile = self._set_object_file(wrapper, cleanup_files)
+        key = self._cache_key(wrapper, doti_digest)
+        return wrapper.compiler_cmd(), None, doti_data, objfile, key
+
+    def _run_job(self, compiler_cmd, cwd, doti_data, objfile, key):
+        if key is None or not self._reply_from_cache(key):
+            ret, stdout, stderr = self._compile(compiler_cmd, cwd, doti_data)
+            self._reply(ret, stdout, stderr, objfile)
+            if key is not None and ret == 0:
+                self._store_in_cache(key, ret, stdout, stderr, objfile)
 
-    def handle(self):
-        if 'delayed_handle' in self._settings:
-            pass
+    def _cleanup(self, cleanup_files, cleanup_dirs):
+        for p in cleanup_files:
+            if os.path.isfile(p):
+                os.remove(p)
+        for d in cleanup_dirs:
+            shutil.rmtree(d, ignore_errors=True)
+
+    def _handle_job(self):
         start_time = time.perf_counter()
-        logger.info("connection from %s", self.client_address)
         cleanup_files = []
+        cleanup_dirs = []
         try:
-            compiler_cmd = self._read_request()
-            wrapper = find_compiler_wrapper(compiler_cmd, self._settings)
-            wrapper.can_handle_command()
-            doti_file = self._read_doti()
-            cleanup_files.append(doti_file)
-            wrapper.set_preprocessed_file(doti_file)
-            ret, stdout, stderr, objfile = self._compile(wrapper, cleanup_files)
-            self._reply(ret, stdout, stderr, objfile)
+            try:
+                job = self._receive_job(cleanup_files, cleanup_dirs)
+            except (RejectedJob, UnsupportedCompiler,
+                    UnsupportedCompilationMode) as e:
+                # tell the client it's the job, not the server, which is
+                # at fault
+                self._reject(e)
+                return
+            self._run_job(*job)
             self._perf.total_time = (time.perf_counter() - start_time)*1000
             logger.info("%s: request handled: %s", self.client_address, self._perf)
+            if self._metrics is not None:
+                self._metrics.observe(self._perf)
         except BrokenPipeError:
             # client has disconnected, ignore
             pass
         finally:
-            for p in cleanup_files:
-                if os.path.isfile(p):
-                    os.remove(p)
+            self._cleanup(cleanup_files, cleanup_dirs)
+
+    def _finish_job(self, job, cleanup_files, cleanup_dirs, start_time):
+        try:
+            self._run_job(*job)
+            self._perf.total_time = (time.perf_counter() - start_time)*1000
+            logger.info("%s: job %s handled: %s", self.client_address,
+                        self._job_id, self._perf)
+            if self._metrics is not None:
+                self._metrics.observe(self._perf)
+        except BrokenPipeError:
+            pass
+        except Exception:
+            logger.exception('%s: job %s failed', self.client_address, self._job_id)
+            if self._metrics is not None:
+                self._metrics.request_failed()
+            try:
+                with self._write_lock:
+                    self.request.sendall(dcc_encode('JOBE', self._job_id))
+            except OSError:
+                pass
+        finally:
+            self._cleanup(cleanup_files, cleanup_dirs)
+
+    def _reject(self, error):
+        logger.warning('%s: rejecting job %s: %r', self.client_address,
+                       self._job_id, error)
+        if self._metrics is not None:
+            self._metrics.request_failed()
+        self._skip_files()
+        with self._write_lock:
+            # a plain connection has no job id: JOBE00000000
+            self.request.sendall(dcc_encode('JOBE', self._job_id or 0))
+
+    def _new_job(self, job_id):
+        job = copy.copy(self)
+        job._perf = Perf()
+        job._protocol_version = DCC_VERSION
+        job._codec = None
+        job._chunked_reply = False
+        job._job_id = job_id
+        job._reply_prefix = dcc_encode('JOBO', job_id)
+        return job
+
+    def _handle_multiplexed(self):
+        """Many jobs over a single connection.
+
+        The requests are read one by one, each prefixed by JOBI<id>, and
+        compiled concurrently. Replies (prefixed by JOBO<id>) are sent as
+        soon as the job is done, so they might come out of order.
+        """
+        _, version = read_token(self.request, b'MPLX')
+        if version != MPLX_VERSION:
+            raise ProtocolError('unsupported multiplexing version {}'.format(version))
+        max_jobs = self._settings.get('max_connection_jobs') or MAX_CONNECTION_JOBS
+        self.request.sendall(dcc_encode('MPLX', max_jobs))
+        logger.debug('%s: multiplexed connection', self.client_address)
+        # the client doesn't send more than max_jobs requests at once,
+        # so the reader never waits for a worker
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs) as executor:
+            while _peek(self.request, DCC_TOKEN_HEADER_LEN):
+                _, job_id = read_token(self.request, b'JOBI')
+                start_time = time.perf_counter()
+                job = self._new_job(job_id)
+                cleanup_files = []
+                cleanup_dirs = []
+                try:
+                    spec = job._receive_job(cleanup_files, cleanup_dirs)
+                except (RejectedJob, UnsupportedCompiler,
+                        UnsupportedCompilationMode) as e:
+                    # nothing of the job has been received yet but its
+                    # command, the connection goes on with the next one
+                    self._cleanup(cleanup_files, cleanup_dirs)
+                    job._reject(e)
+                    continue
+                except BaseException:
+                    self._cleanup(cleanup_files, cleanup_dirs)
+                    raise
+                executor.submit(job._finish_job, spec, cleanup_files,
+                                cleanup_dirs, start_time)
+
+    def _handle_inventory(self):
+        _, version = read_token(self.request, b'INVQ')
+        if version != INVENTORY_VERSION:
+            raise ProtocolError('unsupported inventory version {}'
+                                .format(version))
+        if self._inventory is None:
+            raise ProtocolError('no compiler inventory')
+        self.request.sendall(dcc_encode('INVR', len(self._inventory))
+                             + self._inventory)
+
+    def handle(self):
+        if 'delayed_handle' in self._settings:
+            pass
+        logger.info("connection from %s", self.client_address)
+        request = _peek(self.request, 4)
+        if request == b'MPLX':
+            self._handle_multiplexed()
+        elif request == b'INVQ':
+            self._handle_inventory()
+        else:
+            self._handle_job()
+
+
+def _peek(sock, size):
+    """Wait for size bytes without consuming them, b'' if the peer has
+    closed the connection"""
+    return sock.recv(size, socket.MSG_PEEK | socket.MSG_WAITALL)
+
+
+def _rooted_path(root, path):
+    path = os.path.normpath(path)
+    if not os.path.isabs(path):
+        raise ProtocolError('expected an absolute path, got {}'.format(path))
+    # normpath has collapsed '..', so the result can't escape the root
+    return os.path.join(root, os.path.relpath(path, '/'))
 
 
 class Perf:
     def __init__(self):
         self._total_time = 0.0
+        self._queue_time = 0.0
         self._compile_time = 0.0
         self._recv_time = 0.0
         self._send_time = 0.0
         self._recv_size = 0
         self._send_size = 0
+        self._cache_hit = False
+        self._returncode = None
 
     @property
     def total_time(self):
         return self._total_time
 
+    @property
+    def queue_time(self):
+        return self._queue_time
+
     @property
     def recv_time(self):
         return self._recv_time
@@ -179,10 +577,22 @@ class Perf:
     def send_size(self):
         return self._send_size
 
+    @property
+    def cache_hit(self):
+        return self._cache_hit
+
+    @property
+    def returncode(self):
+        return self._returncode
+
     @total_time.setter
     def total_time(self, value):
         self._total_time = value
 
+    @queue_time.setter
+    def queue_time(self, value):
+        self._queue_time = value
+
     @compile_time.setter
     def compile_time(self, value):
         self._compile_time = value
@@ -203,23 +613,188 @@ class Perf:
     def send_size(self, value):
         self._send_size = value
 
+    @cache_hit.setter
+    def cache_hit(self, value):
+        self._cache_hit = value
+
+    @returncode.setter
+    def returncode(self, value):
+        self._returncode = value
+
     def __str__(self):
-        return f'total: {self._total_time:.2f}, compile: {self._compile_time:.2f}, recv: {self._recv_time:.2f}, send: {self._send_time:.2f}, recv size: {self._recv_size}, send size: {self._send_size}'
+        return f'total: {self._total_time:.2f}, compile: {self._compile_time:.2f}, recv: {self._recv_time:.2f}, send: {self._send_time:.2f}, queue: {self._queue_time:.2f}, recv size: {self._recv_size}, send size: {self._send_size}, cache hit: {self._cache_hit}'
+
+
+def cleanup_scratch_dir(scratch_dir=None, max_age=STALE_SCRATCH_AGE):
+    scratch_dir = scratch_dir or tempfile.gettempdir()
+    deadline = time.time() - max_age
+    for entry in os.scandir(scratch_dir):
+        if not entry.name.startswith(SCRATCH_PREFIX):
+            continue
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime > deadline:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+class CompileSlots:
+    """Run compilers on the event loop, at most `count` at a time.
+
+    popen() mimics subprocess.Popen, so Distccd (which runs in a worker
+    thread) can use it as is.
+    """
+
+    def __init__(self, loop, count):
+        self._loop = loop
+        self._count = count
+        self._sem = asyncio.Semaphore(count)
+        self.running = 0
+        self.waiting = 0
+
+    @property
+    def count(self):
+        return self._count
+
+    async def _run(self, cmd, cwd, stdin, stdout, stderr, input):
+        self.waiting += 1
+        start_time = self._loop.time()
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        queue_time = (self._loop.time() - start_time)*1000
+        self.running += 1
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd,
+                                                        cwd=cwd,
+                                                        stdin=stdin,
+                                                        stdout=stdout,
+                                                        stderr=stderr)
+            out, err = await proc.communicate(input)
+            return proc.returncode, out, err, queue_time
+        finally:
+            self.running -= 1
+            self._sem.release()
+
+    def popen(self, cmd, cwd=None, stdin=None, stdout=None, stderr=None):
+        return SlotProcess(self, cmd, cwd, stdin, stdout, stderr)
+
+    def run(self, cmd, cwd, stdin, stdout, stderr, input):
+        coro = self._run(cmd, cwd, stdin, stdout, stderr, input)
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+
+class SlotProcess:
+    def __init__(self, slots, cmd, cwd, stdin, stdout, stderr):
+        self._slots = slots
+        self._args = (cmd, cwd, stdin, stdout, stderr)
+        self.returncode = None
+        # ms spent waiting for a free slot
+        self.queue_time = 0.0
+
+    def communicate(self, input=None):
+        self.returncode, out, err, self.queue_time = \
+            self._slots.run(*self._args, input)
+        return out, err
+
+
+def _handle_connection(settings, conn, client_address, slots, metrics=None,
+                       inventory=None, objcache=None):
+    try:
+        Distccd(copy.deepcopy(settings), conn, client_address, None,
+                popen=slots.popen, metrics=metrics, inventory=inventory,
+                objcache=objcache)
+    except ProtocolError as e:
+        logger.warning('%s: rejecting request: %s', client_address, e)
+        if metrics is not None:
+            metrics.request_failed()
+    except Exception:
+        logger.exception('%s: failed to handle request', client_address)
+        if metrics is not None:
+            metrics.request_failed()
+    finally:
+        conn.close()
+
+
+async def _reject_connection(loop, conn, client_address, load, reason):
+    logger.info('%s: rejecting request (%s): %s', client_address, reason, load)
+    try:
+        await loop.sock_sendall(conn, dcc_encode('BUSY', load.queued))
+        conn.shutdown(socket.SHUT_WR)
+        # Drain the request so closing the socket doesn't reset the
+        # connection before the client has read BUSY
+        deadline = loop.time() + BUSY_DRAIN_TIMEOUT
+        while loop.time() < deadline:
+            data = await asyncio.wait_for(loop.sock_recv(conn, 65536),
+                                          deadline - loop.time())
+            if not data:
+                break
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        conn.close()
+
+
+async def serve(settings, host, port):
+    loop = asyncio.get_running_loop()
+    slots = CompileSlots(loop, settings.get('jobs') or os.cpu_count())
+    load = LoadMonitor(slots, settings)
+    metrics = ServerMetrics(slots, load)
+    metrics_server = None
+    if settings.get('metrics_listen'):
+        metrics_host, metrics_port = settings['metrics_listen'].rsplit(':', 1)
+        metrics_server = await serve_metrics(metrics, metrics_host,
+                                             int(metrics_port))
+    compilers = await loop.run_in_executor(None, server_inventory, settings)
+    logger.info('compilers: %s', ', '.join(
+        '{name} {version} ({triplet})'.format(**c) for c in compilers))
+    inventory = encode_inventory(compilers)
+    # shared by the connection threads
+    objcache = object_cache(settings)
+    # connections waiting for a compile slot occupy a worker thread
+    max_connections = settings.get('max_connections') or 4*slots.count
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_connections)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    sock.setblocking(False)
+    logger.info("listening at %s:%s, %s compile slots", host, port, slots.count)
+    rejects = set()
+    try:
+        with sock, executor:
+            while True:
+                conn, client_address = await loop.sock_accept(sock)
+                reason = load.busy()
+                if reason is not None:
+                    metrics.request_rejected()
+                    task = loop.create_task(_reject_connection(
+                        loop, conn, client_address, load, reason))
+                    rejects.add(task)
+                    task.add_done_callback(rejects.discard)
+                    continue
+                conn.setblocking(True)
+                load.connection_opened()
+                fut = loop.run_in_executor(executor, _handle_connection,
+                                           settings, conn, client_address,
+                                           slots, metrics, inventory,
+                                           objcache)
+                fut.add_done_callback(lambda _: load.connection_closed())
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
 
 
 def daemon(settings, host='127.0.0.1', port=3632):
     logging.basicConfig(level=settings['loglevel'],
                         format='%(asctime)-15s %(message)s')
-
-    def distccd_factory(*args, **kwargs):
-        return Distccd(copy.deepcopy(settings), *args, **kwargs)
-
-    socketserver.TCPServer.allow_reuse_address = True
-    socketserver.TCPServer.request_queue_size = multiprocessing.cpu_count() + 1
-    logger.info("listening at %s:%s", host, port)
-    if hasattr(socketserver, 'ForkingTCPServer'):
-        Server = socketserver.ForkingTCPServer
-    else:
-        Server = socketserver.ThreadingTCPServer
-    with Server((host, port), distccd_factory) as server:
-        server.serve_forever()
+    cleanup_scratch_dir(settings.get('scratch_dir'))
+    if DEFAULT_CODEC not in available_codecs():
+        logger.warning('python-lzo is not installed, compressed requests '
+                       'of distcc clients will be rejected')
+    asyncio.run(serve(settings, host, port))
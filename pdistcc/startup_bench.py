@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Measures how long it takes the client to start: the time from exec of
+# pdistcc to the first byte of the request arriving to the server, for
+# a compile job which takes no time at all (fake compiler and server).
+#
+#   python3 -m pdistcc.startup_bench --runs 50
+#
+# Exits with status 1 if the median exceeds the threshold of some mode.
+
+import argparse
+import json
+import os
+import os.path
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from .net import (
+    dcc_encode,
+    read_field,
+    read_token,
+)
+
+MODES = ('direct', 'broker')
+# median time to the first byte, in milliseconds
+DEFAULT_THRESHOLDS = {
+    'direct': 150,
+    'broker': 60,
+}
+FAKE_GCC = '''#!/bin/sh
+# creates empty output files
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-o" ]; then
+        : > "$2"
+        shift
+    fi
+    shift
+done
+'''
+CLIENT = 'import sys; from pdistcc.fastclient import main; main()'
+BROKER = 'import sys; from pdistcc.broker import broker_main; broker_main()'
+
+
+class FakeDistccd(socketserver.BaseRequestHandler):
+    def handle(self):
+        _, version = read_token(self.request, b'DIST')
+        self.server.first_byte.append(time.perf_counter())
+        _, argc = read_token(self.request, b'ARGC')
+        for _ in range(argc):
+            read_field(self.request, b'ARGV')
+        read_field(self.request, b'DOTI')
+        self.request.sendall(b''.join([
+            dcc_encode('DONE', version),
+            dcc_encode('STAT', 0),
+            dcc_encode('SERR', 0),
+            dcc_encode('SOUT', 0),
+            dcc_encode('DOTO', 0),
+        ]))
+
+
+class FakeServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        self.first_byte = []
+        super().__init__(('127.0.0.1', 0), FakeDistccd)
+
+
+def _workdir(tmpdir):
+    bindir = os.path.join(tmpdir, 'bin')
+    os.makedirs(bindir)
+    gcc = os.path.join(bindir, 'gcc')
+    with open(gcc, 'w') as f:
+        f.write(FAKE_GCC)
+    os.chmod(gcc, 0o755)
+    with open(os.path.join(tmpdir, 'foo.c'), 'w') as f:
+        f.write('int foo;\n')
+    return bindir
+
+
+def _env(tmpdir, bindir, port):
+    env = dict(os.environ)
+    pkgdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in [pkgdir, env.get('PYTHONPATH')] if p)
+    env['PATH'] = os.pathsep.join([bindir, env['PATH']])
+    # empty configuration directory: default settings
+    env['PDISTCC_DIR'] = tmpdir
+    env['DISTCC_HOSTS'] = '127.0.0.1:{}/16'.format(port)
+    env.pop('PDISTCC_BROKER', None)
+    return env
+
+
+def _start_broker(env, path):
+    proc = subprocess.Popen([sys.executable, '-c', BROKER, '--socket', path],
+                            env=env)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path):
+        if proc.poll() is not None or time.monotonic() > deadline:
+            proc.kill()
+            raise RuntimeError("broker hasn't started")
+        time.sleep(0.01)
+    return proc
+
+
+def _run_client(server, env, cwd):
+    cmd = [sys.executable, '-c', CLIENT, 'gcc', '-c', '-o', 'foo.o', 'foo.c']
+    start = time.perf_counter()
+    subprocess.run(cmd, env=env, cwd=cwd, check=True)
+    end = time.perf_counter()
+    return server.first_byte[-1] - start, end - start
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    return {
+        'median_ms': 1000*statistics.median(samples),
+        'p90_ms': 1000*samples[int(0.9*(len(samples) - 1))],
+        'min_ms': 1000*samples[0],
+    }
+
+
+def measure(modes=MODES, runs=20, warmup=2):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='pdistcc-bench-') as tmpdir, \
+            FakeServer() as server:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        bindir = _workdir(tmpdir)
+        env = _env(tmpdir, bindir, server.server_address[1])
+        try:
+            for mode in modes:
+                broker = None
+                mode_env = dict(env)
+                if mode == 'broker':
+                    path = os.path.join(tmpdir, 'broker.sock')
+                    broker = _start_broker(env, path)
+                    mode_env['PDISTCC_BROKER'] = path
+                try:
+                    first_byte, total = [], []
+                    for n in range(warmup + runs):
+                        fb, t = _run_client(server, mode_env, tmpdir)
+                        if n >= warmup:
+                            first_byte.append(fb)
+                            total.append(t)
+                finally:
+                    if broker is not None:
+                        broker.terminate()
+                        broker.wait()
+                results[mode] = {
+                    'first_byte': _summary(first_byte),
+                    'total': _summary(total),
+                }
+        finally:
+            server.shutdown()
+    return results
+
+
+def regressions(results, thresholds):
+    failed = []
+    for mode, result in results.items():
+        median = result['first_byte']['median_ms']
+        if median > thresholds[mode]:
+            failed.append((mode, median, thresholds[mode]))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--mode', choices=MODES, action='append',
+                        help='client mode to measure (default: all)')
+    for mode in MODES:
+        parser.add_argument('--max-{}'.format(mode), type=float,
+                            default=DEFAULT_THRESHOLDS[mode], metavar='MS',
+                            help='median time to the first byte threshold')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+    thresholds = dict((mode, getattr(args, 'max_' + mode)) for mode in MODES)
+    results = measure(args.mode or MODES, args.runs)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for mode, result in results.items():
+            for metric in ('first_byte', 'total'):
+                print('{:8} {:12} median: {median_ms:7.1f} ms, '
+                      'p90: {p90_ms:7.1f} ms, min: {min_ms:7.1f} ms'
+                      .format(mode, metric, **result[metric]))
+    failed = regressions(results, thresholds)
+    for mode, median, threshold in failed:
+        print('{}: time to the first byte {:.1f} ms exceeds {} ms'
+              .format(mode, median, threshold), file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
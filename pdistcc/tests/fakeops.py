@@ -1,5 +1,6 @@
 
 import io
+import socket
 
 from contextlib import contextmanager
 
@@ -12,7 +13,12 @@ class FakeSocket(object):
     def send(self, data):
         return self._write.write(data)
 
-    def recv(self, size):
+    def recv(self, size, flags=0):
+        if flags & socket.MSG_PEEK:
+            pos = self._read.tell()
+            data = self._read.read(size)
+            self._read.seek(pos)
+            return data
         return self._read.read(size)
 
     def recv_into(self, buf, size=0):
@@ -38,7 +44,8 @@ class FakeFileOpsFactory(object):
         content = self._vfs.get(name, b'')
         if isinstance(content, bytes):
             f = io.BytesIO(content)
-            self._vfs[name] = f
+            if 'r' not in flags:
+                self._vfs[name] = f
         else:
             f = content
         try:
@@ -76,7 +83,7 @@ class FakeTempFileFactory(object):
         return self._counter
 
     @contextmanager
-    def __call__(self, prefix='', suffix='', delete=True):
+    def __call__(self, prefix='', suffix='', dir=None, delete=True):
         class _dummy(object):
             def __init__(self, name, file):
                 self.name = name
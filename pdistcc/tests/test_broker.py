@@ -0,0 +1,42 @@
+import os
+import sys
+import threading
+
+from ..broker import Broker
+from ..fastclient import run_job
+
+
+def fake_main(argv, settings):
+    sys.stdout.write('{} {} {} {}\n'.format(' '.join(argv), os.getcwd(),
+                                            os.environ['FOO'],
+                                            ' '.join(settings['distcc_hosts'])))
+    return 3
+
+
+def test_broker_runs_job(tmp_path, monkeypatch):
+    path = str(tmp_path / 'broker.sock')
+    settings = {'distcc_hosts': ['a:3632/4'], 'loglevel': 'WARN'}
+    broker = Broker(path, settings, fake_main)
+    thread = threading.Thread(target=broker.serve_forever)
+    thread.start()
+    try:
+        workdir = tmp_path / 'work'
+        workdir.mkdir()
+        monkeypatch.chdir(workdir)
+        monkeypatch.setenv('FOO', 'bar')
+        monkeypatch.setenv('DISTCC_HOSTS', 'b:3632/2 c:3632/2')
+        rd, wr = os.pipe()
+        status = run_job(['gcc', '-c', 'foo.c'], path, fds=(0, wr, 2))
+        os.close(wr)
+        with os.fdopen(rd, 'r') as out:
+            output = out.read()
+        assert status == 3
+        assert output == 'gcc -c foo.c {} bar b:3632/2 c:3632/2\n'.format(workdir)
+    finally:
+        broker.shutdown()
+        thread.join()
+        broker.server_close()
+
+
+def test_broker_not_running(tmp_path):
+    assert run_job(['gcc'], str(tmp_path / 'nonexistent.sock')) is None
@@ -0,0 +1,29 @@
+import pytest
+import shutil
+import subprocess
+
+from ..build_bench import (
+    generate_project,
+    measure,
+)
+
+
+def test_generate_project(tmp_path):
+    sources = generate_project(str(tmp_path), units=3, header_depth=2,
+                               header_size=4, unit_size=2, heavy=1)
+    assert sources == ['src/unit0.cpp', 'src/unit1.cpp', 'src/unit2.cpp',
+                       'src/heavy0.cpp', 'src/main.cpp']
+    with open(str(tmp_path / 'include' / 'level0.h')) as f:
+        assert '#include "level1.h"' in f.read()
+
+
+@pytest.mark.skipif(not shutil.which('make') or not shutil.which('g++'),
+                    reason='needs make and g++')
+def test_build_bench(tmp_path):
+    results = measure(jobs=(2,), units=2, header_depth=1, header_size=2,
+                      unit_size=1, heavy=0, servers=1, tool='make',
+                      workdir=str(tmp_path))
+    [run] = results['runs']
+    assert run['distributed']['makespan'] > 0
+    assert run['servers'][0]['jobs'] == 3
+    assert subprocess.check_output([str(tmp_path / 'project' / 'bench')]) == b'0\n'
@@ -5,6 +5,11 @@ from pytest_mock import mocker
 from unittest.mock import MagicMock
 
 from ..cli import main as client_main
+from ..config import (
+    client_settings,
+    parse_distcc_host,
+    parse_distcc_hosts,
+)
 
 import pdistcc
 
@@ -23,3 +28,48 @@ def test_distcc_host_cmdline(mocker):
         'gcc -c foo.c'.split(),
         {'distcc_hosts': 'a:1111/1 b:2222/2'.split(), 'loglevel': 'WARN'}
     )
+
+
+def test_distcc_host_defaults():
+    assert parse_distcc_host('localhost/8') == {
+        'host': 'localhost', 'port': 3632, 'weight': 8,
+    }
+    assert parse_distcc_host('localhost')['weight'] == 2
+    assert parse_distcc_host('b,zlib') == {
+        'host': 'b', 'port': 3632, 'weight': 4, 'compression': 'zlib',
+    }
+
+
+def test_distcc_host_compression():
+    assert parse_distcc_host('a:1111/4,lzo') == {
+        'host': 'a', 'port': 1111, 'weight': 4, 'compression': 'lzo',
+    }
+
+
+def test_distcc_host_pump():
+    assert parse_distcc_host('a/4,pump,zstd') == {
+        'host': 'a', 'port': 3632, 'weight': 4, 'compression': 'zstd',
+        'pump': True,
+    }
+    # distcc-pump's option, its protocol is not supported
+    assert 'pump' not in parse_distcc_host('a/4,cpp,lzo')
+
+
+def test_client_settings_cache(tmp_path, monkeypatch):
+    confdir = tmp_path / 'conf'
+    confdir.mkdir()
+    (confdir / 'client.json').write_text('{"distcc_hosts": ["a:1111/2"]}')
+    monkeypatch.setenv('PDISTCC_DIR', str(confdir))
+    monkeypatch.setenv('DISTCC_HOSTS', 'b:2222/4')
+    cache = str(tmp_path / 'settings')
+    assert client_settings(cache)['distcc_hosts'] == ['b:2222/4']
+    # DISTCC_HOSTS is a part of the cache key
+    monkeypatch.delenv('DISTCC_HOSTS')
+    assert client_settings(cache)['distcc_hosts'] == ['a:1111/2']
+    # served from the cache along with the parsed hosts
+    monkeypatch.setattr('pdistcc.config._settings', None)
+    monkeypatch.setattr('pdistcc.config._parsed_hosts', {})
+    monkeypatch.setattr('pdistcc.config.parse_distcc_host', None)
+    assert client_settings(cache)['distcc_hosts'] == ['a:1111/2']
+    assert parse_distcc_hosts(['a:1111/2']) == \
+        [{'host': 'a', 'port': 1111, 'weight': 2}]
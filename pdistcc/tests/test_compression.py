@@ -0,0 +1,47 @@
+import io
+import pytest
+
+from ..compression import (
+    UnsupportedCodec,
+    available_codecs,
+    get_codec,
+    get_codec_by_id,
+)
+from ..net import (
+    chunked_read_decompress,
+    compress_file,
+)
+from .fakeops import FakeSocket
+
+
+@pytest.mark.parametrize("name", available_codecs())
+def test_roundtrip(name):
+    codec = get_codec(name)
+    data = b'#include <vector>\nint f(int x) { return x; }\n' * 10000
+    compressed = compress_file(codec, io.BytesIO(data), len(data))
+    assert len(compressed) < len(data)
+    out = io.BytesIO()
+    chunked_read_decompress(FakeSocket(compressed), out, len(compressed), codec,
+                            chunk_size=4096)
+    assert out.getvalue() == data
+
+
+def test_lzo_roundtrip():
+    pytest.importorskip('lzo')
+    codec = get_codec('lzo')
+    data = b'int x;\n' * 100000
+    compressed = compress_file(codec, io.BytesIO(data), len(data))
+    out = io.BytesIO()
+    # a raw LZO block, decompressed at once
+    chunked_read_decompress(FakeSocket(compressed), out, len(compressed), codec,
+                            chunk_size=4096)
+    assert out.getvalue() == data
+
+
+def test_codec_by_id():
+    assert get_codec_by_id(get_codec('zlib').codec_id).name == 'zlib'
+
+
+def test_unknown_codec():
+    with pytest.raises(UnsupportedCodec):
+        get_codec_by_id(42)
@@ -0,0 +1,33 @@
+import pytest
+import subprocess
+import sys
+
+from ..startup_bench import measure
+
+
+def _imported_modules(stmt):
+    script = 'import sys; {}; print(" ".join(sys.modules))'.format(stmt)
+    out = subprocess.check_output([sys.executable, '-c', script])
+    return set(out.decode().split())
+
+
+def test_fastclient_imports():
+    modules = _imported_modules('import pdistcc.fastclient')
+    assert set(m for m in modules if m.startswith('pdistcc')) == \
+        {'pdistcc', 'pdistcc.fastclient'}
+    for heavy in ('json', 'logging', 'argparse', 'subprocess', 'asyncio'):
+        assert heavy not in modules
+
+
+def test_client_imports():
+    modules = _imported_modules('import pdistcc.cli')
+    for heavy in ('asyncio', 'fasteners', 'json', 'pdistcc.server'):
+        assert heavy not in modules
+
+
+@pytest.mark.slow
+def test_startup_bench():
+    results = measure(modes=('direct',), runs=1, warmup=0)
+    assert results['direct']['first_byte']['median_ms'] > 0
+    assert results['direct']['total']['median_ms'] >= \
+        results['direct']['first_byte']['median_ms']
@@ -31,7 +31,8 @@ class TestGCCWrapper(object):
         remote_cmd = wrapper.compiler_cmd()
         assert remote_cmd == 'g++ -c -o foo.o -x c++ foo.ii'.split()
 
-    @pytest.mark.parametrize("arg", ['-DFOO', '-Ibar', '-M', '-MD'])
+    @pytest.mark.parametrize("arg", ['-DFOO', '-Ibar', '-M', '-MD', '-MMD',
+                                     '-MP'])
     def test_omits_preprocessor_args(self, arg):
         cmdline = 'g++ -O2 -c {} -o foo.o foo.cpp'.format(arg).split()
         wrapper = GCCWrapper(cmdline)
@@ -68,7 +69,42 @@ class TestGCCWrapper(object):
         assert wrapper.preprocessed_file() == 'foo.ii'
         assert wrapper.compiler_cmd() == 'g++ -c -o foo.o -x c++ foo.ii'.split()
 
+    def test_skips_MQ_remote(self):
+        cmdline = 'g++ -O2 -c -MQ foo.o -o foo.o foo.cpp'.split()
+        wrapper = GCCWrapper(cmdline)
+        wrapper.can_handle_command()
+        wrapper.preprocessor_cmd()
+        assert wrapper.compiler_cmd() == \
+            'g++ -O2 -c -o foo.o -x c++ foo.ii'.split()
+
     def test_called_for_preprocessing(self):
         cmdline = 'gcc -E -o foo.i foo.c'.split()
         wrapper = GCCWrapper(cmdline)
         assert wrapper.called_for_preprocessing()
+
+    def test_preprocessor_to_stdout(self):
+        cmdline = 'g++ -c -MD -o foo.o foo.cpp'.split()
+        wrapper = GCCWrapper(cmdline)
+        wrapper.can_handle_command()
+        assert wrapper.preprocessor_cmd(to_stdout=True) == \
+            'g++ -E -MD -o - foo.cpp -MF foo.d -MQ foo.o'.split()
+
+    def test_pump_compiler_cmd(self):
+        cmdline = 'g++ -c -I/src/inc -Ilocal -MD -MF foo.d -o foo.o /src/foo.cpp'.split()
+        wrapper = GCCWrapper(cmdline)
+        wrapper.can_handle_command()
+        wrapper.set_object_file('/tmp/foo_1.o')
+        assert wrapper.pump_compiler_cmd('/tmp/root') == [
+            'g++', '-c', '-I/tmp/root/src/inc', '-Ilocal',
+            '-o', '/tmp/foo_1.o', '/tmp/root/src/foo.cpp',
+            '-ffile-prefix-map=/tmp/root=',
+        ]
+
+    def test_write_dependency_file(self, tmp_path):
+        depfile = str(tmp_path / 'foo.d')
+        cmdline = 'g++ -c -MD -MT foo.o -MF {} -o foo.o foo.cpp'.format(depfile).split()
+        wrapper = GCCWrapper(cmdline)
+        wrapper.can_handle_command()
+        wrapper.write_dependency_file(['/src/a.h', '/src/b c.h'])
+        with open(depfile) as f:
+            assert f.read() == 'foo.o: foo.cpp \\\n /src/a.h \\\n /src/b\\ c.h\n'
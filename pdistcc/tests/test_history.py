@@ -0,0 +1,79 @@
+from ..history import (
+    CostModel,
+    History,
+    history,
+)
+
+
+def _hosts():
+    return [
+        {'host': 'fast', 'port': 3632, 'weight': 4},
+        {'host': 'slow', 'port': 3632, 'weight': 4},
+        {'host': 'new', 'port': 3632, 'weight': 4},
+    ]
+
+
+def test_record(tmp_path):
+    jobs = History(str(tmp_path / 'history.sqlite'))
+    jobs.record('/src/a.c', 'gcc', 'fast:3632', 1000, 1.0)
+    jobs.record('/src/a.c', 'gcc', 'fast:3632', 1000, 2.0)
+    jobs.record('/src/a.c', 'g++', 'fast:3632', 1000, 5.0)
+    size, duration = jobs.durations('/src/a.c', 'gcc')['fast:3632']
+    assert size == 1000
+    assert 1.0 < duration < 2.0
+    assert jobs.durations('/src/b.c', 'gcc') == {}
+    rate, duration = jobs.hosts()['fast:3632']
+    assert 0.001 < rate < 0.005
+    # shared by all clients
+    jobs.close()
+    other = History(str(tmp_path / 'history.sqlite'))
+    assert set(other.durations('/src/a.c', 'gcc')) == {'fast:3632'}
+
+
+def test_history_disabled(tmp_path):
+    path = str(tmp_path / 'history.sqlite')
+    hosts = _hosts()
+    assert history(hosts, {'history': None}) is None
+    # a single server, nothing to choose from
+    assert history(hosts[:1] + [{'host': 'localhost', 'weight': 2}],
+                   {'history': path}) is None
+    assert history(hosts, {'history': path}) is not None
+
+
+def test_placement(tmp_path):
+    jobs = History(str(tmp_path / 'history.sqlite'))
+    for n in range(10):
+        tu = '/src/{}.c'.format(n)
+        jobs.record(tu, 'gcc', 'fast:3632', 1000, 1.0)
+        jobs.record(tu, 'gcc', 'slow:3632', 1000, 3.0)
+    jobs.record('/src/big.c', 'gcc', 'slow:3632', 10000, 30.0)
+    model = CostModel(jobs)
+    hosts = _hosts()
+    expected = model.expected('/src/big.c', 'gcc', hosts)
+    # scaled by the speed of the hosts, nothing known about 'new'
+    assert expected['slow:3632'] == 30.0
+    assert 9 < expected['fast:3632'] < 11
+    assert 'new:3632' not in expected
+    assert [h['host'] for h in model.placement('/src/big.c', 'gcc', hosts)] \
+        == ['fast', 'slow', 'new']
+    assert model.duration('/src/big.c', 'gcc', hosts) == expected['fast:3632']
+    # light and unknown jobs are placed as usual
+    assert model.placement('/src/1.c', 'gcc', hosts) is None
+    assert model.placement('/src/unknown.c', 'gcc', hosts) is None
+    assert model.duration('/src/unknown.c', 'gcc', hosts) == model.average()
+
+
+def test_straggler(tmp_path):
+    jobs = History(str(tmp_path / 'history.sqlite'))
+    model = CostModel(jobs)
+    for n in range(19):
+        if n == 9:
+            # too few jobs to tell
+            assert model.straggler('fast:3632', 1000) is None
+        jobs.record('/src/{}.c'.format(n), 'gcc', 'fast:3632', 1000, 1.0 + n)
+    jobs.record('/src/big.c', 'gcc', 'fast:3632', 1500, 100.0)
+    # 19th of the 20 similar jobs
+    assert model.straggler('fast:3632', 1000) == 19.0
+    assert model.straggler('fast:3632', 10000) is None
+    assert model.straggler('slow:3632', 1000) is None
+    assert model.straggler('fast:3632', 0) is None
@@ -0,0 +1,48 @@
+import pytest
+
+from ..compiler.errors import UnsupportedCompilationMode
+from ..compiler.includes import IncludeScanner
+
+
+def _write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    return str(path)
+
+
+def test_scan_finds_nested_headers(tmp_path):
+    src = _write(tmp_path / 'foo.c', '#include "foo.h"\n#include <stdio.h>\n')
+    foo_h = _write(tmp_path / 'inc' / 'foo.h', '#  include <sub/bar.h>\n')
+    bar_h = _write(tmp_path / 'inc' / 'sub' / 'bar.h', '#define BAR 1\n')
+    stdio_h = _write(tmp_path / 'sys' / 'stdio.h', '#include "bar.h"\n')
+    scanner = IncludeScanner([], [str(tmp_path / 'inc')], [str(tmp_path / 'sys')])
+    assert sorted(scanner.scan(src)) == sorted([foo_h, bar_h])
+
+
+def test_scan_ignores_conditionals(tmp_path):
+    src = _write(tmp_path / 'foo.c', '\n'.join([
+        '#if 0',
+        '#include "a.h"',
+        '#endif',
+        '#if __has_include("b.h")',
+        '#endif',
+    ]))
+    a_h = _write(tmp_path / 'a.h', '')
+    b_h = _write(tmp_path / 'b.h', '')
+    scanner = IncludeScanner([], [], [])
+    assert sorted(scanner.scan(src)) == sorted([a_h, b_h])
+
+
+def test_scan_include_next(tmp_path):
+    src = _write(tmp_path / 'foo.c', '#include_next <a.h>\n')
+    a1 = _write(tmp_path / 'one' / 'a.h', '')
+    a2 = _write(tmp_path / 'two' / 'a.h', '')
+    scanner = IncludeScanner([], [str(tmp_path / 'one'), str(tmp_path / 'two')], [])
+    assert sorted(scanner.scan(src)) == sorted([a1, a2])
+
+
+def test_scan_rejects_computed_include(tmp_path):
+    src = _write(tmp_path / 'foo.c', '#include HEADER\n')
+    scanner = IncludeScanner([], [], [])
+    with pytest.raises(UnsupportedCompilationMode):
+        scanner.scan(src)
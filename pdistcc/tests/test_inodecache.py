@@ -0,0 +1,107 @@
+import multiprocessing
+import os
+
+from .. import inodecache
+from ..inodecache import (
+    MMAP_SLOTS,
+    MMAP_SLOT_SIZE,
+    InodeCache,
+    MmapInodeCache,
+)
+
+
+def test_mmap_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(inodecache, '_memo', {})
+    cachedir = str(tmp_path / 'icache')
+    src = tmp_path / 'gcc'
+    src.write_bytes(b'#!/bin/sh\n')
+    cache = MmapInodeCache(cachedir)
+    assert cache.get(str(src), 1) is None
+    cache.put_str(str(src), 1, 'x86_64-linux-gnu')
+    cache.put(str(src), 2, b'skylake')
+    assert cache.get_str(str(src), 1) == 'x86_64-linux-gnu'
+    assert os.path.getsize(os.path.join(cachedir, os.listdir(cachedir)[0])) \
+        == MMAP_SLOTS*MMAP_SLOT_SIZE
+
+    # another process: nothing memoized
+    monkeypatch.setattr(inodecache, '_memo', {})
+    other = MmapInodeCache(cachedir)
+    assert other.get(str(src), 2) == b'skylake'
+    other.purge(str(src), 2)
+    assert other.get(str(src), 2) is None
+    assert other.get_str(str(src), 1) == 'x86_64-linux-gnu'
+
+    # a new binary
+    src.write_bytes(b'#!/bin/sh\nexit 0\n')
+    assert other.get(str(src), 1) is None
+
+    # too large for a slot, only memoized
+    big = b'x'*MMAP_SLOT_SIZE
+    other.put(str(src), 1, big)
+    assert other.get(str(src), 1) == big
+    monkeypatch.setattr(inodecache, '_memo', {})
+    assert MmapInodeCache(cachedir).get(str(src), 1) is None
+
+
+def test_mmap_cache_collisions(tmp_path, monkeypatch):
+    monkeypatch.setattr(inodecache, '_memo', {})
+    monkeypatch.setattr(inodecache, 'MMAP_SLOTS', 4)
+    monkeypatch.setattr(inodecache, 'MMAP_PROBES', 2)
+    cache = MmapInodeCache(str(tmp_path / 'icache'))
+    src = tmp_path / 'gcc'
+    src.write_bytes(b'')
+    for kind in range(10):
+        cache.put(str(src), kind, str(kind).encode())
+    monkeypatch.setattr(inodecache, '_memo', {})
+    # older entries are evicted, the latest ones are found
+    assert cache.get(str(src), 9) == b'9'
+    found = [cache.get(str(src), kind) for kind in range(10)]
+    assert sum(1 for v in found if v is not None) <= 4
+
+
+def _write_values(cachedir, path, count):
+    cache = InodeCache(cachedir)
+    for n in range(count):
+        cache.put(path, 1, bytes([n % 2])*65536)
+
+
+def test_files_cache(tmp_path):
+    cachedir = str(tmp_path / 'icache')
+    src = tmp_path / 'gcc'
+    src.write_bytes(b'')
+    cache = InodeCache(cachedir)
+    assert cache.get(str(src), 1) is None
+    cache.put_str(str(src), 1, 'skylake')
+    assert cache.get_str(str(src), 1) == 'skylake'
+    cache.purge(str(src), 1)
+    assert cache.get(str(src), 1) is None
+
+    # readers never see a partially written value
+    writer = multiprocessing.Process(target=_write_values,
+                                     args=(cachedir, str(src), 200))
+    writer.start()
+    while writer.is_alive():
+        value = cache.get(str(src), 1)
+        assert value is None or value in (bytes(65536), b'\1'*65536)
+    writer.join()
+    assert writer.exitcode == 0
+    # no lock or temporary files
+    assert len(os.listdir(cachedir)) == 1
+
+
+def test_files_cache_replace_failed(tmp_path, monkeypatch, caplog):
+    cachedir = str(tmp_path / 'icache')
+    src = tmp_path / 'gcc'
+    src.write_bytes(b'')
+    cache = InodeCache(cachedir)
+
+    def replace(src, dst):
+        raise PermissionError('open by a reader')
+
+    monkeypatch.setattr(os, 'replace', replace)
+    with caplog.at_level('DEBUG', logger='pdistcc.inodecache'):
+        cache.put_str(str(src), 1, 'skylake')
+    assert 'open by a reader' in caplog.text
+    # the temporary file is removed
+    assert os.listdir(cachedir) == []
+    assert cache.get(str(src), 1) is None
@@ -0,0 +1,175 @@
+import socket
+import subprocess
+import sys
+import threading
+
+from ..inventory import (
+    InventoryCache,
+    can_compile,
+    decode_inventory,
+    encode_inventory,
+    normalize_triplet,
+    server_inventory,
+)
+from ..net import (
+    ProtocolError,
+    ServerBusy,
+    dcc_inventory,
+)
+from ..sched import file_lock
+from ..server import Distccd
+
+
+def _fake_gcc(path, triplet):
+    path.write_text('#!/bin/sh\n'
+                    'case "$1" in\n'
+                    '-dumpmachine) echo {} ;;\n'
+                    '-dumpfullversion) echo 12.2.0 ;;\n'
+                    'esac\n'.format(triplet))
+    path.chmod(0o755)
+
+
+def test_server_inventory(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    _fake_gcc(bindir / 'gcc', 'x86_64-linux-gnu')
+    _fake_gcc(bindir / 'aarch64-linux-gnu-g++', 'aarch64-linux-gnu')
+    # not a compiler pdistcc distributes jobs of
+    _fake_gcc(bindir / 'ld', 'x86_64-linux-gnu')
+    settings = {'gcc': {'compiler_dir': str(bindir)},
+                'msvc': {'clang_path': str(tmp_path / 'missing')}}
+    compilers = server_inventory(settings)
+    assert compilers == [
+        {'name': 'aarch64-linux-gnu-g++', 'version': '12.2.0',
+         'triplet': 'aarch64-linux-gnu',
+         'path': str(bindir / 'aarch64-linux-gnu-g++')},
+        {'name': 'gcc', 'version': '12.2.0', 'triplet': 'x86_64-linux-gnu',
+         'path': str(bindir / 'gcc')},
+    ]
+    assert decode_inventory(encode_inventory(compilers)) == compilers
+    assert server_inventory({}, path_dirs=[str(tmp_path / 'none')]) == []
+
+
+def test_can_compile():
+    compilers = [
+        {'name': 'gcc', 'version': '12', 'triplet': 'x86_64-linux-gnu',
+         'path': '/usr/bin/gcc'},
+        {'name': 'clang-cl', 'version': '', 'triplet': '',
+         'path': '/usr/bin/clang-cl'},
+    ]
+    assert can_compile(compilers, 'gcc', 'x86_64-linux-gnu')
+    assert can_compile(compilers, 'gcc', None)
+    assert not can_compile(compilers, 'gcc', 'aarch64-linux-gnu')
+    assert not can_compile(compilers, 'g++', 'x86_64-linux-gnu')
+    # clang-cl has no fixed target
+    assert can_compile(compilers, 'clang-cl', None)
+    # the same target as built by other vendors
+    assert can_compile(compilers, 'gcc', 'x86_64-pc-linux-gnu')
+    assert can_compile(compilers, 'gcc', 'x86_64-redhat-linux')
+
+
+def test_normalize_triplet():
+    for triplet in ('x86_64-linux-gnu', 'x86_64-pc-linux-gnu',
+                    'x86_64-unknown-linux-gnu', 'x86_64-redhat-linux'):
+        assert normalize_triplet(triplet) == 'x86_64-linux-gnu'
+    assert normalize_triplet('arm-linux-gnueabihf') == 'arm-linux-gnueabihf'
+    assert normalize_triplet('arm-none-eabi') == 'arm-none-eabi'
+    assert normalize_triplet('x86_64-w64-mingw32') == 'x86_64-mingw32'
+    assert normalize_triplet('x86_64-apple-darwin21') == 'x86_64-darwin21'
+
+
+def test_inventory_cache(tmp_path):
+    now = [1000.0]
+    replies = {
+        'a': b'gcc\t12\tx86_64-linux-gnu\t/usr/bin/gcc\n',
+        'b': b'gcc\t12\taarch64-linux-gnu\t/usr/bin/gcc\n',
+        'c': ProtocolError('peer disconnected'),
+        'd': ServerBusy(4),
+    }
+    queries = []
+
+    def query(host, port):
+        queries.append(host)
+        reply = replies[host]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    cache = InventoryCache(str(tmp_path), ttl=60, query=query,
+                           clock=lambda: now[0])
+    hosts = [{'host': h, 'port': 3632, 'weight': 4} for h in 'abcd']
+    hosts.append({'host': 'localhost', 'port': 3632, 'weight': 2})
+    # 'c' and 'd' can't tell, might have the compiler
+    assert cache.incompatible(hosts, 'gcc', 'x86_64-linux-gnu') == hosts[1:2]
+    assert queries == ['a', 'b', 'c', 'd']
+    # shared by the clients until the ttl is over, busy hosts are asked again
+    other = InventoryCache(str(tmp_path), ttl=60, query=query,
+                           clock=lambda: now[0])
+    assert other.incompatible(hosts, 'g++', None) == hosts[:2]
+    assert queries == ['a', 'b', 'c', 'd', 'd']
+    now[0] += 60
+    other.incompatible(hosts, 'gcc', None)
+    assert queries[5:] == ['a', 'b', 'c', 'd']
+
+
+def test_inventory_single_refresh(tmp_path):
+    now = [1000.0]
+    queries = []
+
+    def query(host, port):
+        queries.append(host)
+        return b'gcc\t12\tx86_64-linux-gnu\t/usr/bin/gcc\n'
+
+    cache = InventoryCache(str(tmp_path), ttl=60, query=query,
+                           clock=lambda: now[0])
+    host = {'host': 'a', 'port': 3632, 'weight': 4}
+    compilers = cache.get(host)
+    now[0] += 60
+    # another client is asking the host: go on with the stale inventory
+    lock = file_lock(str(tmp_path / 'a_3632.lock'))
+    assert lock.acquire()
+    try:
+        child = subprocess.run([
+            sys.executable, '-c',
+            'import sys; from pdistcc.inventory import InventoryCache; '
+            'cache = InventoryCache(sys.argv[1], ttl=60, clock=lambda: 1060.0, '
+            'query=lambda host, port: sys.exit("queried")); '
+            'print(cache.get({"host": "a", "port": 3632})[0]["name"])',
+            str(tmp_path)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    finally:
+        lock.release()
+    assert child.stderr == b''
+    assert child.stdout == b'gcc\n'
+    assert queries == ['a']
+    assert cache.get(host) == compilers
+    assert queries == ['a', 'a']
+
+
+def _listening_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    return sock
+
+
+def test_dcc_inventory():
+    inventory = encode_inventory([
+        {'name': 'gcc', 'version': '12', 'triplet': 'x86_64-linux-gnu',
+         'path': '/usr/bin/gcc'},
+    ])
+
+    def serve(lsock):
+        conn, _ = lsock.accept()
+        with conn:
+            Distccd({}, conn, ('test', 0), None, inventory=inventory)
+
+    with _listening_socket() as lsock:
+        thread = threading.Thread(target=serve, args=(lsock,))
+        thread.start()
+        try:
+            reply = dcc_inventory('127.0.0.1', lsock.getsockname()[1],
+                                  io_timeout=10)
+        finally:
+            thread.join()
+    assert reply == inventory
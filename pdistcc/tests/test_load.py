@@ -0,0 +1,46 @@
+from ..load import (
+    LoadMonitor,
+    cpu_pressure,
+)
+
+
+class FakeSlots:
+    def __init__(self, count, running=0):
+        self.count = count
+        self.running = running
+
+
+def test_cpu_pressure(tmp_path):
+    psi = tmp_path / 'cpu'
+    psi.write_text('some avg10=12.50 avg60=3.00 avg300=1.00 total=123\n'
+                   'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+    assert cpu_pressure(str(psi)) == 12.5
+    assert cpu_pressure(str(tmp_path / 'missing')) is None
+
+
+def test_busy_queue():
+    load = LoadMonitor(FakeSlots(2), {}, pressure=lambda: None,
+                       loadavg=lambda: None)
+    for _ in range(3):
+        load.connection_opened()
+    assert load.queued == 1
+    assert load.busy() is None
+    load.connection_opened()
+    assert load.busy() == 'queue is full'
+    load.connection_closed()
+    assert load.busy() is None
+
+
+def test_busy_pressure():
+    now = [0.0]
+    pressure = [10.0]
+    load = LoadMonitor(FakeSlots(4), {'max_cpu_pressure': 50, 'max_load': 8},
+                       clock=lambda: now[0],
+                       pressure=lambda: pressure[0],
+                       loadavg=lambda: 1.0)
+    assert load.busy() is None
+    pressure[0] = 80.0
+    # the sample is cached for a while
+    assert load.busy() is None
+    now[0] += 1.5
+    assert load.busy() == 'CPU pressure 80.00%'
@@ -0,0 +1,95 @@
+import os
+
+from ..manifest import (
+    TOO_NEW,
+    ManifestCache,
+    direct_key,
+    parse_dependencies,
+)
+
+
+def test_parse_dependencies():
+    text = ('foo.o: foo.c /usr/include/stdio.h \\\n'
+            ' inc/a\\ b.h inc/$$x.h\n'
+            '/usr/include/stdio.h:\n')
+    assert parse_dependencies(text) == \
+        ['foo.c', '/usr/include/stdio.h', 'inc/a b.h', 'inc/$x.h']
+    assert parse_dependencies('') is None
+
+
+def test_direct_key(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'foo.c').write_bytes(b'int x;\n')
+    cmd = 'gcc -c -MD -o foo.o foo.c'.split()
+    key = direct_key('gcc:1', cmd, 'foo.c')
+    assert key == direct_key('gcc:1', cmd, 'foo.c')
+    assert key != direct_key('gcc:2', cmd, 'foo.c')
+    monkeypatch.setenv('CPATH', '/opt/include')
+    assert key != direct_key('gcc:1', cmd, 'foo.c')
+    (tmp_path / 'foo.c').write_bytes(b'char *s = __DATE__;\n')
+    assert direct_key('gcc:1', cmd, 'foo.c') is None
+    assert direct_key('gcc:1', cmd, 'missing.c') is None
+
+
+def test_manifest_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'foo.c').write_bytes(b'#include "a.h"\n')
+    header = tmp_path / 'a.h'
+    header.write_bytes(b'#define A 1\n')
+    depdata = b'foo.o: foo.c a.h\n'
+    (tmp_path / 'foo.d').write_bytes(depdata)
+    now = [os.stat('a.h').st_ctime_ns + TOO_NEW + 1]
+    cache = ManifestCache(str(tmp_path / 'manifests'), clock=lambda: now[0])
+    assert cache.lookup('k1') is None
+    assert cache.record('k1', 'foo.d', 'obj1')
+    assert cache.lookup('k1') == ('obj1', depdata)
+
+    # same size and mtime, but the header is hashed as its ctime changed
+    st = os.stat('a.h')
+    header.write_bytes(b'#define A 2\n')
+    os.utime('a.h', ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert cache.lookup('k1') is None
+    now[0] = os.stat('a.h').st_ctime_ns + TOO_NEW + 1
+    assert cache.record('k1', 'foo.d', 'obj2')
+    assert cache.lookup('k1') == ('obj2', depdata)
+    # the earlier result is kept
+    header.write_bytes(b'#define A 1\n')
+    assert cache.lookup('k1') == ('obj1', depdata)
+    header.unlink()
+    assert cache.lookup('k1') is None
+
+
+def test_manifest_time_macros(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'foo.c').write_bytes(b'#include "a.h"\n')
+    (tmp_path / 'a.h').write_bytes(b'#define BUILT __TIME__\n')
+    (tmp_path / 'foo.d').write_bytes(b'foo.o: foo.c a.h\n')
+    cache = ManifestCache(str(tmp_path / 'manifests'))
+    assert not cache.record('k1', 'foo.d', 'obj1')
+    assert cache.lookup('k1') is None
+
+
+def test_manifest_eviction(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'foo.c').write_bytes(b'int x;\n')
+    (tmp_path / 'foo.d').write_bytes(b'foo.o: foo.c\n')
+    cachedir = str(tmp_path / 'manifests')
+    cache = ManifestCache(cachedir, clock=lambda: 0)
+    assert cache.record('k0', 'foo.d', 'obj')
+    size = os.path.getsize(os.path.join(cachedir, 'k0', 'k0'))
+    # room for three manifests
+    cache = ManifestCache(cachedir, clock=lambda: 0, max_size=3*size)
+    for key in ['k1', 'k2']:
+        assert cache.record(key, 'foo.d', 'obj')
+    for n, key in enumerate(['k0', 'k1', 'k2']):
+        os.utime(os.path.join(cachedir, key, key), ns=(n*10**9, n*10**9))
+    # a hit makes k0 the most recently used
+    assert cache.lookup('k0') == ('obj', b'foo.o: foo.c\n')
+    # over the limit: shrunk below 90% of it, the oldest first
+    assert cache.record('k3', 'foo.d', 'obj')
+    assert cache.lookup('k1') is None
+    assert cache.lookup('k2') is None
+    remaining = sorted(e[2] for e in cache._entries())
+    assert [os.path.basename(p) for p in remaining] == ['k0', 'k3']
+    with open(os.path.join(cachedir, 'size')) as f:
+        assert int(f.read()) == sum(e[1] for e in cache._entries())
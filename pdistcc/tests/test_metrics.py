@@ -0,0 +1,139 @@
+import asyncio
+
+from .fakeops import (
+    FakeFileOpsFactory,
+    FakeSocket,
+    FakeTempFileFactory,
+)
+from unittest.mock import MagicMock
+
+from ..metrics import (
+    Counter,
+    Histogram,
+    ServerMetrics,
+    serve_metrics,
+)
+from ..server import (
+    Distccd,
+    Perf,
+)
+
+
+def test_histogram():
+    hist = Histogram('foo_seconds', 'Foo', ('phase',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3):
+        hist.observe(value, phase='a')
+    assert hist.render() == [
+        '# HELP foo_seconds Foo',
+        '# TYPE foo_seconds histogram',
+        'foo_seconds_bucket{phase="a",le="0.1"} 2',
+        'foo_seconds_bucket{phase="a",le="1.0"} 3',
+        'foo_seconds_bucket{phase="a",le="+Inf"} 4',
+        'foo_seconds_sum{phase="a"} 3.65',
+        'foo_seconds_count{phase="a"} 4',
+    ]
+
+
+def test_counter():
+    counter = Counter('foo_total', 'Foo', ('code',))
+    counter.inc(code=1)
+    counter.inc(2, code=0)
+    counter.inc(code='say "hi"\n')
+    assert counter.render()[2:] == [
+        'foo_total{code="0"} 2',
+        'foo_total{code="1"} 1',
+        'foo_total{code="say \\"hi\\"\\n"} 1',
+    ]
+
+
+def test_server_metrics():
+    class FakeSlots:
+        count = 4
+        running = 3
+        waiting = 2
+
+    class FakeLoad:
+        connections = 5
+        load_average = 1.5
+        cpu_pressure = None
+
+    metrics = ServerMetrics(FakeSlots(), FakeLoad())
+    perf = Perf()
+    perf.total_time = 1500.0
+    perf.compile_time = 1000.0
+    perf.recv_size = 100
+    perf.send_size = 2000
+    perf.returncode = 1
+    metrics.observe(perf)
+    perf.cache_hit = True
+    perf.returncode = 0
+    metrics.observe(perf)
+    metrics.request_rejected()
+    lines = metrics.render().splitlines()
+    assert 'pdistccd_request_seconds_count{phase="compile"} 2' in lines
+    assert 'pdistccd_request_seconds_sum{phase="total"} 3.0' in lines
+    assert 'pdistccd_request_bytes_bucket{direction="in",le="1024"} 2' in lines
+    assert 'pdistccd_sent_bytes_total 4000' in lines
+    assert 'pdistccd_compiler_exits_total{code="0"} 1' in lines
+    assert 'pdistccd_compiler_exits_total{code="1"} 1' in lines
+    assert 'pdistccd_cache_hits_total 1' in lines
+    assert 'pdistccd_rejected_requests_total 1' in lines
+    assert 'pdistccd_failed_requests_total 0' in lines
+    assert 'pdistccd_active_jobs 3' in lines
+    assert 'pdistccd_queued_jobs 2' in lines
+    assert 'pdistccd_connections 5' in lines
+    # not available
+    assert not any(line.startswith('pdistccd_cpu_pressure ') for line in lines)
+
+
+def test_distccd_metrics():
+    source = b'int f(int x,int y){return x+y;}'
+    job = b''.join([
+        b'DIST', b'00000001',
+        b'ARGC', b'00000005',
+        b'ARGV', b'00000003', b'gcc',
+        b'ARGV', b'00000002', b'-c',
+        b'ARGV', b'00000002', b'-o',
+        b'ARGV', b'00000005', b'foo.o',
+        b'ARGV', b'00000005', b'foo.c'
+        b'DOTI', b'0000001f', source,
+    ])
+    mock_popen = MagicMock()
+    mock_popen.return_value.communicate.return_value = (b'SOUT', b'SERR')
+    mock_popen.return_value.returncode = 0
+    metrics = ServerMetrics()
+    Distccd({}, FakeSocket(job), ('127.0.0.1', '3632'), {},
+            fileops=FakeFileOpsFactory({'foo_1.o': b'FAKE'}),
+            tempfile=FakeTempFileFactory(['foo_0.ii', 'foo_1.o']),
+            popen=mock_popen,
+            objcache=None,
+            metrics=metrics)
+    assert metrics.compiler_exits.value(code=0) == 1
+    assert metrics.received_bytes.value() == len(source)
+    assert metrics.sent_bytes.value() == 4
+
+
+def test_metrics_http():
+    metrics = ServerMetrics()
+    metrics.request_rejected()
+
+    async def get(port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                     .format(path).encode())
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def scrape():
+        server = await serve_metrics(metrics, '127.0.0.1', 0)
+        async with server:
+            port = server.sockets[0].getsockname()[1]
+            return await get(port, '/metrics'), await get(port, '/')
+
+    found, not_found = asyncio.run(scrape())
+    headers, body = found.split(b'\r\n\r\n', 1)
+    assert headers.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert b'Content-Type: text/plain; version=0.0.4' in headers
+    assert b'\npdistccd_rejected_requests_total 1\n' in body
+    assert not_found.startswith(b'HTTP/1.1 404 ')
@@ -1,16 +1,38 @@
 
+import hashlib
 import io
+import os
 import pytest
+import socket
+import threading
+import time
 
 from contextlib import contextmanager
 
 
+from pdistcc.compression import get_codec
 from pdistcc.net import (
+    IOV_MAX,
+    RECV_SPLICE_MIN_SIZE,
+    SENDFILE_MIN_SIZE,
     DccClient,
+    DccSession,
     InvalidToken,
+    MultiplexNotSupported,
+    ReplyTimeout,
+    ServerBusy,
     chunked_read_write,
+    client_codec,
+    compress_chunk,
+    compress_file,
     dcc_decode,
     dcc_encode,
+    dcc_hedged_compile,
+    receive_file,
+    recv_exactly,
+    send_buffers,
+    send_compressed_chunks,
+    send_file,
 )
 
 
@@ -129,6 +151,16 @@ def test_dcc_reply_success():
     assert fileFactory._vfs['dot.o'].getvalue() == fakeobj
 
 
+def test_dcc_reply_busy():
+    sock = FakeSocket(dcc_encode('BUSY', 5))
+    dcc = DccClient(sock, 'hello.ii', 'dot.o',
+                    stdout=io.BytesIO(), stderr=io.BytesIO(),
+                    fileops=FakeFileOpsFactory({}))
+    with pytest.raises(ServerBusy) as excinfo:
+        dcc.handle_response()
+    assert excinfo.value.queued == 5
+
+
 def test_dcc_request1():
     stdout = io.StringIO('')
     stderr = io.StringIO('')
@@ -161,3 +193,384 @@ def test_dcc_request1():
         dcc_encode('DOTI', len(source)),
         source,
     ])
+
+
+def test_dcc_request_compressed():
+    sock = FakeSocket()
+    source = b'int f(int x, int y) { return x + y; }' * 100
+    codec = get_codec('zlib')
+    fileFactory = FakeFileOpsFactory({
+        'hello.ii': source,
+    })
+    dcc = DccClient(sock,
+                    'hello.ii',
+                    'a.o',
+                    fileops=fileFactory,
+                    codec=codec)
+    dcc.request(['gcc'])
+    compressed = compress_chunk(codec, source)
+    # sent as it's compressed, the object file can come back in chunks
+    assert sock.getvalue() == b''.join([
+        b'DIST00000002',
+        b'COMP00000002',
+        b'ARGC00000001',
+        b'ARGV00000003' + b'gcc',
+        b'DOTC00000001',
+        dcc_encode('CHNK', len(compressed)),
+        compressed,
+        b'CHNK00000000',
+    ])
+
+
+def test_dcc_reply_compressed():
+    fakeobj = b'FAKEELF' * 100
+    codec = get_codec('zlib')
+    compressed = compress_file(codec, io.BytesIO(fakeobj), len(fakeobj))
+    sock = FakeSocket(b''.join([
+        dcc_encode('DONE', 2),
+        dcc_encode('STAT', 0),
+        dcc_encode('SERR', 0),
+        dcc_encode('SOUT', 0),
+        dcc_encode('DOTO', len(compressed)),
+        compressed,
+    ]))
+    fileFactory = FakeFileOpsFactory({
+        'dot.o': b'',
+    })
+    dcc = DccClient(sock,
+                    'hello.ii',
+                    'dot.o',
+                    stdout=io.BytesIO(),
+                    stderr=io.BytesIO(),
+                    fileops=fileFactory,
+                    codec=codec)
+    assert dcc.handle_response() == 0
+    assert fileFactory._vfs['dot.o'].getvalue() == fakeobj
+
+
+def test_dcc_reply_compressed_chunks():
+    fakeobj = b'FAKEELF' * 100
+    codec = get_codec('zlib')
+    sock = FakeSocket()
+    send_compressed_chunks(sock, io.BytesIO(fakeobj), len(fakeobj), codec,
+                           [b''.join([
+                               dcc_encode('DONE', 2),
+                               dcc_encode('STAT', 0),
+                               dcc_encode('SERR', 0),
+                               dcc_encode('SOUT', 0),
+                               dcc_encode('DOTC', 0),
+                           ])], chunk_size=256)
+    fileFactory = FakeFileOpsFactory({
+        'dot.o': b'',
+    })
+    dcc = DccClient(FakeSocket(sock.getvalue()),
+                    'hello.ii',
+                    'dot.o',
+                    stdout=io.BytesIO(),
+                    stderr=io.BytesIO(),
+                    fileops=fileFactory,
+                    codec=codec)
+    assert dcc.handle_response() == 0
+    assert fileFactory._vfs['dot.o'].getvalue() == fakeobj
+
+
+def test_check_busy_leaves_reply():
+    server, client = socket.socketpair()
+    with server, client:
+        # a small job, compiled before the client has checked
+        server.sendall(dcc_encode('DONE', 1))
+        dcc = DccClient(client, None, 'foo.o', io.BytesIO(), io.BytesIO())
+        dcc.check_busy(timeout=5)
+        assert recv_exactly(client, 12) == dcc_encode('DONE', 1)
+        server.sendall(dcc_encode('BUSY', 3))
+        with pytest.raises(ServerBusy):
+            dcc.check_busy(timeout=5)
+
+
+def test_check_busy_split_token():
+    server, client = socket.socketpair()
+    with server, client:
+        client.settimeout(5)
+        server.sendall(b'BU')
+        timer = threading.Timer(0.1, server.sendall, [b'SY00000003'])
+        timer.start()
+        dcc = DccClient(client, None, 'foo.o', io.BytesIO(), io.BytesIO())
+        with pytest.raises(ServerBusy) as exc:
+            dcc.check_busy(timeout=5)
+        timer.join()
+        assert exc.value.queued == 3
+
+
+def test_client_codec(monkeypatch):
+    monkeypatch.setattr('pdistcc.compression.CODECS',
+                        {'zlib': get_codec('zlib')})
+    assert client_codec('zlib').name == 'zlib'
+    # python-lzo is not installed: no compression
+    assert client_codec('lzo') is None
+    assert client_codec(None) is None
+
+
+def test_dcc_request_stream():
+    sock = FakeSocket()
+    dcc = DccClient(sock, None, 'a.o', fileops=FakeFileOpsFactory({}))
+    dcc.request_stream(['gcc'], io.BytesIO(b'int x;' * 3), chunk_size=8)
+    dcc.end_stream()
+    assert sock.getvalue() == b''.join([
+        b'DIST00000001',
+        b'ARGC00000001',
+        b'ARGV00000003' + b'gcc',
+        b'DOTC00000000',
+        b'CHNK00000008' + b'int x;in',
+        b'CHNK00000008' + b't x;int ',
+        b'CHNK00000002' + b'x;',
+        b'CHNK00000000',
+    ])
+
+
+def test_dcc_session_not_supported():
+    server, client = socket.socketpair()
+    # like distccd: the request is invalid, drop the connection
+    server.close()
+    with pytest.raises(MultiplexNotSupported):
+        DccSession(conn=client)
+
+
+def _receive_in_thread(sock, size):
+    received = []
+    thread = threading.Thread(target=lambda: received.append(recv_exactly(sock, size)))
+    thread.start()
+    return thread, received
+
+
+def test_send_buffers():
+    # more buffers than a single sendmsg() takes, larger than the
+    # socket buffer (partial sends)
+    buffers = [dcc_encode('ARGV', n) for n in range(2*IOV_MAX)]
+    buffers.append(os.urandom(4*1024*1024))
+    buffers.append(b'')
+    buffers.append(b'TAIL')
+    expected = b''.join(buffers)
+    server, client = socket.socketpair()
+    with server, client:
+        thread, received = _receive_in_thread(server, len(expected))
+        send_buffers(client, buffers)
+        thread.join()
+    assert received == [expected]
+
+
+@pytest.mark.parametrize('size', [0, 100, 3*SENDFILE_MIN_SIZE + 5])
+def test_send_file(tmp_path, size):
+    data = os.urandom(size)
+    path = tmp_path / 'foo.o'
+    path.write_bytes(b'JUNK' + data)
+    header = dcc_encode('DOTO', size)
+    server, client = socket.socketpair()
+    with server, client, open(str(path), 'rb') as f:
+        f.read(4)
+        thread, received = _receive_in_thread(server, len(header) + size)
+        send_file(client, f, size, [header])
+        thread.join()
+    assert received == [header + data]
+
+
+@pytest.mark.parametrize('size', [100, 3*SENDFILE_MIN_SIZE + 5])
+def test_send_file_fallback(size):
+    data = os.urandom(size)
+    sock = FakeSocket()
+    send_file(sock, io.BytesIO(data), size, [b'HEAD', b'ER'])
+    assert sock.getvalue() == b'HEADER' + data
+
+
+def test_recv_exactly_large():
+    data = os.urandom(4*1024*1024)
+    server, client = socket.socketpair()
+    with server, client:
+        thread, received = _receive_in_thread(server, len(data))
+        client.sendall(data)
+        thread.join()
+    assert received == [data]
+
+
+@pytest.mark.parametrize('hashed', [False, True])
+@pytest.mark.parametrize('size', [100, 3*RECV_SPLICE_MIN_SIZE + 5])
+def test_receive_file(tmp_path, hashed, size):
+    data = os.urandom(size)
+    path = str(tmp_path / 'foo.o')
+    server, client = socket.socketpair()
+    hsh = hashlib.sha256() if hashed else None
+    with server, client, open(path, 'wb') as f:
+        f.write(b'HEAD')
+        thread = threading.Thread(target=client.sendall, args=(data + b'TAIL',))
+        thread.start()
+        receive_file(server, f, size, hsh)
+        f.write(b'ER')
+        thread.join()
+        assert recv_exactly(server, 4) == b'TAIL'
+    with open(path, 'rb') as f:
+        assert f.read() == b'HEAD' + data + b'ER'
+    if hashed:
+        assert hsh.digest() == hashlib.sha256(data).digest()
+
+
+def test_net_bench():
+    from pdistcc.net_bench import measure, regressions
+    results = measure(sizes=(1024,), argcs=(8,), transports=('socketpair',),
+                      min_time=0.01)
+    assert results['transfer']['socketpair']['receive_file']['1K']['mb_per_s'] > 0
+    assert results['exchange']['socketpair']['argc']['8']['requests_per_s'] > 0
+    assert regressions(results, results, 0.2) == []
+    slower = {'codec': {'dcc_encode': {'ops_per_s': 0.5*results['codec']['dcc_encode']['ops_per_s']}}}
+    assert [path for path, _, _ in regressions(slower, results, 0.2)] == \
+        ['codec/dcc_encode/ops_per_s']
+
+
+def test_dcc_client_io_timeout(tmp_path):
+    server, client = socket.socketpair()
+    with server, client:
+        dcc = DccClient(client, None, str(tmp_path / 'foo.o'),
+                        io.BytesIO(), io.BytesIO(), io_timeout=0.1)
+        with pytest.raises(ReplyTimeout):
+            dcc.handle_response()
+
+
+class _StubCompiler(object):
+    def __init__(self, args, obj, done):
+        self._ofile = args[args.index('-o') + 1]
+        self._obj = obj
+        self._done = done
+        self.returncode = 0
+
+    def communicate(self, input=None):
+        self._done.wait()
+        with open(self._ofile, 'wb') as f:
+            f.write(self._obj)
+        return b'', b''
+
+
+def _listening_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    return sock
+
+
+@contextmanager
+def _stub_server(tmp_path, obj, done):
+    from pdistcc.server import Distccd
+
+    def handle(conn):
+        with conn:
+            try:
+                Distccd({'scratch_dir': str(tmp_path)}, conn, ('test', 0), None,
+                        popen=lambda args, **kw: _StubCompiler(args, obj, done),
+                        objcache=None)
+            except OSError:
+                # the client has given up on this server
+                pass
+
+    with _listening_socket() as lsock:
+        def serve():
+            conn, _ = lsock.accept()
+            handle(conn)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        try:
+            yield {'host': '127.0.0.1', 'port': lsock.getsockname()[1]}
+        finally:
+            done.set()
+            thread.join()
+
+
+class _Lease(object):
+    def __init__(self, host):
+        self.host = host
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def test_dcc_hedged_compile(tmp_path):
+    doti = tmp_path / 'foo.i'
+    doti.write_bytes(b'int x;')
+    ofile = tmp_path / 'foo.o'
+    args = ['gcc', '-c', '-o', 'foo.o', 'foo.i']
+    stuck, ready = threading.Event(), threading.Event()
+    ready.set()
+    with _stub_server(tmp_path, b'SLOW', stuck) as slow, \
+            _stub_server(tmp_path, b'FAST', ready) as fast:
+        backups = []
+
+        def backup():
+            backups.append(fast)
+            return _Lease(fast)
+
+        start = time.monotonic()
+        ret, winner, sent = dcc_hedged_compile(
+            str(doti), args, slow['host'], slow['port'], backup, 0.2,
+            ofile=str(ofile), stdout=io.BytesIO(), stderr=io.BytesIO())
+        assert ret == 0
+        assert backups == [fast]
+        # the duplicate has won, sent after the hedge delay
+        assert winner == fast
+        assert sent >= start + 0.2
+        assert ofile.read_bytes() == b'FAST'
+
+
+def test_dcc_hedged_compile_fast(tmp_path):
+    doti = tmp_path / 'foo.i'
+    doti.write_bytes(b'int x;')
+    ofile = tmp_path / 'foo.o'
+    args = ['gcc', '-c', '-o', 'foo.o', 'foo.i']
+    ready = threading.Event()
+    ready.set()
+    with _stub_server(tmp_path, b'FAST', ready) as server:
+        ret, winner, _ = dcc_hedged_compile(
+            str(doti), args, server['host'], server['port'],
+            lambda: pytest.fail('hedged a fast job'), 5, ofile=str(ofile),
+            stdout=io.BytesIO(), stderr=io.BytesIO())
+    assert ret == 0
+    assert winner == server
+    assert ofile.read_bytes() == b'FAST'
+
+
+def test_dcc_hedged_compile_partial_reply(tmp_path):
+    doti = tmp_path / 'foo.i'
+    doti.write_bytes(b'int x;')
+    ofile = tmp_path / 'foo.o'
+    args = ['gcc', '-c', '-o', 'foo.o', 'foo.i']
+    backup_ready = threading.Event()
+
+    def broken(lsock):
+        conn, _ = lsock.accept()
+        with conn:
+            request = b''
+            while not request.endswith(b'int x;'):
+                request += conn.recv(4096)
+            # past the hedge delay: half a reply, then the server is gone
+            time.sleep(0.3)
+            conn.sendall(dcc_encode('DONE', 1) + dcc_encode('STAT', 0)
+                         + dcc_encode('SERR', 4) + b'half')
+        backup_ready.set()
+
+    with _listening_socket() as lsock, \
+            _stub_server(tmp_path, b'FAST', backup_ready) as fast:
+        thread = threading.Thread(target=broken, args=(lsock,))
+        thread.start()
+        try:
+            stdout, stderr = io.BytesIO(), io.BytesIO()
+            ret, winner, _ = dcc_hedged_compile(
+                str(doti), args, '127.0.0.1', lsock.getsockname()[1],
+                lambda: _Lease(fast), 0.1, ofile=str(ofile), stdout=stdout,
+                stderr=stderr)
+        finally:
+            thread.join()
+    assert ret == 0
+    assert winner == fast
+    # nothing of the broken reply
+    assert stderr.getvalue() == b''
+    assert ofile.read_bytes() == b'FAST'
+    assert sorted(os.listdir(str(tmp_path))) == ['foo.i', 'foo.o']
@@ -0,0 +1,85 @@
+import io
+import os
+import threading
+
+from ..objcache import (
+    DigestWriter,
+    ObjectCache,
+    cache_key,
+    doti_hash,
+)
+
+
+def _store(cache, key, obj, stderr=b''):
+    cache.store(key, 0, b'', stderr, io.BytesIO(obj), len(obj))
+
+
+def test_store_lookup(tmp_path):
+    cache = ObjectCache(str(tmp_path))
+    _store(cache, 'abcd', b'FAKEELF', stderr=b'warning')
+    with cache.lookup('abcd') as entry:
+        assert entry.returncode == 0
+        assert entry.stderr == b'warning'
+        assert entry.stdout == b''
+        assert entry.object_size == len(b'FAKEELF')
+        assert entry.object.read() == b'FAKEELF'
+
+
+def test_lookup_miss(tmp_path):
+    cache = ObjectCache(str(tmp_path))
+    with cache.lookup('abcd') as entry:
+        assert entry is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ObjectCache(str(tmp_path), max_size=400)
+    _store(cache, 'aa00', b'a'*100)
+    _store(cache, 'bb00', b'b'*100)
+    os.utime(os.path.join(str(tmp_path), 'aa', 'aa00'), ns=(1, 1))
+    os.utime(os.path.join(str(tmp_path), 'bb', 'bb00'), ns=(2, 2))
+    # a hit makes the entry the most recently used one
+    with cache.lookup('aa00') as entry:
+        assert entry is not None
+    _store(cache, 'cc00', b'c'*100)
+    with cache.lookup('bb00') as entry:
+        assert entry is None
+    with cache.lookup('aa00') as entry:
+        assert entry is not None
+    with cache.lookup('cc00') as entry:
+        assert entry is not None
+
+
+def test_concurrent_stores(tmp_path):
+    def store(n):
+        # a cache per thread, as pdistccd used to have per connection
+        cache = ObjectCache(str(tmp_path))
+        for k in range(20):
+            _store(cache, '{:02x}{:04x}'.format(n, k), b'x' * 1000)
+
+    threads = [threading.Thread(target=store, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(os.path.join(str(tmp_path), 'size')) as f:
+        size = int(f.read())
+    assert size == sum(e[1] for e in ObjectCache(str(tmp_path))._entries())
+
+
+def test_cache_key_depends_on_inputs():
+    cmd = 'gcc -c -o @DOTO@ -x c @DOTI@'.split()
+    key = cache_key(b'digest', cmd, 'gcc:1')
+    assert key == cache_key(b'digest', cmd, 'gcc:1')
+    assert key != cache_key(b'digest2', cmd, 'gcc:1')
+    assert key != cache_key(b'digest', cmd + ['-O2'], 'gcc:1')
+    assert key != cache_key(b'digest', cmd, 'gcc:2')
+
+
+def test_digest_writer():
+    out = io.BytesIO()
+    writer = DigestWriter(out, doti_hash())
+    writer.write(b'int x;')
+    expected = doti_hash()
+    expected.update(b'int x;')
+    assert out.getvalue() == b'int x;'
+    assert writer.digest() == expected.digest()
@@ -0,0 +1,103 @@
+import os
+import subprocess
+import sys
+
+from ..sched import (
+    BACKOFF_MIN,
+    Scheduler,
+)
+
+
+def _hosts():
+    return [
+        {'host': 'a', 'port': 3632, 'weight': 3},
+        {'host': 'b', 'port': 3632, 'weight': 1},
+        {'host': 'localhost', 'port': 3632, 'weight': 1},
+    ]
+
+
+def test_slots_by_weight(tmp_path):
+    sched = Scheduler(_hosts(), str(tmp_path))
+    leases = [sched.try_lease('cmd') for _ in range(5)]
+    assert all(lease is not None for lease in leases)
+    hosts = [lease.host['host'] for lease in leases]
+    # first slots of all hosts go first
+    assert sorted(hosts[:3]) == ['a', 'b', 'localhost']
+    assert hosts[3:] == ['a', 'a']
+    assert sched.try_lease('cmd') is None
+    leases[3].release()
+    assert sched.try_lease('cmd').host['host'] == 'a'
+
+
+def test_exclude(tmp_path):
+    hosts = _hosts()
+    sched = Scheduler(hosts, str(tmp_path))
+    lease = sched.lease('cmd', exclude=hosts[:2])
+    assert lease.host['host'] == 'localhost'
+    lease.release()
+    assert sched.lease('cmd', exclude=hosts) is None
+
+
+def test_slots_shared_between_processes(tmp_path):
+    hosts = [{'host': 'a', 'port': 3632, 'weight': 1}]
+    sched = Scheduler(hosts, str(tmp_path))
+    script = ('import sys; from pdistcc.sched import Scheduler; '
+              'hosts = [{"host": "a", "port": 3632, "weight": 1}]; '
+              'print(Scheduler(hosts, sys.argv[1]).try_lease("cmd") is None)')
+    with sched.try_lease('cmd'):
+        out = subprocess.check_output([sys.executable, '-c', script,
+                                       str(tmp_path)])
+        assert out.strip() == b'True'
+    out = subprocess.check_output([sys.executable, '-c', script, str(tmp_path)])
+    assert out.strip() == b'False'
+
+
+def test_backoff(tmp_path):
+    now = [1000.0]
+    hosts = _hosts()[:2]
+    sched = Scheduler(hosts, str(tmp_path), clock=lambda: now[0])
+    # another process sharing the lock directory
+    other = Scheduler(hosts, str(tmp_path), clock=lambda: now[0])
+    sched.host_failed(hosts[1])
+    for _ in range(4):
+        with other.try_lease('cmd') as lease:
+            assert lease.host['host'] == 'a'
+    now[0] += BACKOFF_MIN
+    # the backoff period is over, a single job probes the host
+    probe = sched.try_lease('cmd', exclude=hosts[:1])
+    assert probe.host['host'] == 'b'
+    assert other.try_lease('cmd', exclude=hosts[:1]) is None
+    probe.release()
+    # fails again: skipped twice as long
+    sched.host_failed(hosts[1])
+    now[0] += 1.5*BACKOFF_MIN
+    assert other.lease('cmd', exclude=hosts[:1]) is None
+    now[0] += BACKOFF_MIN
+    with other.try_lease('cmd', exclude=hosts[:1]) as lease:
+        assert lease.host['host'] == 'b'
+    other.host_ok(hosts[1])
+    with sched.try_lease('cmd', exclude=hosts[:1]) as lease:
+        assert lease.host['host'] == 'b'
+    assert not any(name.startswith('backoff') for name in os.listdir(str(tmp_path)))
+
+
+def test_lease_local(tmp_path):
+    hosts = _hosts()
+    sched = Scheduler(hosts, str(tmp_path), sleep=lambda delay: None)
+    lease = sched.lease_local('cmd')
+    assert lease.host['host'] == 'localhost'
+    # the remote hosts are free, yet the next local job waits
+    assert sched.try_lease('cmd', exclude=hosts[:2]) is None
+    lease.release()
+    assert Scheduler(hosts[:2], str(tmp_path)).lease_local('cmd') is None
+
+
+def test_ordered(tmp_path):
+    hosts = _hosts()
+    sched = Scheduler(hosts, str(tmp_path))
+    order = [hosts[1], hosts[0]]
+    # all slots of the first host in the order, then the next one
+    leases = [sched.try_lease('cmd', order=order) for _ in range(3)]
+    assert [lease.host['host'] for lease in leases] == ['b', 'a', 'a']
+    assert sched.try_lease('cmd', exclude=hosts[:2],
+                           order=order).host['host'] == 'localhost'
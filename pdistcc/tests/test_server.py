@@ -1,6 +1,16 @@
 
+import asyncio
+import concurrent.futures
+import io
+import os
+import pytest
+import socket
 import subprocess
+import sys
+import threading
+import time
 
+from pytest_mock import mocker
 from unittest.mock import MagicMock
 
 from .fakeops import (
@@ -9,8 +19,23 @@ from .fakeops import (
     FakeTempFileFactory,
 )
 
+from ..compression import get_codec
+from ..net import (
+    DCC_VERSION_PUMP,
+    DccClient,
+    DccSession,
+    JobFailed,
+    ServerBusy,
+    chunked_read_decompress,
+    compress_file,
+    dcc_encode,
+)
+from ..objcache import ObjectCache
 from ..server import (
-    Distccd
+    CompileSlots,
+    Distccd,
+    _reject_connection,
+    cleanup_scratch_dir,
 )
 
 
@@ -47,6 +72,8 @@ def test_distccd_normal():
     compiler_cmd = 'gcc -c -o foo_1.o -x c foo_0.ii'.split()
 
     mock_popen.assert_called_once_with(compiler_cmd,
+                                       cwd=None,
+                                       stdin=None,
                                        stdout=subprocess.PIPE,
                                        stderr=subprocess.PIPE)
     faketempfile.file(0).seek(0)
@@ -58,3 +85,466 @@ def test_distccd_normal():
         b'SOUT', b'00000004', b'SOUT',
         b'DOTO', b'00000004', b'FAKE',
     ])
+
+
+def test_distccd_cache_hit(mocker, tmp_path):
+    source = b'int f(int x,int y){return x+y;}'
+    job = b''.join([
+        b'DIST', b'00000001',
+        b'ARGC', b'00000005',
+        b'ARGV', b'00000003', b'gcc',
+        b'ARGV', b'00000002', b'-c',
+        b'ARGV', b'00000002', b'-o',
+        b'ARGV', b'00000005', b'foo.o',
+        b'ARGV', b'00000005', b'foo.c'
+        b'DOTI', b'0000001f', source,
+    ])
+    reply = b''.join([
+        b'DONE', b'00000001',
+        b'STAT', b'00000000',
+        b'SERR', b'00000004', b'SERR',
+        b'SOUT', b'00000004', b'SOUT',
+        b'DOTO', b'00000004', b'FAKE',
+    ])
+    mocker.patch('pdistcc.server.compiler_identity', return_value='gcc:1')
+    objcache = ObjectCache(str(tmp_path))
+
+    def run(tempnames):
+        sock = FakeSocket(job)
+        mock_popen = MagicMock()
+        mock_popen.return_value.communicate.return_value = (b'SOUT', b'SERR')
+        mock_popen.return_value.returncode = 0
+        fileops = FakeFileOpsFactory({tempnames[1]: b'FAKE'})
+        Distccd({}, sock, ('127.0.0.1', '3632'), {},
+                fileops=fileops,
+                tempfile=FakeTempFileFactory(tempnames),
+                popen=mock_popen,
+                objcache=objcache)
+        return sock, mock_popen
+
+    sock, mock_popen = run(['foo_0.ii', 'foo_1.o'])
+    mock_popen.assert_called_once()
+    assert sock._write.getvalue() == reply
+
+    # temporary file names differ, yet the result is served from the cache
+    sock, mock_popen = run(['foo_2.ii', 'foo_3.o'])
+    mock_popen.assert_not_called()
+    assert sock._write.getvalue() == reply
+
+
+def test_distccd_compressed():
+    source = b'int f(int x,int y){return x+y;}'
+    codec = get_codec('zlib')
+    compressed = compress_file(codec, io.BytesIO(source), len(source))
+    job = b''.join([
+        b'DIST', b'00000002',
+        b'COMP', b'00000002',
+        b'ARGC', b'00000005',
+        b'ARGV', b'00000003', b'gcc',
+        b'ARGV', b'00000002', b'-c',
+        b'ARGV', b'00000002', b'-o',
+        b'ARGV', b'00000005', b'foo.o',
+        b'ARGV', b'00000005', b'foo.c',
+        dcc_encode('DOTI', len(compressed)), compressed,
+    ])
+    sock = FakeSocket(job)
+    mock_popen = MagicMock()
+    mock_popen.return_value.communicate.return_value = (b'', b'')
+    mock_popen.return_value.returncode = 0
+    fileops = FakeFileOpsFactory({'foo_1.o': b'FAKE'})
+    faketempfile = FakeTempFileFactory(['foo_0.ii', 'foo_1.o'])
+    Distccd({}, sock, ('127.0.0.1', '3632'), {},
+            fileops=fileops,
+            tempfile=faketempfile,
+            popen=mock_popen)
+    assert faketempfile.file(0).getvalue() == source
+
+    reply = FakeSocket(sock._write.getvalue())
+    assert reply.recv(52) == b''.join([
+        b'DONE', b'00000002',
+        b'STAT', b'00000000',
+        b'SERR', b'00000000',
+        b'SOUT', b'00000000',
+    ]) + b'DOTO'
+    doto_len = int(reply.recv(8), 16)
+    doto = io.BytesIO()
+    chunked_read_decompress(reply, doto, doto_len, codec)
+    assert doto.getvalue() == b'FAKE'
+
+
+def test_distccd_compressed_chunks(tmp_path):
+    codec = get_codec('zlib')
+    request = FakeSocket()
+    source = b'int f(int x,int y){return x+y;}' * 1000
+    dcc = DccClient(request, 'foo.ii', 'foo.o',
+                    fileops=FakeFileOpsFactory({'foo.ii': source}), codec=codec)
+    dcc.request('gcc -c -o foo.o foo.c'.split())
+    sock = FakeSocket(request._write.getvalue())
+    mock_popen = MagicMock()
+    mock_popen.return_value.communicate.return_value = (b'', b'')
+    mock_popen.return_value.returncode = 0
+    fakeobj = b'FAKEELF' * 100000
+    faketempfile = FakeTempFileFactory(['foo_0.ii', 'foo_1.o'])
+    Distccd({}, sock, ('127.0.0.1', '3632'), {},
+            fileops=FakeFileOpsFactory({'foo_1.o': fakeobj}),
+            tempfile=faketempfile,
+            popen=mock_popen)
+    assert faketempfile.file(0).getvalue() == source
+    reply = sock._write.getvalue()
+    assert b'DOTC00000000CHNK' in reply
+    ofile = tmp_path / 'foo.o'
+    dcc = DccClient(FakeSocket(reply), 'foo.ii', str(ofile), codec=codec)
+    assert dcc.handle_response() == 0
+    assert ofile.read_bytes() == fakeobj
+
+
+def test_distccd_lzo_unavailable(monkeypatch):
+    # distcc clients send no COMP token, LZO is implied
+    monkeypatch.setattr('pdistcc.compression.CODECS',
+                        {'zlib': get_codec('zlib')})
+    job = b''.join([
+        b'DIST', b'00000002',
+        b'ARGC', b'00000001',
+        b'ARGV', b'00000003', b'gcc',
+        b'DOTI', b'00000004', b'LZO!',
+    ])
+    sock = FakeSocket(job)
+    popen = MagicMock()
+    Distccd({}, sock, ('127.0.0.1', '3632'), {}, popen=popen)
+    popen.assert_not_called()
+    # the request is read to the end, the job (not the server) has failed
+    assert sock._write.getvalue() == dcc_encode('JOBE', 0)
+    dcc = DccClient(FakeSocket(sock._write.getvalue()), 'foo.ii', 'foo.o')
+    with pytest.raises(JobFailed):
+        dcc.handle_response()
+
+
+def test_distccd_lzo(tmp_path):
+    pytest.importorskip('lzo')
+    codec = get_codec('lzo')
+    source = b'int f(int x,int y){return x+y;}' * 100
+    compressed = compress_file(codec, io.BytesIO(source), len(source))
+    job = b''.join([
+        b'DIST', b'00000002',
+        b'ARGC', b'00000005',
+        b'ARGV', b'00000003', b'gcc',
+        b'ARGV', b'00000002', b'-c',
+        b'ARGV', b'00000002', b'-o',
+        b'ARGV', b'00000005', b'foo.o',
+        b'ARGV', b'00000005', b'foo.c',
+        dcc_encode('DOTI', len(compressed)), compressed,
+    ])
+    sock = FakeSocket(job)
+    mock_popen = MagicMock()
+    mock_popen.return_value.communicate.return_value = (b'', b'')
+    mock_popen.return_value.returncode = 0
+    faketempfile = FakeTempFileFactory(['foo_0.ii', 'foo_1.o'])
+    Distccd({}, sock, ('127.0.0.1', '3632'), {},
+            fileops=FakeFileOpsFactory({'foo_1.o': b'FAKE' * 100}),
+            tempfile=faketempfile,
+            popen=mock_popen)
+    assert faketempfile.file(0).getvalue() == source
+    # a single LZO block, as distcc expects
+    ofile = tmp_path / 'foo.o'
+    dcc = DccClient(FakeSocket(sock._write.getvalue()), 'foo.ii', str(ofile),
+                    codec=codec)
+    assert dcc.handle_response() == 0
+    assert ofile.read_bytes() == b'FAKE' * 100
+
+
+def test_distccd_pump(tmp_path):
+    codec = get_codec('zlib')
+    request = FakeSocket()
+    client_files = FakeFileOpsFactory({
+        '/src/foo.c': b'#include "foo.h"\n',
+        '/src/inc/foo.h': b'int x;\n',
+    })
+    dcc = DccClient(request, None, 'foo.o', fileops=client_files, codec=codec)
+    dcc.request_pump('gcc -c -Iinc -o foo.o foo.c'.split(), '/src',
+                     ['/src/foo.c', '/src/inc/foo.h'])
+
+    sock = FakeSocket(request._write.getvalue())
+    mock_popen = MagicMock()
+    mock_popen.return_value.communicate.return_value = (b'', b'')
+    mock_popen.return_value.returncode = 0
+    fileops = FakeFileOpsFactory({'foo_0.o': b'FAKE'})
+    root = str(tmp_path / 'root')
+    os.makedirs(root)
+    seen = {}
+
+    def check_files(cmd, cwd, stdin, stdout, stderr):
+        with open(os.path.join(root, 'src', 'inc', 'foo.h'), 'rb') as f:
+            seen['foo.h'] = f.read()
+        return mock_popen.return_value
+
+    mock_popen.side_effect = check_files
+    Distccd({}, sock, ('127.0.0.1', '3632'), {},
+            fileops=fileops,
+            tempfile=FakeTempFileFactory(['foo_0.o']),
+            mkdtemp=lambda prefix, suffix, dir: root,
+            popen=mock_popen)
+    mock_popen.assert_called_once_with(
+        ['gcc', '-c', '-Iinc', '-o', 'foo_0.o', 'foo.c',
+         '-ffile-prefix-map={}='.format(root)],
+        cwd=os.path.join(root, 'src'),
+        stdin=None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    assert seen['foo.h'] == b'int x;\n'
+    # per job root is removed
+    assert not os.path.exists(root)
+    assert sock._write.getvalue().startswith(dcc_encode('DONE', DCC_VERSION_PUMP)
+                                             + b'STAT00000000')
+
+
+def test_distccd_stream():
+    source = b'int f(int x,int y){return x+y;}'
+    job = b''.join([
+        b'DIST', b'00000001',
+        b'ARGC', b'00000005',
+        b'ARGV', b'00000003', b'gcc',
+        b'ARGV', b'00000002', b'-c',
+        b'ARGV', b'00000002', b'-o',
+        b'ARGV', b'00000005', b'foo.o',
+        b'ARGV', b'00000005', b'foo.c',
+        b'DOTC', b'00000000',
+        dcc_encode('CHNK', 10), source[:10],
+        dcc_encode('CHNK', len(source) - 10), source[10:],
+        b'CHNK', b'00000000',
+    ])
+    sock = FakeSocket(job)
+    mock_popen = MagicMock()
+    mock_popen.return_value.communicate.return_value = (b'', b'')
+    mock_popen.return_value.returncode = 0
+    fileops = FakeFileOpsFactory({'foo_1.o': b'FAKE'})
+    faketempfile = FakeTempFileFactory(['foo_0.ii', 'foo_1.o'])
+    Distccd({}, sock, ('127.0.0.1', '3632'), {},
+            fileops=fileops,
+            tempfile=faketempfile,
+            popen=mock_popen)
+    assert faketempfile.file(0).getvalue() == source
+    assert sock._write.getvalue().endswith(b'DOTO00000004FAKE')
+
+
+def test_distccd_compile_from_stdin():
+    source = b'int f(int x,int y){return x+y;}'
+    job = b''.join([
+        b'DIST', b'00000001',
+        b'ARGC', b'00000005',
+        b'ARGV', b'00000003', b'gcc',
+        b'ARGV', b'00000002', b'-c',
+        b'ARGV', b'00000002', b'-o',
+        b'ARGV', b'00000005', b'foo.o',
+        b'ARGV', b'00000005', b'foo.c',
+        b'DOTI', b'0000001f', source,
+    ])
+    sock = FakeSocket(job)
+    mock_popen = MagicMock()
+    mock_popen.return_value.communicate.return_value = (b'', b'')
+    mock_popen.return_value.returncode = 0
+    fileops = FakeFileOpsFactory({'foo_0.o': b'FAKE'})
+    # only the object file is created
+    faketempfile = FakeTempFileFactory(['foo_0.o'])
+    Distccd({'compile_from_stdin': True}, sock, ('127.0.0.1', '3632'), {},
+            fileops=fileops,
+            tempfile=faketempfile,
+            popen=mock_popen)
+    mock_popen.assert_called_once_with('gcc -c -o foo_0.o -x c -'.split(),
+                                       cwd=None,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+    mock_popen.return_value.communicate.assert_called_once_with(input=source)
+    assert sock._write.getvalue().endswith(b'DOTO00000004FAKE')
+
+
+def test_cleanup_scratch_dir(tmp_path):
+    stale = tmp_path / 'pdistccd-foo.ii'
+    stale.write_bytes(b'')
+    os.utime(str(stale), (0, 0))
+    stale_dir = tmp_path / 'pdistccd-foo.pump'
+    stale_dir.mkdir()
+    os.utime(str(stale_dir), (0, 0))
+    fresh = tmp_path / 'pdistccd-bar.ii'
+    fresh.write_bytes(b'')
+    unrelated = tmp_path / 'foo.ii'
+    unrelated.write_bytes(b'')
+    os.utime(str(unrelated), (0, 0))
+    cleanup_scratch_dir(str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ['foo.ii', 'pdistccd-bar.ii']
+
+
+def test_compile_slots():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        slots = CompileSlots(loop, 2)
+        cmd = [sys.executable, '-c',
+               'import sys, time; time.sleep(0.3); sys.stdout.write(sys.stdin.read())']
+        queue_times = []
+
+        def compile(n):
+            proc = slots.popen(cmd,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+            out, err = proc.communicate(input=str(n).encode())
+            queue_times.append(proc.queue_time)
+            return proc.returncode, out
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(compile, range(4)))
+        elapsed = time.perf_counter() - start
+        assert results == [(0, str(n).encode()) for n in range(4)]
+        # 4 jobs, 2 slots: two rounds
+        assert elapsed >= 0.6
+        # the second round has waited for the first one
+        assert sorted(queue_times)[2] >= 250
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_reject_connection():
+    class FakeLoad:
+        queued = 7
+
+    server, client = socket.socketpair()
+    server.setblocking(False)
+    client.sendall(dcc_encode('DIST', 1) + b'x' * 1000)
+
+    async def reject():
+        loop = asyncio.get_running_loop()
+        await _reject_connection(loop, server, 'test', FakeLoad(), 'queue is full')
+
+    thread = threading.Thread(target=asyncio.run, args=(reject(),))
+    thread.start()
+    try:
+        dcc = DccClient(client, None, 'foo.o', io.BytesIO(), io.BytesIO())
+        with pytest.raises(ServerBusy) as excinfo:
+            dcc.check_busy(timeout=5)
+        assert excinfo.value.queued == 7
+        client.shutdown(socket.SHUT_WR)
+    finally:
+        thread.join()
+        client.close()
+
+
+def test_distccd_multiplexed(tmp_path):
+    slow_started = threading.Event()
+
+    class FakeCompiler:
+        def __init__(self, args, **kwargs):
+            self._args = args
+            self.returncode = 0
+
+        def communicate(self, input=None):
+            with open(self._args[-1], 'rb') as f:
+                source = f.read()
+            if source == b'fail':
+                raise OSError('no compiler')
+            if source == b'error':
+                self.returncode = 1
+                return b'', b'syntax error'
+            if source == b'slow':
+                # the fast job is done while this one is running
+                slow_started.set()
+                time.sleep(0.2)
+            else:
+                assert slow_started.wait(5)
+            ofile = self._args[self._args.index('-o') + 1]
+            with open(ofile, 'wb') as f:
+                f.write(b'OBJ ' + source)
+            return b'', source
+
+    server, client = socket.socketpair()
+    settings = {'scratch_dir': str(tmp_path / 'scratch')}
+    os.mkdir(settings['scratch_dir'])
+
+    def serve():
+        with server:
+            Distccd(settings, server, ('127.0.0.1', 0), None, popen=FakeCompiler)
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    def compile(name):
+        doti = str(tmp_path / (name + '.i'))
+        with open(doti, 'wb') as f:
+            f.write(name.encode())
+        ofile = str(tmp_path / (name + '.o'))
+        stderr = io.BytesIO()
+        ret = session.compile(doti, ['gcc', '-c', '-o', 'x.o', 'x.c'],
+                              ofile=ofile, stdout=io.BytesIO(), stderr=stderr)
+        if ret != 0:
+            return ret, stderr.getvalue(), None
+        with open(ofile, 'rb') as f:
+            return ret, stderr.getvalue(), f.read()
+
+    try:
+        with DccSession(conn=client) as session:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+                slow = pool.submit(compile, 'slow')
+                assert slow_started.wait(5)
+                assert compile('error') == (1, b'syntax error', None)
+                fast = pool.submit(compile, 'fast')
+                fail = pool.submit(compile, 'fail')
+                assert fast.result() == (0, b'fast', b'OBJ fast')
+                assert not slow.done()
+                assert slow.result() == (0, b'slow', b'OBJ slow')
+                with pytest.raises(JobFailed):
+                    fail.result()
+    finally:
+        thread.join()
+    assert os.listdir(settings['scratch_dir']) == []
+
+
+def test_distccd_multiplexed_rejected_job(tmp_path):
+    class FakeCompiler:
+        def __init__(self, args, **kwargs):
+            self._args = args
+            self.returncode = 0
+
+        def communicate(self, input=None):
+            with open(self._args[-1], 'rb') as f:
+                source = f.read()
+            ofile = self._args[self._args.index('-o') + 1]
+            with open(ofile, 'wb') as f:
+                f.write(b'OBJ ' + source)
+            return b'', b''
+
+    server, client = socket.socketpair()
+    settings = {'scratch_dir': str(tmp_path / 'scratch')}
+    os.mkdir(settings['scratch_dir'])
+
+    def serve():
+        with server:
+            Distccd(settings, server, ('127.0.0.1', 0), None, popen=FakeCompiler)
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    def compile(name, compiler='gcc', compression=None):
+        doti = str(tmp_path / (name + '.i'))
+        with open(doti, 'wb') as f:
+            f.write(name.encode()*10000)
+        ofile = str(tmp_path / (name + '.o'))
+        ret = session.compile(doti, [compiler, '-c', '-o', 'x.o', 'x.c'],
+                              ofile=ofile, stdout=io.BytesIO(),
+                              stderr=io.BytesIO(), compression=compression)
+        with open(ofile, 'rb') as f:
+            return ret, f.read()
+
+    try:
+        with DccSession(conn=client) as session:
+            assert compile('first') == (0, b'OBJ ' + b'first'*10000)
+            # the request is read to the end, the next job goes on
+            with pytest.raises(JobFailed):
+                compile('bad', compiler='javac', compression='zlib')
+            assert compile('second') == (0, b'OBJ ' + b'second'*10000)
+    finally:
+        thread.join()
+    assert os.listdir(settings['scratch_dir']) == []
@@ -0,0 +1,90 @@
+import json
+import os
+
+from pytest_mock import mocker
+
+from .. import trace
+from ..cli import main as client_main
+
+
+def test_tracer():
+    now = [1.0]
+    tracer = trace.Tracer(clock=lambda: now[0])
+    tracer.tag(tu='src/foo.c')
+    with tracer.span('preprocess'):
+        now[0] += 0.5
+    tracer.tag(host='a:3632')
+    try:
+        with tracer.span('upload', stream=True):
+            now[0] += 0.25
+            raise ConnectionResetError()
+    except ConnectionResetError:
+        pass
+    now[0] += 1
+    job, preprocess, upload = tracer.events()
+    assert (job['name'], job['cat'], job['ts'], job['dur']) == \
+        ('foo.c', 'job', 1000000, 1750000)
+    assert job['args'] == {'tu': 'src/foo.c', 'host': 'a:3632'}
+    assert (preprocess['name'], preprocess['ts'], preprocess['dur']) == \
+        ('preprocess', 1000000, 500000)
+    assert preprocess['args'] == {'tu': 'src/foo.c'}
+    assert upload['dur'] == 250000
+    assert upload['args'] == {
+        'tu': 'src/foo.c', 'host': 'a:3632', 'stream': True,
+        'error': 'ConnectionResetError',
+    }
+
+
+def test_trace_disabled(monkeypatch):
+    monkeypatch.delenv(trace.TRACE_DIR_ENV, raising=False)
+    trace.start()
+    with trace.span('preprocess'):
+        pass
+    trace.finish()
+
+
+def test_trace_client(mocker, monkeypatch, tmp_path):
+    monkeypatch.setenv(trace.TRACE_DIR_ENV, str(tmp_path))
+
+    def wrap_compiler(hosts, args, settings):
+        trace.tag(tu='foo.c')
+        with trace.span('upload'):
+            pass
+
+    mocker.patch('pdistcc.cli.wrap_compiler', side_effect=wrap_compiler)
+    client_main(['--host', 'a:1111/1', '--', 'gcc', '-c', 'foo.c'],
+                {'distcc_hosts': None})
+    files = os.listdir(str(tmp_path))
+    assert len(files) == 1 and files[0].startswith('pdistcc-')
+    with open(str(tmp_path / files[0])) as f:
+        events = json.load(f)['traceEvents']
+    assert [e['name'] for e in events] == ['foo.c', 'settings', 'upload']
+
+
+def _job(pid, tu, start, dur):
+    return {'traceEvents': [
+        {'name': tu, 'cat': 'job', 'ph': 'X', 'ts': start, 'dur': dur,
+         'pid': pid, 'tid': pid, 'args': {'tu': tu}},
+        {'name': 'wait', 'cat': 'pdistcc', 'ph': 'X', 'ts': start + 1,
+         'dur': dur - 2, 'pid': pid, 'tid': pid, 'args': {'tu': tu}},
+    ]}
+
+
+def test_trace_merge(tmp_path):
+    jobs = [(1, 'a.c', 1000, 100), (2, 'b.c', 1050, 100), (3, 'c.c', 1100, 10)]
+    for pid, tu, start, dur in jobs:
+        with open(str(tmp_path / 'pdistcc-{}-{}.json'.format(pid, start)), 'w') as f:
+            json.dump(_job(pid, tu, start, dur), f)
+    (tmp_path / 'unrelated.json').write_text('{}')
+    merged = trace.merge([str(tmp_path)])
+    spans = [e for e in merged['traceEvents'] if e['ph'] == 'X']
+    rows = {e['name']: (e['tid'], e['ts']) for e in spans if e['cat'] == 'job'}
+    # c.c has started when a.c was done
+    assert rows == {'a.c': (0, 0), 'b.c': (1, 50), 'c.c': (0, 100)}
+    assert all(e['pid'] == 1 for e in merged['traceEvents'])
+    threads = [e['args']['name'] for e in merged['traceEvents']
+               if e['name'] == 'thread_name']
+    assert threads == ['job 0', 'job 1']
+    wall, totals = trace.summary(merged)
+    assert wall == 150
+    assert totals == [('job', 3, 210), ('wait', 3, 204)]
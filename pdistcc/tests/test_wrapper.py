@@ -1,4 +1,5 @@
 
+import os
 import pytest
 import subprocess
 
@@ -35,7 +36,10 @@ def test_wrapper(mocker):
         'gcc -c -o foo.o -x c foo.i'.split(),
         host=host,
         port=port,
-        ofile='foo.o'
+        ofile='foo.o',
+        compression=None,
+        connect_timeout=None,
+        io_timeout=None,
     )
     subprocess.check_output.assert_called_once_with(
         'gcc -E -o foo.i foo.c'.split()
@@ -90,3 +94,266 @@ def test_wrapper_called_for_preprocessing(mocker):
     wrapper.preprocessor_cmd.assert_not_called()
     subprocess.check_output.assert_not_called()
     pdistcc.compiler.wrapper.dcc_compile.assert_not_called()
+
+
+def _cached_wrapper(tmp_path):
+    settings = {'object_cache': {'dir': str(tmp_path / 'cache')}}
+    wrapper = CompilerWrapper('gcc -c -o foo.o foo.c'.split(), settings)
+    setattr(wrapper, 'called_for_preprocessing', MagicMock())
+    wrapper.called_for_preprocessing.return_value = False
+    setattr(wrapper, 'can_handle_command', MagicMock())
+    setattr(wrapper, 'preprocessor_cmd', MagicMock())
+    wrapper.preprocessor_cmd.return_value = 'gcc -E -o foo.i foo.c'.split()
+    setattr(wrapper, 'compiler_cmd', MagicMock())
+    wrapper.compiler_cmd.return_value = 'gcc -c -o foo.o -x c foo.i'.split()
+    setattr(wrapper, 'object_file', MagicMock())
+    wrapper.object_file.return_value = str(tmp_path / 'foo.o')
+    setattr(wrapper, 'preprocessed_file', MagicMock())
+    wrapper.preprocessed_file.return_value = str(tmp_path / 'foo.i')
+    return wrapper
+
+
+def test_wrapper_local_cache(mocker, tmp_path):
+    mocker.patch('subprocess.check_output')
+    mocker.patch('pdistcc.compiler.wrapper.compiler_identity',
+                 return_value='gcc:1')
+    (tmp_path / 'foo.i').write_bytes(b'int x;')
+
+    def fake_compile(doti, args, host, port, ofile, stdout, stderr,
+                     compression, **timeouts):
+        with open(ofile, 'wb') as f:
+            f.write(b'FAKEELF')
+        return 0
+
+    mocker.patch('pdistcc.compiler.wrapper.dcc_compile',
+                 side_effect=fake_compile)
+    _cached_wrapper(tmp_path).wrap_compiler('127.0.0.1', 3632)
+    pdistcc.compiler.wrapper.dcc_compile.assert_called_once()
+
+    # same preprocessed source: served from the cache, no network round trip
+    (tmp_path / 'foo.o').unlink()
+    pdistcc.compiler.wrapper.dcc_compile.reset_mock()
+    _cached_wrapper(tmp_path).wrap_compiler('127.0.0.1', 3632)
+    pdistcc.compiler.wrapper.dcc_compile.assert_not_called()
+    assert (tmp_path / 'foo.o').read_bytes() == b'FAKEELF'
+
+    # preprocessed source has changed: cache miss
+    (tmp_path / 'foo.i').write_bytes(b'int y;')
+    _cached_wrapper(tmp_path).wrap_compiler('127.0.0.1', 3632)
+    pdistcc.compiler.wrapper.dcc_compile.assert_called_once()
+
+
+def test_pump_compile_failed(mocker):
+    mocker.patch('pdistcc.compiler.wrapper.dcc_pump_compile', return_value=1)
+    wrapper = CompilerWrapper('gcc -c -MD -o foo.o foo.c'.split())
+    setattr(wrapper, 'pump_files', MagicMock())
+    wrapper.pump_files.return_value = ['/src/foo.c', '/src/foo.h']
+    setattr(wrapper, 'object_file', MagicMock())
+    setattr(wrapper, 'write_dependency_file', MagicMock())
+    assert wrapper.compile_remote('127.0.0.1', 3632, pump=True) == 1
+    # no dependency file for a failed compilation
+    wrapper.write_dependency_file.assert_not_called()
+
+
+def test_wrap_compiler_busy_failover(mocker, tmp_path):
+    from ..compiler import wrap_compiler
+    from ..net import ServerBusy
+    wrapper = MagicMock()
+    wrapper.prepare.return_value = True
+    wrapper.compile_remote.side_effect = ServerBusy(3)
+    mocker.patch('pdistcc.compiler.find_compiler_wrapper', return_value=wrapper)
+    mocker.patch('subprocess.check_call')
+    hosts = [{'host': 'a', 'port': 3632, 'weight': 1},
+             {'host': 'b', 'port': 3632, 'weight': 1}]
+    compiler_cmd = 'gcc -c -o foo.o foo.c'.split()
+    settings = {'lock_dir': str(tmp_path), 'history': None,
+                'inventory_ttl': None}
+    wrap_compiler(hosts, compiler_cmd, settings)
+    # the source is preprocessed once, then tried on both servers
+    wrapper.prepare.assert_called_once()
+    assert sorted(c[0][0] for c in wrapper.compile_remote.call_args_list) == \
+        ['a', 'b']
+    # all servers are busy: compile locally
+    subprocess.check_call.assert_called_once_with(compiler_cmd)
+
+
+def test_wrap_compiler_failover(mocker, tmp_path):
+    from ..compiler import wrap_compiler
+    from ..sched import Scheduler
+    wrapper = MagicMock()
+    wrapper.prepare.return_value = True
+
+    def compile_remote(host, port, **kwargs):
+        if host == 'a':
+            raise ConnectionRefusedError()
+        return 1
+
+    wrapper.compile_remote.side_effect = compile_remote
+    mocker.patch('pdistcc.compiler.find_compiler_wrapper', return_value=wrapper)
+    mocker.patch('subprocess.check_call')
+    hosts = [{'host': 'a', 'port': 3632, 'weight': 1},
+             {'host': 'b', 'port': 3632, 'weight': 1}]
+    compiler_cmd = 'gcc -c -o foo.o foo.c'.split()
+    settings = {'lock_dir': str(tmp_path), 'history': None,
+                'inventory_ttl': None}
+    # the status of the compiler on the other server
+    for _ in range(2):
+        assert wrap_compiler(hosts, compiler_cmd, settings) == 1
+    # 'a' has failed once, the second job went to 'b' right away
+    assert [c[0][0] for c in wrapper.compile_remote.call_args_list].count('a') == 1
+    assert Scheduler(hosts, str(tmp_path)).try_lease('cmd').host['host'] == 'b'
+    subprocess.check_call.assert_not_called()
+
+
+def test_wrap_compiler_local_fallback(mocker, tmp_path):
+    from ..compiler import wrap_compiler
+    from ..net import ProtocolError
+    wrapper = MagicMock()
+    wrapper.prepare.return_value = True
+    wrapper.compile_remote.side_effect = ProtocolError('garbage')
+    mocker.patch('pdistcc.compiler.find_compiler_wrapper', return_value=wrapper)
+    mocker.patch('subprocess.check_call')
+    hosts = [{'host': h, 'port': 3632, 'weight': 1} for h in 'abc']
+    compiler_cmd = 'gcc -c -o foo.o foo.c'.split()
+    settings = {'lock_dir': str(tmp_path), 'remote_attempts': 2,
+                'history': None, 'inventory_ttl': None}
+    assert wrap_compiler(hosts, compiler_cmd, settings) == 0
+    # gave up after two failed servers
+    assert wrapper.compile_remote.call_count == 2
+    subprocess.check_call.assert_called_once_with(compiler_cmd)
+
+
+def test_wrap_compiler_reply_timeout(mocker, tmp_path):
+    from ..compiler import wrap_compiler
+    from ..net import ReplyTimeout
+    from ..sched import Scheduler
+    wrapper = MagicMock()
+    wrapper.prepare.return_value = True
+    wrapper.compile_remote.side_effect = ReplyTimeout('no reply')
+    mocker.patch('pdistcc.compiler.find_compiler_wrapper', return_value=wrapper)
+    mocker.patch('subprocess.check_call')
+    hosts = [{'host': h, 'port': 3632, 'weight': 1} for h in 'ab']
+    compiler_cmd = 'gcc -c -o foo.o foo.c'.split()
+    settings = {'lock_dir': str(tmp_path), 'history': None,
+                'inventory_ttl': None}
+    assert wrap_compiler(hosts, compiler_cmd, settings) == 0
+    # a slow job is not retried elsewhere, the server is not skipped
+    assert wrapper.compile_remote.call_count == 1
+    subprocess.check_call.assert_called_once_with(compiler_cmd)
+    leases = [Scheduler(hosts, str(tmp_path)).try_lease('cmd')
+              for _ in range(2)]
+    assert sorted(lease.host['host'] for lease in leases) == ['a', 'b']
+
+
+def test_wrap_compiler_rejected_job(mocker, tmp_path):
+    from ..compiler import wrap_compiler
+    from ..net import JobFailed
+    wrapper = MagicMock()
+    wrapper.prepare.return_value = True
+
+    def compile_remote(host, port, **kwargs):
+        if host == 'a':
+            raise JobFailed('the server has rejected the job')
+        return 0
+
+    wrapper.compile_remote.side_effect = compile_remote
+    mocker.patch('pdistcc.compiler.find_compiler_wrapper', return_value=wrapper)
+    mocker.patch('subprocess.check_call')
+    hosts = [{'host': h, 'port': 3632, 'weight': 1} for h in 'ab']
+    compiler_cmd = 'gcc -c -o foo.o foo.c'.split()
+    settings = {'lock_dir': str(tmp_path), 'history': None,
+                'inventory_ttl': None}
+    for _ in range(2):
+        assert wrap_compiler(hosts, compiler_cmd, settings) == 0
+    # the job is retried elsewhere, but 'a' is not backed off: the next
+    # job tries it again
+    assert [c[0][0] for c in wrapper.compile_remote.call_args_list].count('a') == 2
+    assert not [f for f in os.listdir(str(tmp_path))
+                if f.startswith('backoff_')]
+    subprocess.check_call.assert_not_called()
+
+
+def test_wrap_compiler_records_winner(mocker, tmp_path, monkeypatch):
+    from ..compiler import wrap_compiler
+    from ..history import History
+    monkeypatch.chdir(tmp_path)
+    hosts = [{'host': h, 'port': 3632, 'weight': 1} for h in 'ab']
+    wrapper = MagicMock()
+    wrapper.prepare.return_value = True
+    wrapper.source_file.return_value = 'foo.c'
+
+    def compile_remote(host, port, **kwargs):
+        # the duplicate sent to the other server has won
+        wrapper.remote_host = hosts[1] if host == 'a' else hosts[0]
+        wrapper.remote_duration = 2.0
+        wrapper.remote_size = 100
+        return 0
+
+    wrapper.compile_remote.side_effect = compile_remote
+    mocker.patch('pdistcc.compiler.find_compiler_wrapper', return_value=wrapper)
+    close = mocker.spy(History, 'close')
+    path = str(tmp_path / 'history.sqlite')
+    settings = {'lock_dir': str(tmp_path), 'history': path,
+                'inventory_ttl': None}
+    compiler_cmd = 'gcc -c -o foo.o foo.c'.split()
+    assert wrap_compiler(hosts, compiler_cmd, settings) == 0
+    close.assert_called_once()
+    asked = wrapper.compile_remote.call_args[0][0]
+    durations = History(path).durations(str(tmp_path / 'foo.c'), 'gcc')
+    assert list(durations) == ['{}:3632'.format('b' if asked == 'a' else 'a')]
+
+
+def test_expected_duration():
+    args = 'gcc -c -o foo.o foo.c'.split()
+    assert CompilerWrapper(args).expected_duration(1024) is None
+    settings = {'hedge_delay': 10, 'hedge_delay_per_mb': 2}
+    wrapper = CompilerWrapper(args, settings)
+    assert wrapper.expected_duration(3*1024*1024) == 16
+    # the recorded durations of similar jobs win, hedge_delay is the floor
+    assert wrapper.expected_duration(3*1024*1024, 40) == 40
+    assert wrapper.expected_duration(3*1024*1024, 4) == 10
+
+
+def test_wrapper_direct_mode(mocker, tmp_path, monkeypatch):
+    from ..compiler.gcc import GCCWrapper
+    monkeypatch.chdir(tmp_path)
+    mocker.patch('pdistcc.compiler.wrapper.compiler_identity',
+                 return_value='gcc:1')
+    (tmp_path / 'foo.c').write_bytes(b'#include "foo.h"\n')
+    (tmp_path / 'foo.h').write_bytes(b'int x;\n')
+
+    def preprocess(cmd):
+        assert cmd[-4:] == ['-MF', 'foo.d', '-MQ', 'foo.o']
+        (tmp_path / 'foo.i').write_bytes((tmp_path / 'foo.h').read_bytes())
+        (tmp_path / 'foo.d').write_bytes(b'foo.o: foo.c foo.h\n')
+
+    def fake_compile(doti, args, host, port, ofile, stdout, stderr,
+                     compression, **timeouts):
+        with open(ofile, 'wb') as f:
+            f.write(b'FAKEELF')
+        return 0
+
+    mocker.patch('subprocess.check_output', side_effect=preprocess)
+    mocker.patch('pdistcc.compiler.wrapper.dcc_compile',
+                 side_effect=fake_compile)
+    settings = {'object_cache': {'dir': str(tmp_path / 'cache'),
+                                 'manifest_dir': str(tmp_path / 'manifests')}}
+    cmd = 'gcc -c -MD -o foo.o foo.c'.split()
+    assert GCCWrapper(cmd, settings).wrap_compiler('127.0.0.1', 3632) == 0
+    pdistcc.compiler.wrapper.dcc_compile.assert_called_once()
+
+    # unchanged source and headers: neither preprocessed nor compiled
+    (tmp_path / 'foo.o').unlink()
+    (tmp_path / 'foo.d').unlink()
+    subprocess.check_output.reset_mock()
+    assert not GCCWrapper(cmd, settings).prepare()
+    subprocess.check_output.assert_not_called()
+    assert (tmp_path / 'foo.o').read_bytes() == b'FAKEELF'
+    assert (tmp_path / 'foo.d').read_bytes() == b'foo.o: foo.c foo.h\n'
+
+    # a header has changed
+    (tmp_path / 'foo.h').write_bytes(b'int y;\n')
+    assert GCCWrapper(cmd, settings).prepare()
+    # -MMD leaves out the system headers, no direct mode
+    (tmp_path / 'foo.h').write_bytes(b'int x;\n')
+    assert GCCWrapper('gcc -c -MMD -o foo.o foo.c'.split(), settings).prepare()
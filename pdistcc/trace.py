@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Traces of pdistcc invocations in the Chrome trace event format
+# (chrome://tracing, https://ui.perfetto.dev). With PDISTCC_TRACE_DIR set
+# every invocation writes its spans to a file in that directory, merge
+# them into a single trace of the whole build with
+#
+#   python3 -m pdistcc.trace $PDISTCC_TRACE_DIR -o build.json
+#
+# The client imports this module on every compiler invocation, keep it
+# light.
+
+import contextlib
+import os
+import sys
+import threading
+import time
+
+TRACE_DIR_ENV = 'PDISTCC_TRACE_DIR'
+TRACE_FILE_PREFIX = 'pdistcc-'
+CATEGORY = 'pdistcc'
+# the span covering the whole invocation, named after the source file
+JOB_CATEGORY = 'job'
+
+_NO_SPAN = contextlib.nullcontext()
+_tracer = None
+# thread ids as shown by the OS tools, Python 3.8+
+_thread_id = getattr(threading, 'get_native_id', threading.get_ident)
+
+
+class Tracer(object):
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._pid = os.getpid()
+        self._events = []
+        # added to the args of all spans which end afterwards
+        self._tags = {}
+        self._start = self._now()
+
+    def _now(self):
+        # microseconds, comparable between processes
+        return int(self._clock()*1000000)
+
+    def tag(self, **tags):
+        self._tags.update(tags)
+
+    def _event(self, name, start, end, args, cat=CATEGORY):
+        merged = dict(self._tags)
+        merged.update(args)
+        return {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start,
+            'dur': end - start,
+            'pid': self._pid,
+            'tid': _thread_id(),
+            'args': merged,
+        }
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start = self._now()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = type(e).__name__
+            raise
+        finally:
+            self._events.append(self._event(name, start, self._now(), args))
+
+    def events(self):
+        """Spans so far and the one of the whole invocation"""
+        name = os.path.basename(self._tags.get('tu') or 'pdistcc')
+        job = self._event(name, self._start, self._now(), {}, JOB_CATEGORY)
+        return [job] + self._events
+
+    def write(self, directory):
+        import json
+        os.makedirs(directory, exist_ok=True)
+        name = '{}{}-{}.json'.format(TRACE_FILE_PREFIX, self._pid, self._start)
+        path = os.path.join(directory, name)
+        # merge shouldn't see incomplete files
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'traceEvents': self.events()}, f)
+        os.replace(tmp, path)
+        return path
+
+
+def start():
+    """Start tracing the invocation if PDISTCC_TRACE_DIR is set"""
+    global _tracer
+    _tracer = Tracer() if os.environ.get(TRACE_DIR_ENV) else None
+
+
+def finish():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return
+    try:
+        tracer.write(os.environ[TRACE_DIR_ENV])
+    except (KeyError, OSError) as e:
+        import logging
+        logging.getLogger(__name__).warning('failed to write trace: %s', e)
+
+
+def span(name, **args):
+    """Context manager timing a part of the job, no-op unless tracing"""
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, **args)
+
+
+def tag(**tags):
+    """Set args (such as the translation unit or host) of later spans"""
+    if _tracer is not None:
+        _tracer.tag(**tags)
+
+
+def _trace_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for name in sorted(os.listdir(path)):
+            if name.startswith(TRACE_FILE_PREFIX) and name.endswith('.json'):
+                yield os.path.join(path, name)
+
+
+def _load_jobs(paths):
+    import json
+    jobs = []
+    for path in _trace_files(paths):
+        with open(path, 'r') as f:
+            events = json.load(f)['traceEvents']
+        if events:
+            jobs.append(events)
+    return jobs
+
+
+def merge(paths):
+    """Single trace of the jobs traced to the given files/directories.
+
+    Jobs are placed on rows (threads of a single process) so that jobs
+    which ran concurrently are on different rows, the number of rows is
+    the peak number of concurrent jobs.
+    """
+    import heapq
+    jobs = _load_jobs(paths)
+    for events in jobs:
+        events.sort(key=lambda e: (e['ts'], -e['dur']))
+    jobs.sort(key=lambda events: events[0]['ts'])
+    origin = jobs[0][0]['ts'] if jobs else 0
+    merged = [{'name': 'process_name', 'ph': 'M', 'pid': 1,
+               'args': {'name': 'build'}}]
+    # (end time, row) of the jobs on the rows, and the free rows
+    busy = []
+    free = []
+    rows = 0
+    for events in jobs:
+        start = events[0]['ts']
+        end = max(e['ts'] + e['dur'] for e in events)
+        while busy and busy[0][0] <= start:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        if free:
+            row = heapq.heappop(free)
+        else:
+            row = rows
+            rows += 1
+            merged.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                           'tid': row, 'args': {'name': 'job {}'.format(row)}})
+        heapq.heappush(busy, (end, row))
+        for e in events:
+            args = dict(e.get('args', {}), pid=e['pid'])
+            merged.append(dict(e, ts=e['ts'] - origin, pid=1, tid=row,
+                               args=args))
+    return {'traceEvents': merged, 'displayTimeUnit': 'ms'}
+
+
+def summary(trace):
+    """Wall time of the build and (name, count, total time) of spans"""
+    spans = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+    if not spans:
+        return 0, []
+    wall = (max(e['ts'] + e['dur'] for e in spans)
+            - min(e['ts'] for e in spans))
+    totals = {}
+    for e in spans:
+        name = JOB_CATEGORY if e['cat'] == JOB_CATEGORY else e['name']
+        count, total = totals.get(name, (0, 0))
+        totals[name] = (count + 1, total + e['dur'])
+    return wall, sorted(((name, count, total)
+                         for name, (count, total) in totals.items()),
+                        key=lambda t: -t[2])
+
+
+def main():
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='merge pdistcc traces')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='trace files or directories ($PDISTCC_TRACE_DIR)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='merged trace (default: stdout)')
+    parser.add_argument('--summary', action='store_true',
+                        help='print the time spent in every kind of span')
+    args = parser.parse_args()
+    trace = merge(args.paths)
+    if args.output == '-':
+        if not args.summary:
+            json.dump(trace, sys.stdout)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(trace, f)
+    if args.summary:
+        wall, spans = summary(trace)
+        print('build: {:.3f}s'.format(wall/1e6))
+        for name, count, total in spans:
+            print('{:24} {:8} {:12.3f}s'.format(name, count, total/1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,26 @@ import sys
 from setuptools import setup
 entries = {
     'console_scripts': [
-        'pdistcc=pdistcc.cli:main',
+        'pdistcc=pdistcc.fastclient:main',
         'pdistccd=pdistcc.cli:server_main',
+        'pdistcc-broker=pdistcc.broker:broker_main',
     ]
 }
 packages = [
     'pdistcc',
     'pdistcc.compiler',
 ]
-install_requires=['uhashring==2.0']
+install_requires=['fasteners']
+extras_require = {
+    # distcc compatible compression
+    'lzo': ['python-lzo'],
+    'zstd': ['zstandard'],
+}
 
 setup(
     name='pdistcc',
     packages=packages,
     entry_points=entries,
     install_requires=install_requires,
+    extras_require=extras_require,
 )